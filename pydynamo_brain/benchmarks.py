@@ -0,0 +1,314 @@
+# A collection of small timing scripts for the model and file code paths.
+# Run directly, e.g. 'python benchmarks.py', to print timings for each.
+
+import copy
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from pydynamo_brain.files import exportAllToSWC, exportToSWC, fullStateToString, importFromSWC, importSWCFiles, loadState, saveState
+from pydynamo_brain.files.compression import GZIP, CompressedWriter, availableCodecs, readCompressed
+from pydynamo_brain.files.matlab import alignPointID
+from pydynamo_brain.files.traceCache import TRACE_PREFIX, TraceCache
+from pydynamo_brain.model import *
+
+EXAMPLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pydynamo_brain', 'test', 'files', 'example2.dyn.gz')
+
+# Time a single call of func, returning (result, seconds taken)
+def timed(func, *args, **kwargs):
+    startTime = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - startTime
+
+# Soma plus a single unbranched branch of the given number of points.
+def buildLongBranchTree(nPoints):
+    tree = Tree()
+    tree.rootPoint = Point(id='%08x' % 0, location=(0, 0, 0))
+    branch = Branch(id='%04x' % 0)
+    branch.setParentPoint(tree.rootPoint)
+    tree.addBranch(branch)
+    for i in range(1, nPoints + 1):
+        branch.addPoint(Point(id='%08x' % i, location=(i, 0, 0)))
+    return tree
+
+# Walk point by point along a long branch, which should be linear in length.
+def benchmarkBranchWalk(nPoints=10000):
+    tree = buildLongBranchTree(nPoints)
+
+    def _walk():
+        steps, pointAt = 0, tree.rootPoint
+        while pointAt is not None:
+            pointAt = pointAt.nextPointInBranch(noWrap=(pointAt is not tree.rootPoint))
+            steps += 1
+        return steps
+
+    def _pathsToEnd():
+        lastPoint = tree.branches[0].points[-1]
+        return len(lastPoint.pathFromRoot())
+
+    steps, walkSec = timed(_walk)
+    pathLength, pathSec = timed(_pathsToEnd)
+    print ("Branch walk, %d points: %.3fs" % (steps, walkSec))
+    print ("Path from root, %d points: %.3fs" % (pathLength, pathSec))
+
+# Soma plus randomly attached branches, registered with a project so world sizes work.
+def buildRandomTree(nBranches, pointsPerBranch, seed=0):
+    rng = random.Random(seed)
+    fullState = FullState()
+    tree = Tree()
+    fullState.addFiles(['benchmark.tif'], [tree])
+    tree.rootPoint = Point(id=fullState.nextPointID(), location=(0, 0, 0))
+    allPoints = [tree.rootPoint]
+    for _ in range(nBranches):
+        parent = rng.choice(allPoints)
+        branch = Branch(id=fullState.nextBranchID())
+        branch.setParentPoint(parent)
+        tree.addBranch(branch)
+        x, y, z = parent.location
+        for _ in range(pointsPerBranch):
+            x, y, z = x + rng.uniform(-2, 2), y + rng.uniform(-2, 2), z + rng.uniform(-1, 1)
+            point = Point(id=fullState.nextPointID(), location=(x, y, z))
+            branch.addPoint(point)
+            allPoints.append(point)
+    return tree
+
+# Reorder branches by length, then measure the tree's radius.
+def benchmarkSubtreeMetrics(nBranches=1000, pointsPerBranch=20):
+    tree = buildRandomTree(nBranches, pointsPerBranch)
+    _, primarySec = timed(tree.updateAllPrimaryBranches)
+    radii, radiusSec = timed(tree.spatialAndTreeRadius)
+    print ("Update primary branches, %d points: %.3fs" % (len(tree.arrays()), primarySec))
+    print ("Spatial and tree radius (%.1f, %.1f): %.3fs" % (radii[0], radii[1], radiusSec))
+
+# Tree distance matrix between a random sample of points.
+def benchmarkTreeDistances(nBranches=1000, pointsPerBranch=20, nSample=2000):
+    tree = buildRandomTree(nBranches, pointsPerBranch)
+    allPoints = tree.arrays().points
+    sample = random.Random(0).sample(allPoints, min(nSample, len(allPoints)))
+    _, indexSec = timed(tree.ancestorIndex)
+    matrix, matrixSec = timed(tree.treeDistanceMatrix, sample)
+    print ("Ancestor index, %d points: %.3fs" % (len(allPoints), indexSec))
+    print ("Tree distance matrix, %d x %d: %.3fs" % (matrix.shape[0], matrix.shape[1], matrixSec))
+
+# Nearest point lookups, as used for hover and ID alignment.
+def benchmarkClosestPoint(nBranches=1000, pointsPerBranch=20, nQueries=2000):
+    tree = buildRandomTree(nBranches, pointsPerBranch)
+    rng = random.Random(1)
+    targets = [(rng.uniform(-30, 30), rng.uniform(-30, 30), rng.uniform(-10, 10)) for _ in range(nQueries)]
+    _, indexSec = timed(lambda: tree.spatialIndex().closestPoint(targets[0]))
+    _, querySec = timed(lambda: [tree.closestPointTo(target) for target in targets])
+    _, zQuerySec = timed(lambda: [tree.closestPointTo(target, zFilter=True) for target in targets])
+    print ("Spatial index, %d points: %.3fs" % (len(tree.arrays()), indexSec))
+    print ("Closest point, %d queries: %.3fs, %.3fs on same z" % (nQueries, querySec, zQuerySec))
+
+# Memory used by many copies of a project loaded from file, and by an undo snapshot of them all.
+def benchmarkProjectMemory(path=EXAMPLE_PATH, copies=50):
+    tracemalloc.start()
+    states, loadSec = timed(lambda: [loadState(path) for _ in range(copies)])
+    loadedBytes = tracemalloc.get_traced_memory()[0]
+    _, snapshotSec = timed(copy.deepcopy, states)
+    snapshotBytes = tracemalloc.get_traced_memory()[0] - loadedBytes
+    tracemalloc.stop()
+
+    nPoints = sum(len(tree.flattenPoints()) for state in states for tree in state.trees)
+    print ("Load %d copies, %d points: %.3fs, %.1fMB" % (copies, nPoints, loadSec, loadedBytes / 1e6))
+    print ("Snapshot %d points: %.3fs, %.1fMB" % (nPoints, snapshotSec, snapshotBytes / 1e6))
+
+# Undo snapshots while editing one point at a time in a multi-stack project.
+def benchmarkHistory(nStacks=10, nBranches=200, pointsPerBranch=20, nEdits=100):
+    fullState = FullState()
+    for i in range(nStacks):
+        tree = buildRandomTree(nBranches, pointsPerBranch)
+        fullState.addFiles(['stack%d.tif' % i], [tree])
+    fullState.projectOptions.pixelSizes = [1.0, 1.0, 1.0]
+    history = History(fullState)
+    history.pushState()
+    rng = random.Random(2)
+
+    def _edit():
+        tree = rng.choice(fullState.trees)
+        point = rng.choice(tree.flattenPoints())
+        history.pushState()
+        x, y, z = point.location
+        tree.movePoint(point.id, (x + 1, y, z))
+
+    tracemalloc.start()
+    _, editSec = timed(lambda: [_edit() for _ in range(nEdits)])
+    historyBytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    _, undoSec = timed(lambda: [history.undo() for _ in range(nEdits)])
+
+    nPoints = sum(len(tree.flattenPoints()) for tree in fullState.trees)
+    print ("Push %d edits, %d points: %.3fs, %.1fMB" % (nEdits, nPoints, editSec, historyBytes / 1e6))
+    print ("Undo %d edits: %.3fs" % (nEdits, undoSec))
+
+# Save and load of a large project, in each of the file formats.
+def benchmarkFileFormats(nStacks=10, nBranches=500, pointsPerBranch=20):
+    fullState = FullState()
+    for i in range(nStacks):
+        fullState.addFiles(['stack%d.tif' % i], [buildRandomTree(nBranches, pointsPerBranch, seed=i)])
+    nPoints = sum(len(tree.flattenPoints()) for tree in fullState.trees)
+    with tempfile.TemporaryDirectory() as tmpDir:
+        for extension in ['.dyn.gz', '.dynb']:
+            path = os.path.join(tmpDir, 'benchmark' + extension)
+            _, saveSec = timed(saveState, fullState, path)
+            _, loadSec = timed(loadState, path)
+            print ("%s, %d points: save %.3fs, load %.3fs, %.1fMB" % (
+                extension, nPoints, saveSec, loadSec, os.path.getsize(path) / 1e6))
+
+# Opening a long time-lapse project, then using only one of its stacks.
+def benchmarkLazyLoading(nStacks=50, nBranches=200, pointsPerBranch=20):
+    fullState = FullState()
+    for i in range(nStacks):
+        fullState.addFiles(['stack%d.tif' % i], [buildRandomTree(nBranches, pointsPerBranch, seed=i)])
+    with tempfile.TemporaryDirectory() as tmpDir:
+        path = os.path.join(tmpDir, 'benchmark.dynb')
+        saveState(fullState, path)
+        _, eagerSec = timed(loadState, path)
+        lazyState, lazySec = timed(loadState, path, lazy=True)
+        _, firstSec = timed(lambda: lazyState.trees[0].rootPoint)
+        print ("%d stacks: load all %.3fs, lazy open %.3fs + %.3fs for the first stack" % (
+            nStacks, eagerSec, lazySec, firstSec))
+
+# Compression throughput on the serialized text of an autosave-sized project, for each codec and level.
+def benchmarkCompression(nStacks=5, nBranches=200, pointsPerBranch=20):
+    fullState = FullState()
+    for i in range(nStacks):
+        fullState.addFiles(['stack%d.tif' % i], [buildRandomTree(nBranches, pointsPerBranch, seed=i)])
+    text = fullStateToString(fullState)
+    megabytes = len(text) / 1e6
+
+    def _write(path, codec, level, threads):
+        with CompressedWriter(path, codec, level, threads=threads) as outfile:
+            # Written in pieces, like saveState does:
+            for start in range(0, len(text), 64 * 1024):
+                outfile.write(text[start:start + 64 * 1024])
+
+    configs = [(GZIP, 9, 1), (GZIP, 6, 1), (GZIP, 6, None), (GZIP, 1, None)]
+    configs += [(codec, None, None) for codec in availableCodecs() if codec != GZIP]
+    with tempfile.TemporaryDirectory() as tmpDir:
+        path = os.path.join(tmpDir, 'benchmark.dyn.gz')
+        for codec, level, threads in configs:
+            _, writeSec = timed(_write, path, codec, level, threads)
+            _, readSec = timed(readCompressed, path)
+            print ("%s level %s, %s threads, %.1fMB: write %.0f MB/s, read %.0f MB/s, ratio %.1fx" % (
+                codec, 'default' if level is None else level, 'all' if threads is None else threads,
+                megabytes, megabytes / writeSec, megabytes / readSec, len(text) / os.path.getsize(path)))
+
+# Random tree written as SWC, like a large traced reconstruction.
+def writeRandomSWC(path, nNodes, seed=0):
+    rng = random.Random(seed)
+    lines = ["1 1 0 0 0 5 -1"]
+    for nodeID in range(2, nNodes + 1):
+        # Mostly continue from the previous node, sometimes branch from anywhere.
+        parent = nodeID - 1 if rng.random() < 0.95 else rng.randint(1, nodeID - 1)
+        lines.append("%d 3 %.3f %.3f %.3f 1 %d" % (
+            nodeID, rng.uniform(0, 500), rng.uniform(0, 500), rng.uniform(0, 50), parent))
+    with open(path, 'w') as outfile:
+        outfile.write('\n'.join(lines) + '\n')
+
+def benchmarkSWCImport(nNodes=100000):
+    with tempfile.TemporaryDirectory() as tmpDir:
+        path = os.path.join(tmpDir, 'benchmark.swc')
+        writeRandomSWC(path, nNodes)
+        tree, importSec = timed(importFromSWC, path)
+        print ("SWC import, %d nodes in %d branches: %.3fs" % (nNodes, len(tree.branches), importSec))
+
+# Import one SWC per timepoint into a new project, parsing in this process or in a pool.
+def benchmarkSWCBatchImport(nFiles=8, nNodes=20000):
+    with tempfile.TemporaryDirectory() as tmpDir:
+        paths = [os.path.join(tmpDir, 'timepoint%d.swc' % i) for i in range(nFiles)]
+        for i, path in enumerate(paths):
+            writeRandomSWC(path, nNodes, seed=i)
+        _, serialSec = timed(importSWCFiles, paths, workers=1)
+        _, poolSec = timed(importSWCFiles, paths)
+        print ("SWC batch import, %d files of %d nodes: %.3fs in one process, %.3fs with %d CPUs" % (
+            nFiles, nNodes, serialSec, poolSec, os.cpu_count() or 1))
+
+# Export a large tree to SWC, then a whole project at once.
+def benchmarkSWCExport(nStacks=10, nBranches=5000, pointsPerBranch=20):
+    fullState = FullState()
+    for i in range(nStacks):
+        fullState.addFiles(['stack%d.tif' % i], [buildRandomTree(nBranches, pointsPerBranch, seed=i)])
+    fullState.volumeSize = [1, 50, 512, 512]
+    nPoints = len(fullState.trees[0].flattenPoints())
+    with tempfile.TemporaryDirectory() as tmpDir:
+        _, singleSec = timed(exportToSWC, tmpDir, 'single.swc', fullState.trees[0], fullState)
+        _, neuroMSec = timed(exportToSWC, tmpDir, 'neurom.swc', fullState.trees[0], fullState, forNeuroM=True)
+        _, allSec = timed(exportAllToSWC, tmpDir, fullState)
+    print ("SWC export, %d points: %.3fs, %.3fs for NeuroM; all %d stacks %.3fs" % (
+        nPoints, singleSec, neuroMSec, nStacks, allSec))
+
+# Matching up point IDs between the stacks of an imported matlab project.
+# Each stack is the same random tree, moving slightly, with new point IDs and some branches shorter.
+def benchmarkMatlabAlign(nStacks=5, nBranches=500, pointsPerBranch=20, bipartite=False):
+    rng = random.Random(0)
+    fullState = FullState()
+    trees = []
+    for i in range(nStacks):
+        tree = buildRandomTree(nBranches, pointsPerBranch)
+        for branch in tree.branches:
+            if rng.random() < 0.3:
+                branch.removePointLocally(branch.points[-1])
+        for point in tree.flattenPoints():
+            x, y, z = point.location
+            point.location = (x + i + rng.uniform(-0.5, 0.5), y + rng.uniform(-0.5, 0.5), z)
+            point.id = fullState.nextPointID()
+        trees.append(tree)
+    fullState.addFiles(['stack%d.tif' % i for i in range(nStacks)], trees)
+    nPoints = len(trees[0].flattenPoints())
+
+    _, alignSec = timed(alignPointID, fullState, bipartite)
+    sharedIDs = set(p.id for p in trees[0].flattenPoints()) & set(p.id for p in trees[-1].flattenPoints())
+    print ("Align %d stacks of ~%d points%s: %.3fs, %d IDs shared by first and last" % (
+        nStacks, nPoints, " (bipartite)" if bipartite else "", alignSec, len(sharedIDs)))
+
+# Showing one POI's trace and the stimuli, from a recording with many POI.
+def benchmarkTraceCache(nTraces=200, nSamples=100000):
+    import datetime
+    import numpy as np
+    import pynwb
+    nwbFile = pynwb.NWBFile(session_description='benchmark', identifier='benchmark',
+        session_start_time=datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc))
+    for i in range(nTraces):
+        nwbFile.add_acquisition(pynwb.base.TimeSeries(name=TRACE_PREFIX + '%08x' % i,
+            data=np.random.RandomState(i).rand(nSamples), unit='dF/F', rate=30.0))
+    nwbFile.add_stimulus(pynwb.base.TimeSeries(name='stim', data=np.ones(10), unit='s', timestamps=np.arange(10.0)))
+
+    cache = TraceCache()
+    cache.clear()
+    with tempfile.TemporaryDirectory() as tmpDir:
+        path = os.path.join(tmpDir, 'benchmark.nwb')
+        with pynwb.NWBHDF5IO(path, 'w') as io:
+            io.write(nwbFile)
+        _showOne = lambda: (cache.getTraceForPOI([path], '%08x' % 1), cache.getStim([path]))
+        _, firstSec = timed(_showOne)
+        _, allSec = timed(cache.getAllTraces, [path])
+        # Again for memory use, which is much slower to time:
+        cache.clear()
+        tracemalloc.start()
+        _showOne()
+        _, peakBytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        cache.clear()
+    print ("Traces, %d POI of %.1fMB: first POI + stimuli %.3fs (peak %.1fMB), all POI %.3fs" % (
+        nTraces, nSamples * 8 / 1e6, firstSec, peakBytes / 1e6, allSec))
+
+if __name__ == '__main__':
+    benchmarkBranchWalk()
+    benchmarkSubtreeMetrics()
+    benchmarkTreeDistances()
+    benchmarkClosestPoint()
+    benchmarkProjectMemory()
+    benchmarkHistory()
+    benchmarkFileFormats()
+    benchmarkLazyLoading()
+    benchmarkCompression()
+    benchmarkSWCImport()
+    benchmarkSWCExport()
+    benchmarkSWCBatchImport()
+    benchmarkMatlabAlign()
+    benchmarkMatlabAlign(bipartite=True)
+    benchmarkTraceCache()
@@ -1,4 +1,4 @@
-from pydynamo_brain.model import Tree, Branch, Point
+from pydynamo_brain.model import Tree, Branch
 import pydynamo_brain.util as util
 
 from typing import Any
@@ -27,37 +27,29 @@ def TDBL(tree: Tree,
     """
     if not tree.rootPoint:
         return 0.0
-    return _tdblPoint(tree.rootPoint, excludeAxon, excludeBasal, includeFilo, filoDist)
 
-# TDBL for a single point, calculated as the TDBL of children off it.
-def _tdblPoint(
-    point: Point, excludeAxon: bool, excludeBasal: bool, includeFilo: bool, filoDist: float
-) -> float:
+    # Only walk down branches that are included in the total:
+    included = set()
     totalLength = 0.0
-    for childBranch in point.children:
-        totalLength += _tdblBranch(childBranch, excludeAxon, excludeBasal, includeFilo, filoDist)
+    for branch in tree.iterBranches(descendInto=lambda b: id(b) in included):
+        if _tdblIncludesBranch(branch, excludeAxon, excludeBasal):
+            included.add(id(branch))
+            totalLength += _tdblBranch(branch, includeFilo, filoDist)
     return totalLength
 
-# TDBL of a branch, the TDBL for all children plus length along the branch.
+# Whether a branch, and hence everything off it, contributes to TDBL.
 # Optional filters can be applied to remove parts based on annotations.
-def _tdblBranch(
-    branch: Branch, excludeAxon: bool, excludeBasal: bool, includeFilo: bool, filoDist: float
-) -> float:
+def _tdblIncludesBranch(branch: Branch, excludeAxon: bool, excludeBasal: bool) -> bool:
+    # If the branch is 1) Empty, or 2) Axon and 3) Basal when desired, skip
+    return not (branch.isEmpty() or (excludeAxon and branch.isAxon()) or (excludeBasal and branch.isBasal()))
+
+# TDBL contribution of a single branch, its length along the branch.
+def _tdblBranch(branch: Branch, includeFilo: bool, filoDist: float) -> float:
     pointsWithRoot = branch.points
     if branch.parentPoint is not None:
         pointsWithRoot = [branch.parentPoint] + branch.points
-    branchIdx = branch.indexInParent()
-
-    # If the branch is 1) Empty, or 2) Axon and 3) Basal when desired, skip
-    if branch.isEmpty() or (excludeAxon and branch.isAxon()) or (excludeBasal and branch.isBasal()):
-        return 0.0
-
-    # Add all the child branches...
-    tdblLength = 0.0
-    for point in branch.points:
-        tdblLength += _tdblPoint(point, excludeAxon, excludeBasal, includeFilo, filoDist)
 
-    # ... then remove any points up to and including the last point marked 'soma'
+    # Remove any points up to and including the last point marked 'soma'
     somaIdx = util.lastPointWithLabelIdx(pointsWithRoot, 'soma')
 
     # ... measure distance for entire branch, and up to last branchpoint:
@@ -65,7 +57,5 @@ def _tdblBranch(
 
     # Use full distance only if including filo, or if the end isn't a filo.
     if includeFilo or (totalLength - totalLengthToLastBranch) > filoDist:
-        tdblLength += totalLength
-    else:
-        tdblLength += totalLengthToLastBranch
-    return tdblLength
+        return totalLength
+    return totalLengthToLastBranch
@@ -1,6 +1,6 @@
 import numpy as np
 
-from typing import Any, List, Tuple
+from typing import Any, Dict, Iterator, List, Tuple
 
 import pydynamo_brain.util as util
 from pydynamo_brain.model import Tree, FiloType
@@ -49,9 +49,9 @@ def addedSubtractedTransitioned(
             treeRoot = trees[treeIdx].rootPoint
             if treeRoot is not None:
                 for branch in treeRoot.children:
-                    branchIdx = branchIDList.index(branch.id)
-                    _recursiveFiloTypes(
-                        branchIDList, filoTypes, masterNodes, trees, treeIdx, branchIdx,
+                    branchIdx = branchIDLookup[branch.id]
+                    _allFiloTypes(
+                        branchIDList, branchIDLookup, filoTypes, masterNodes, trees, treeIdx, branchIdx,
                         excludeAxon, excludeBasal, terminalDist, filoDist
                     )
 
@@ -74,11 +74,34 @@ def addedSubtractedTransitioned(
 
     return filoTypes, added, subtracted, transitioned, masterChanged, masterNodes
 
-def _recursiveFiloTypes(
-    branchIDList: List[str], filoTypes: np.ndarray, masterNodes: np.ndarray,
+# Fill in filo types for a branch and all non-filo branches down from it.
+def _allFiloTypes(
+    branchIDList: List[str], branchIDLookup: Dict[str, int], filoTypes: np.ndarray, masterNodes: np.ndarray,
     trees: List[Tree], treeIdx: int, branchIdx: int,
     excludeAxon: bool, excludeBasal: bool, terminalDist: float, filoDist: float
 ) -> None:
+    def _stepsFor(idx: int) -> Iterator[int]:
+        return _branchFiloTypes(
+            branchIDList, branchIDLookup, filoTypes, masterNodes, trees, treeIdx, idx,
+            excludeAxon, excludeBasal, terminalDist, filoDist
+        )
+
+    # Each branch's steps pause whenever a child branch needs to be fully processed first,
+    # so run them off an explicit stack rather than recursing.
+    toRun = [_stepsFor(branchIdx)]
+    while len(toRun) > 0:
+        childBranchIdx = next(toRun[-1], None)
+        if childBranchIdx is None:
+            toRun.pop()
+        else:
+            toRun.append(_stepsFor(childBranchIdx))
+
+# Filo types for a single branch, yielding the index of each child branch that must be processed before continuing.
+def _branchFiloTypes(
+    branchIDList: List[str], branchIDLookup: Dict[str, int], filoTypes: np.ndarray, masterNodes: np.ndarray,
+    trees: List[Tree], treeIdx: int, branchIdx: int,
+    excludeAxon: bool, excludeBasal: bool, terminalDist: float, filoDist: float
+) -> Iterator[int]:
     branch = trees[treeIdx].getBranchByID(branchIDList[branchIdx])
     if branch is None:
         filoTypes[treeIdx][branchIdx] = FiloType.ABSENT
@@ -111,10 +134,10 @@ def _recursiveFiloTypes(
             if len(childBranch.points) < 1:
                 continue # Skip empty branches
 
-            if childBranch.id not in branchIDList:
+            if childBranch.id not in branchIDLookup:
                 continue # branch is not known? what?
 
-            childBranchIdx = branchIDList.index(childBranch.id)
+            childBranchIdx = branchIDLookup[childBranch.id]
             childIsFilo, childLength = childBranch.isFilo(filoDist)
             if childIsFilo:
                 distPointToEnd = totalLength - cumulativeLengths[pointIdx]
@@ -132,7 +155,7 @@ def _recursiveFiloTypes(
             else: # Not filo
                 # all terminal filopodia identified so far are actually interstitial
                 forceInterstitial = True
-                _recursiveFiloTypes(branchIDList, filoTypes, masterNodes, trees, treeIdx, childBranchIdx, excludeAxon, excludeBasal, terminalDist, filoDist)
+                yield childBranchIdx
 
         # Turn all previous terminal filos into interstitial filos
         if forceInterstitial:
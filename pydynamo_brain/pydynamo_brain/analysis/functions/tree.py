@@ -15,7 +15,7 @@ MIN_MOTILITY = 0.1
 def pointCount(fullState: FullState, **kwargs: Any) -> pd.DataFrame:
     counts = []
     for tree in fullState.trees:
-        counts.append(len(tree.flattenPoints()))
+        counts.append(len(tree.arrays()))
     return pd.DataFrame({'pointCount': counts})
 
 # Provide the number of branches in each tree.
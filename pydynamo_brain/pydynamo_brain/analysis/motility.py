@@ -5,7 +5,7 @@ from typing import Any, Dict, List, Tuple
 from .addedSubtractedTransitioned import addedSubtractedTransitioned
 from .TDBL import TDBL
 
-from pydynamo_brain.model import Tree, Branch, FiloType
+from pydynamo_brain.model import Tree, FiloType
 import pydynamo_brain.util as util
 
 def motility(trees: List[Tree],
@@ -42,6 +42,7 @@ def motility(trees: List[Tree],
     nTrees = len(trees)
     branchIDList = util.sortedBranchIDList(trees)
     nBranches = len(branchIDList)
+    branchIDLookup = {branchID: i for i, branchID in enumerate(branchIDList)}
 
     resultShape = (nTrees, nBranches)
     filoLengths = np.full(resultShape, np.nan)
@@ -50,9 +51,7 @@ def motility(trees: List[Tree],
     # Calculate Filo lengths for all trees:
     for treeIdx, tree in enumerate(trees):
         allTDBL[treeIdx] = TDBL(tree, excludeAxon, excludeBasal, includeFilo=True, filoDist=filoDist)
-        if tree.rootPoint is not None:
-            for branch in tree.rootPoint.children:
-                _calcFiloLengths(branchIDList, filoLengths[treeIdx], treeIdx, branch, excludeAxon, excludeBasal, filoDist)
+        _calcFiloLengths(branchIDLookup, filoLengths[treeIdx], tree, excludeAxon, excludeBasal, filoDist)
 
     # Raw motility:
     lengthBefore, lengthAfter = filoLengths[:-1, :], filoLengths[1:, :]
@@ -79,40 +78,36 @@ def motility(trees: List[Tree],
     return motilities, filoLengths
 
 
+# Fill in filo lengths for all branches in a tree.
 def _calcFiloLengths(
-    branchIDList: List[str], filoLengths: np.ndarray,
-    treeIdx: int, branch: Branch,
+    branchIDLookup: Dict[str, int], filoLengths: np.ndarray, tree: Tree,
     excludeAxon: bool, excludeBasal: bool, filoDist: float
 ) -> None:
-    if branch.id not in branchIDList:
-        return
-
-    branchIdx = branchIDList.index(branch.id)
-    pointsWithRoot = branch.points
-    if branch.parentPoint is not None:
-        pointsWithRoot = [branch.parentPoint] + pointsWithRoot
-
-    # 1) If the branch has not been created yet, or is empty, abort
-    if branch.isEmpty():
-        filoLengths[branchIdx] = 0.0
-        return
-    # 2) If the branch contains an 'axon' label, abort. 3) Same with basal dendrite.
-    if (excludeAxon and branch.isAxon()) or (excludeBasal and branch.isBasal()):
-        filoLengths[branchIdx] = np.nan
-        return
-    # 4) If we're a filo, set and stop:
-    isFilo, branchLength = branch.isFilo(filoDist)
-    if isFilo:
-        filoLengths[branchIdx] = branchLength
-        return
-
-    # 5) Recurse to fill filolengths cache for all child branches:
-    for point in branch.points:
-        for childBranch in point.children:
-            _calcFiloLengths(branchIDList, filoLengths, treeIdx, childBranch, excludeAxon, excludeBasal, filoDist)
-
-    # 6) Add the final filo for this branch if it is there, otherwise use entire length
-    filoLengths[branchIdx] = 0
-    totalLength, totalLengthToLastBranch = branch.worldLengths()
-    lengthPastLastBranch = totalLength - totalLengthToLastBranch
-    filoLengths[branchIdx] = lengthPastLastBranch
+    # Only walk down branches that aren't themselves filos or excluded:
+    descendInto = set()
+    for branch in tree.iterBranches(descendInto=lambda b: id(b) in descendInto):
+        if branch.id not in branchIDLookup:
+            continue
+        branchIdx = branchIDLookup[branch.id]
+
+        # 1) If the branch has not been created yet, or is empty, abort
+        if branch.isEmpty():
+            filoLengths[branchIdx] = 0.0
+            continue
+        # 2) If the branch contains an 'axon' label, abort. 3) Same with basal dendrite.
+        if (excludeAxon and branch.isAxon()) or (excludeBasal and branch.isBasal()):
+            filoLengths[branchIdx] = np.nan
+            continue
+        # 4) If we're a filo, set and stop:
+        isFilo, branchLength = branch.isFilo(filoDist)
+        if isFilo:
+            filoLengths[branchIdx] = branchLength
+            continue
+
+        # 5) Walk down to fill filolengths cache for all child branches:
+        descendInto.add(id(branch))
+
+        # 6) Add the final filo for this branch if it is there, otherwise use entire length
+        totalLength, totalLengthToLastBranch = branch.worldLengths()
+        lengthPastLastBranch = totalLength - totalLengthToLastBranch
+        filoLengths[branchIdx] = lengthPastLastBranch
@@ -5,54 +5,42 @@ from numpy.linalg import det, norm
 
 from typing import List, Tuple
 
-from pydynamo_brain.model import Tree, Point
+from pydynamo_brain.model import Tree
 
 # Smooth to a polynomial of degree 7:
 _DEFAULT_POLY_DEGREE = 7
 
-# from: https://gist.github.com/nim65s/5e9902cd67f094ce65b0
-def _distance(A: np.ndarray, B: np.ndarray, P: np.ndarray) -> float:
-    """ segment line AB, point P, where each one is an array([x, y]) """
-    if np.all(A == P) or np.all(B == P):
-        return 0
-    if np.arccos(np.dot((P - A) / norm(P - A), (B - A) / norm(B - A))) > np.pi / 2:
-        return norm(P - A)
-    if np.arccos(np.dot((P - B) / norm(P - B), (A - B) / norm(A - B))) > np.pi / 2:
-        return norm(P - B)
-    return norm(np.cross(A - B, A - P)) / norm(B - A)
-
-def _lineSegmentCrossRadius(tree: Tree, fr: Point, to: Point, soma: Point, r: float) -> bool:
-    xs, ys, zs = tree.worldCoordPoints([fr, to, soma])
-    A = np.array([xs[0], ys[0], zs[0]])
-    B = np.array([xs[1], ys[1], zs[1]])
-    P = np.array([xs[2], ys[2], zs[2]])
-    maxDist = max(norm(P - A), norm(P - B))
-    minDist = _distance(A, B, P)
-    return minDist <= r <= maxDist
-
-# Number of times branches of the tree cross a given radius
-def _nCrossings(tree: Tree, rad: float) -> int:
-    if tree.rootPoint is None:
-        return 0
-
-    crosses = 0
-    if rad == 0:
-        return crosses
-    else:
-        for point in tree.flattenPoints():
-            if point.isRoot():
-                continue
-            pointBefore = point.nextPointInBranch(delta=-1, noWrap=False)
-            if pointBefore is None:
-                continue
-            if _lineSegmentCrossRadius(tree, point, pointBefore, tree.rootPoint, rad):
-                crosses += 1
-        return crosses
+# For every edge in the tree, the closest and furthest distance from the soma.
+def _edgeDistanceRanges(tree: Tree) -> Tuple[np.ndarray, np.ndarray]:
+    arrays = tree.arrays()
+    hasParent = arrays.parents >= 0
+    A = arrays.worldLocations[hasParent]
+    B = arrays.worldLocations[arrays.parents[hasParent]]
+    P = arrays.worldLocations[0]
+
+    distA, distB = norm(P - A, axis=1), norm(P - B, axis=1)
+    maxDist = np.maximum(distA, distB)
+
+    # Closest distance from P to segment AB, for all segments at once.
+    # from: https://gist.github.com/nim65s/5e9902cd67f094ce65b0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        minDist = norm(np.cross(A - B, A - P), axis=1) / norm(B - A, axis=1)
+    beyondB = np.einsum('ij,ij->i', P - B, A - B) < 0
+    beyondA = np.einsum('ij,ij->i', P - A, B - A) < 0
+    minDist[beyondB] = distB[beyondB]
+    minDist[beyondA] = distA[beyondA]
+    minDist[(distA == 0) | (distB == 0)] = 0
+    return minDist, maxDist
 
 # Calculate sholl properties for a tree
 def shollCrossings(tree: Tree, binSizeUm: float, maxRadius: float) -> Tuple[np.ndarray, np.ndarray]:
     radii = np.arange(0, maxRadius, binSizeUm)
-    crossCounts = [_nCrossings(tree, r) for r in radii]
+    if tree.rootPoint is None:
+        return np.zeros(len(radii), dtype=int), radii
+    minDist, maxDist = _edgeDistanceRanges(tree)
+    crossCounts = [
+        0 if r == 0 else int(np.count_nonzero((minDist <= r) & (r <= maxDist))) for r in radii
+    ]
     return np.array(crossCounts), radii
 
 # Calculate metrics from fitting a curve to the crossings:
@@ -1,6 +1,8 @@
 from .autosaver import AutoSaver
-from .files import loadState, saveState, checkIfChanged, fullStateToString, stringToFullState
+from .columnar import loadStateBinary, saveStateBinary
+from .files import loadState, saveState, checkIfChanged, fullStateToString, stringToFullState, writeFullState
 from .idremap import saveRemapWithMerge
+from .journal import Journal, hasJournal
 from .matlab import importFromMatlab, parseMatlabTree
-from .swc import exportToSWC, importFromSWC
+from .swc import exportAllToSWC, exportToSWC, findSWCFiles, importFromSWC, importSWCFiles
 from .traceCache import TraceCache
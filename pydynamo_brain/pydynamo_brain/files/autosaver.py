@@ -1,9 +1,12 @@
 import os
 import os.path
+import threading
 import time
 
 import pydynamo_brain.util as util
+from pydynamo_brain.model.stateDiff import materializeState, recordState
 from .files import saveState
+from .journal import Journal
 
 # Save every 3 minutes
 MAX_UNSAVED_MS = 3 * 60 * 1000
@@ -15,26 +18,95 @@ DATETIME_SUFFIX_FORMAT = "%m-%d-%Y_%H-%M"
 AUTOSAVE_DIR = "autosave"
 
 class AutoSaver():
-    def __init__(self, fullState):
+    """Keeps unsaved edits safe, without blocking the UI.
+
+    In journal mode, every change is appended to a small write-ahead journal next to the project.
+    Otherwise, a full copy is periodically written to the autosave directory: the state is
+    snapshotted on the calling thread (cheap, unchanged trees are reused from the previous
+    snapshot), then rebuilt, serialized and compressed on a worker thread."""
+
+    USE_JOURNAL = True
+    """Whether to journal each change, rather than periodically saving full copies."""
+
+    def __init__(self, fullState, journal=None):
         self.fullState = fullState
         self.lastSaveMs = util.currentTimeMillis()
+        self._lastSnapshot = None
+        self._worker = None
+        # Pass in a journal that edits were recovered from, to keep using it.
+        self._journal = journal
+        if self._journal is None:
+            self.projectSaved()
+
+    def projectSaved(self):
+        """State has just been loaded or saved, so journaled edits are now in the project file."""
+        if self._journal is not None:
+            self._journal.close(delete=True)
+            self._journal = None
+        path = self.fullState._rootPath
+        if AutoSaver.USE_JOURNAL and path is not None and not self.fullState.hasUnsavedChanges():
+            self._journal = Journal(path)
+            self._journal.start(self.fullState)
+
+    def close(self):
+        """Finish any autosave in progress, and drop the journal as the app is closing normally."""
+        self.waitForSave()
+        if self._journal is not None:
+            self._journal.close(delete=True)
+            self._journal = None
+
+    def handleStateChange(self, statusFunc=None):
+        """Journal or autosave changes. statusFunc(msg) is called with problems or background results."""
+        if self._journal is not None:
+            try:
+                self._journal.record(self.fullState)
+            except Exception as e:
+                print ("Journal failed: %s" % e)
+                self._journal.close()
+                self._journal = None # Fall back to full autosaves
+                if statusFunc is not None:
+                    statusFunc("Journal failed, using autosave instead: %s" % e)
+            return
 
-    def handleStateChange(self, msgBoxFunc):
         msSinceLastSave = self._msSinceLastSave()
         if msSinceLastSave < MAX_UNSAVED_MS:
             return
         if self.fullState._rootPath is None:
             return
+        if self.isSaving():
+            return # Only one autosave at a time.
 
         pathToSave = self._buildAutoSavePath(self.fullState._rootPath)
-        msgBox = msgBoxFunc("Autosaving...")
-        saveState(self.fullState, pathToSave)
+        self._lastSnapshot = recordState(self.fullState, self._lastSnapshot)
         self.lastSaveMs = util.currentTimeMillis()
-        
-        # Fix an issue with saving to quickly and the window not closing:
-        time.sleep(0.05)
-        msgBox.hide()
-        print ("Autosaved to " + pathToSave)
+        self._worker = threading.Thread(
+            target=self._saveInBackground, args=(self._lastSnapshot, pathToSave, statusFunc),
+            name="dynamo-autosave"
+        )
+        self._worker.start()
+
+    def isSaving(self):
+        return self._worker is not None and self._worker.is_alive()
+
+    def waitForSave(self):
+        """Block until any autosave in progress has finished."""
+        if self._worker is not None:
+            self._worker.join()
+
+    def _saveInBackground(self, snapshot, pathToSave, statusFunc):
+        # Write then rename, so quitting mid-save never leaves a partial autosave behind.
+        tmpPath = pathToSave + ".partial"
+        try:
+            saveState(materializeState(snapshot), tmpPath)
+            os.replace(tmpPath, pathToSave)
+            msg = "Autosaved to " + pathToSave
+        except Exception as e:
+            msg = "Autosave failed: %s" % e
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+        print (msg)
+        if statusFunc is not None:
+            statusFunc(msg)
 
     def _msSinceLastSave(self):
         return util.currentTimeMillis() - self.lastSaveMs
@@ -0,0 +1,271 @@
+"""
+Binary columnar project format (.dynb).
+
+Each tree and puncta list is stored as a table of per-point columns in an npz archive,
+with branches as runs of rows. Everything else goes in a small JSON header.
+Loading gives the same FullState as the equivalent .dyn.gz, including ints vs floats.
+
+Each stack's columns are compressed separately, so trees can be loaded lazily: only when first
+used. The header keeps the next free point/branch IDs, so these don't need every tree to find.
+"""
+import attr
+import io
+import json
+import numpy as np
+import threading
+
+from typing import Any, Dict, List, Optional, Tuple
+
+from pydynamo_brain.model import *
+
+from .files import attrFilter, convert, convertToProjectOptions, convertToUIState, indexFullState, indexTree, typeFix
+
+BINARY_EXTENSION = '.dynb'
+
+_FORMAT_VERSION = 1
+
+# Fields stored as columns rather than in the JSON header:
+_COLUMNAR_FIELDS = ('trees', 'puncta')
+
+# Codes for how a value was stored, so it loads back as the same type:
+_TYPE_NONE, _TYPE_FLOAT, _TYPE_INT = 0, 1, 2
+
+def isBinaryPath(path: str) -> bool:
+    return path.endswith(BINARY_EXTENSION)
+
+def saveStateBinary(fullState: FullState, path: str) -> None:
+    arrays: Dict[str, np.ndarray] = {}
+    header: Dict[str, Any] = {
+        'version': _FORMAT_VERSION,
+        'state': attr.asdict(fullState, filter=_headerFilter),
+        'transforms': [attr.asdict(tree.transform, filter=attrFilter) for tree in fullState.trees],
+        'punctaCount': len(fullState.puncta),
+    }
+    hasRoot = []
+    for i, tree in enumerate(fullState.trees):
+        if not tree.isLoaded() and isinstance(tree._pendingLoad, _StackLoader):
+            # Never loaded so can't have changed, copy the columns across as they were:
+            columns, treeHasRoot = tree._pendingLoad.columns(), tree._pendingLoad.hasRoot
+        else:
+            columns, treeHasRoot = _treeColumns(tree), tree.rootPoint is not None
+        _addColumns(arrays, 'tree%d.' % i, columns)
+        hasRoot.append(treeHasRoot)
+    header['hasRoot'] = hasRoot
+    for i, puncta in enumerate(fullState.puncta):
+        points = puncta if isinstance(puncta, list) else []
+        _addColumns(arrays, 'puncta%d.' % i, _pointColumns(points))
+    header['nextPointID'], header['nextBranchID'] = _nextIDs(fullState, arrays)
+
+    headerText = json.dumps(header, default=typeFix).encode('utf-8')
+    arrays['header'] = np.frombuffer(headerText, dtype=np.uint8)
+    # Open directly, otherwise numpy appends .npz to the path.
+    with open(path, 'wb') as outfile:
+        np.savez_compressed(outfile, **arrays)
+
+def loadStateBinary(path: str, lazy: bool=False) -> FullState:
+    """Load a .dynb project. If lazy, each stack's tree is only loaded when first used."""
+    # Read into memory, so trees can still be loaded if the file is overwritten by a save.
+    with open(path, 'rb') as infile:
+        archive = np.load(io.BytesIO(infile.read()), allow_pickle=False)
+    # Autosaves can load stacks on a worker thread, so reads from the archive are one at a time:
+    archiveLock = threading.Lock()
+    header = json.loads(archive['header'].tobytes().decode('utf-8'))
+    if header['version'] > _FORMAT_VERSION:
+        raise ValueError("%s was saved by a newer version (format %d)" % (path, header['version']))
+
+    asDict = header['state']
+    asDict['trees'] = []
+    for i, (hasRoot, transform) in enumerate(zip(header['hasRoot'], header['transforms'])):
+        loader = _StackLoader(archive, archiveLock, 'tree%d.' % i, hasRoot)
+        tree = Tree.lazy(loader, Transform(**transform))
+        if not lazy:
+            loader.fill(tree)
+        asDict['trees'].append(tree)
+    asDict['puncta'] = [
+        _pointsFromColumns(_getColumns(archive, 'puncta%d.' % i))
+        for i in range(header['punctaCount'])
+    ]
+    convert(asDict, 'uiStates', convertToUIState, isArray=True)
+    convert(asDict, 'projectOptions', convertToProjectOptions)
+
+    fullState = FullState(**asDict)
+    nextIDs = None
+    if 'nextPointID' in header:
+        nextIDs = (header['nextPointID'], header['nextBranchID'])
+    elif lazy:
+        # Older file, find the next IDs from the columns without loading any trees.
+        nextIDs = _nextIDs(fullState, {key: archive[key] for key in archive.files if key.endswith(('.ids', '.branchIDs'))})
+    # Trees are indexed as they're loaded:
+    return indexFullState(fullState, path, nextIDs=nextIDs, indexTrees=False)
+
+def _headerFilter(attrData: attr.Attribute, value: Any) -> bool:
+    return attrFilter(attrData, value) and attrData.name not in _COLUMNAR_FIELDS
+
+def _nextIDs(fullState: FullState, arrays: Dict[str, np.ndarray]) -> Tuple[int, int]:
+    """Next free point and branch IDs, from the state's counters and all the saved ID columns."""
+    nextPointID, nextBranchID = fullState._nextPointID, fullState._nextBranchID
+    for key, column in arrays.items():
+        if key.endswith('.ids') and len(column) > 0:
+            nextPointID = max(nextPointID, 1 + max(int(pointID, 16) for pointID in column.tolist()))
+        elif key.endswith('.branchIDs') and len(column) > 0:
+            nextBranchID = max(nextBranchID, 1 + max(int(branchID, 16) for branchID in column.tolist()))
+    return nextPointID, nextBranchID
+
+
+class _StackLoader():
+    """Loads one stack's tree from its columns, see Tree.lazy."""
+
+    def __init__(self, archive: Any, archiveLock: threading.Lock, prefix: str, hasRoot: bool) -> None:
+        self.archive = archive
+        self.archiveLock = archiveLock
+        self.prefix = prefix
+        self.hasRoot = hasRoot
+
+    def __deepcopy__(self, memo: Dict[int, Any]) -> '_StackLoader':
+        # The archive is only ever read, so copies share it, and its lock.
+        return self
+
+    def columns(self) -> Dict[str, np.ndarray]:
+        with self.archiveLock:
+            return _getColumns(self.archive, self.prefix)
+
+    def fill(self, tree: Tree) -> None:
+        rootPoint, branches = _structureFromColumns(self.columns(), self.hasRoot)
+        tree.rootPoint = rootPoint
+        tree.branches = branches
+        indexTree(tree)
+        tree._pendingLoad = None
+
+    def __call__(self, tree: Tree) -> None:
+        self.fill(tree)
+
+
+### Writing columns
+
+def _treeColumns(tree: Tree) -> Dict[str, np.ndarray]:
+    points = [] if tree.rootPoint is None else [tree.rootPoint]
+    for branch in tree.branches:
+        points.extend(branch.points)
+    rowForPoint = {id(point): row for row, point in reversed(list(enumerate(points)))}
+
+    # Parents not in the tree are kept as extra rows after all the tree's points:
+    extraPoints: List[Point] = []
+    def _rowFor(point: Optional[Point]) -> int:
+        if point is None:
+            return -1
+        if id(point) not in rowForPoint:
+            rowForPoint[id(point)] = len(points) + len(extraPoints)
+            extraPoints.append(point)
+        return rowForPoint[id(point)]
+
+    branchParents = [_rowFor(branch.parentPoint) for branch in tree.branches]
+    branchReparents = [_rowFor(branch.reparentTo) for branch in tree.branches]
+    columns = _pointColumns(points + extraPoints)
+
+    columns['treePointCount'] = np.array(len(points), dtype=np.int64)
+    columns['branchIDs'] = _stringColumn([branch.id for branch in tree.branches])
+    columns['branchSizes'] = np.array([len(branch.points) for branch in tree.branches], dtype=np.int64)
+    columns['branchParents'] = np.array(branchParents, dtype=np.int64)
+    columns['branchReparents'] = np.array(branchReparents, dtype=np.int64)
+    return columns
+
+def _pointColumns(points: List[Point]) -> Dict[str, np.ndarray]:
+    n = len(points)
+    locations, isIntRows = [], []
+    radii, radiusTypes = [], []
+    annotationRows, manuallyMarked, hilighted = [], [], []
+    annotationTable: Dict[str, int] = {}
+    for point in points:
+        locations.append(point.location)
+        isIntRows.append([type(v) is int for v in point.location])
+        radii.append(0.0 if point.radius is None else point.radius)
+        radiusTypes.append(_typeCode(point.radius))
+        annotationRows.append(-1 if point.annotation is None else
+            annotationTable.setdefault(point.annotation, len(annotationTable)))
+        manuallyMarked.append(_flagCode(point.manuallyMarked))
+        hilighted.append(_flagCode(point.hilighted))
+
+    columns = {
+        'ids': _stringColumn([point.id for point in points]),
+        'locations': np.array(locations, dtype=np.float64).reshape((n, 3)),
+        'radii': np.array(radii, dtype=np.float64),
+        'radiusTypes': np.array(radiusTypes, dtype=np.int8),
+        'annotations': _stringColumn(list(annotationTable.keys())),
+        'annotationRows': np.array(annotationRows, dtype=np.int32),
+        'manuallyMarked': np.array(manuallyMarked, dtype=np.int8),
+        'hilighted': np.array(hilighted, dtype=np.int8),
+    }
+    locationInts = np.array(isIntRows, dtype=bool).reshape((n, 3))
+    if locationInts.any():
+        columns['locationInts'] = locationInts
+    return columns
+
+def _stringColumn(values: List[str]) -> np.ndarray:
+    return np.array(values, dtype=str) if len(values) > 0 else np.zeros(0, dtype='U1')
+
+def _typeCode(value: Optional[float]) -> int:
+    if value is None:
+        return _TYPE_NONE
+    return _TYPE_INT if type(value) is int else _TYPE_FLOAT
+
+def _flagCode(value: Optional[bool]) -> int:
+    return -1 if value is None else int(value)
+
+def _addColumns(arrays: Dict[str, np.ndarray], prefix: str, columns: Dict[str, np.ndarray]) -> None:
+    for name, column in columns.items():
+        arrays[prefix + name] = column
+
+
+### Reading columns
+
+def _getColumns(archive: Any, prefix: str) -> Dict[str, np.ndarray]:
+    """Columns with a given prefix from the npz archive, only those are decompressed."""
+    return {key[len(prefix):]: archive[key] for key in archive.files if key.startswith(prefix)}
+
+def _structureFromColumns(columns: Dict[str, np.ndarray], hasRoot: bool) -> Tuple[Optional[Point], List[Branch]]:
+    allPoints = _pointsFromColumns(columns)
+    treePointCount = int(columns['treePointCount'])
+    parents = columns['branchParents'].tolist()
+    reparents = columns['branchReparents'].tolist()
+
+    branches = []
+    start = 1 if hasRoot else 0
+    for branchID, size, parentRow, reparentRow in zip(
+            columns['branchIDs'].tolist(), columns['branchSizes'].tolist(), parents, reparents):
+        branches.append(Branch(
+            id=branchID,
+            parentPoint=None if parentRow < 0 else allPoints[parentRow],
+            points=allPoints[start:start + size],
+            reparentTo=None if reparentRow < 0 else allPoints[reparentRow],
+        ))
+        start += size
+    assert start == treePointCount, "Corrupt tree, branch sizes don't match number of points"
+    return (allPoints[0] if hasRoot else None), branches
+
+def _pointsFromColumns(columns: Dict[str, np.ndarray]) -> List[Point]:
+    locations = list(map(tuple, columns['locations'].tolist()))
+    if 'locationInts' in columns:
+        for row in np.flatnonzero(columns['locationInts'].any(axis=1)).tolist():
+            ints = columns['locationInts'][row]
+            locations[row] = tuple(int(v) if isInt else v for v, isInt in zip(locations[row], ints))
+
+    annotations = columns['annotations'].tolist()
+    newPoint = Point.fromSaved
+    points = []
+    for pointID, location, radius, radiusType, annotationRow, marked, hilit in zip(
+            columns['ids'].tolist(), locations, columns['radii'].tolist(), columns['radiusTypes'].tolist(),
+            columns['annotationRows'].tolist(), columns['manuallyMarked'].tolist(), columns['hilighted'].tolist()):
+        points.append(newPoint(
+            id=pointID,
+            location=location,
+            radius=_fromTypeCode(radius, radiusType),
+            annotation=None if annotationRow < 0 else annotations[annotationRow],
+            manuallyMarked=None if marked < 0 else bool(marked),
+            hilighted=None if hilit < 0 else bool(hilit),
+        ))
+    return points
+
+def _fromTypeCode(value: float, typeCode: int) -> Optional[float]:
+    if typeCode == _TYPE_NONE:
+        return None
+    return int(value) if typeCode == _TYPE_INT else value
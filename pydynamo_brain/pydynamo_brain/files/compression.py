@@ -0,0 +1,150 @@
+"""
+Compression used for .dyn.gz project files.
+
+gzip is written as a series of independently compressed members, one per block, so blocks can
+be compressed on several threads and the result is still a normal gzip file. zstd and lz4 are
+available if their (optional) packages are installed. The codec is detected from the file's
+first bytes on load, so it doesn't need to match the extension.
+"""
+import gzip
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, List, Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
+
+GZIP, ZSTD, LZ4 = 'gzip', 'zstd', 'lz4'
+
+# Level used when the project doesn't pick one:
+DEFAULT_LEVELS = {GZIP: 6, ZSTD: 3, LZ4: 0}
+
+# Valid (min, max) levels for each codec:
+LEVEL_RANGES = {GZIP: (1, 9), ZSTD: (1, 22), LZ4: (0, 16)}
+
+_MAGIC = {GZIP: b'\x1f\x8b', ZSTD: b'\x28\xb5\x2f\xfd', LZ4: b'\x04\x22\x4d\x18'}
+
+# Uncompressed size of each independently compressed gzip member:
+_GZIP_BLOCK_BYTES = 1024 * 1024
+
+def availableCodecs() -> List[str]:
+    """Codecs that can be used here, the optional ones need their packages installed."""
+    result = [GZIP]
+    if zstandard is not None:
+        result.append(ZSTD)
+    if lz4frame is not None:
+        result.append(LZ4)
+    return result
+
+def detectCodec(header: bytes) -> str:
+    for codec, magic in _MAGIC.items():
+        if header.startswith(magic):
+            return codec
+    raise ValueError("Unknown compression, file doesn't start with a gzip, zstd or lz4 header")
+
+def _levelFor(codec: str, level: Optional[int]) -> int:
+    if level is None:
+        return DEFAULT_LEVELS[codec]
+    low, high = LEVEL_RANGES[codec]
+    return min(max(int(level), low), high)
+
+
+class CompressedWriter():
+    """File-like object that compresses everything written to it, close() to finish."""
+
+    def __init__(self, path: str, codec: str=GZIP, level: Optional[int]=None, threads: Optional[int]=None) -> None:
+        if codec not in availableCodecs():
+            print ("WARNING: %s compression not installed, saving as gzip instead" % codec)
+            codec = GZIP
+        self.codec = codec
+        self.level = _levelFor(codec, level)
+        self.threads = threads if threads is not None else (os.cpu_count() or 1)
+        self._file: BinaryIO = open(path, 'wb')
+        self._stream: Optional[BinaryIO] = None
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._pending: List = []
+        self._block: List[bytes] = []
+        self._blockBytes = 0
+
+        if codec == ZSTD:
+            compressor = zstandard.ZstdCompressor(level=self.level, threads=self.threads)
+            self._stream = compressor.stream_writer(self._file, closefd=False)
+        elif codec == LZ4:
+            self._stream = lz4frame.LZ4FrameFile(self._file, 'wb', compression_level=self.level)
+        elif self.threads > 1:
+            self._pool = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='dynamo-gzip')
+
+    def __enter__(self) -> 'CompressedWriter':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def write(self, data: bytes) -> None:
+        if self._stream is not None:
+            self._stream.write(data)
+            return
+        self._block.append(data)
+        self._blockBytes += len(data)
+        if self._blockBytes >= _GZIP_BLOCK_BYTES:
+            self._flushBlock()
+
+    def close(self) -> None:
+        if self._file.closed:
+            return
+        try:
+            if self._stream is not None:
+                self._stream.close()
+            else:
+                self._flushBlock()
+                self._writeFinished(0)
+                if self._file.tell() == 0:
+                    # Nothing written, still leave a valid (empty) gzip file:
+                    self._file.write(gzip.compress(b'', compresslevel=self.level, mtime=0))
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown()
+            self._file.close()
+
+    def _flushBlock(self) -> None:
+        if self._blockBytes == 0:
+            return
+        block = b''.join(self._block)
+        self._block, self._blockBytes = [], 0
+        # mtime=0 keeps the output the same for the same contents.
+        if self._pool is None:
+            self._file.write(gzip.compress(block, compresslevel=self.level, mtime=0))
+            return
+        # zlib releases the GIL while compressing, so blocks compress in parallel.
+        self._pending.append(self._pool.submit(gzip.compress, block, self.level, mtime=0))
+        # Keep a bounded number of blocks in memory:
+        self._writeFinished(2 * self.threads)
+
+    def _writeFinished(self, maxPending: int) -> None:
+        """Write out compressed blocks in order, until at most maxPending are still waiting."""
+        while len(self._pending) > maxPending:
+            self._file.write(self._pending.pop(0).result())
+
+
+def readCompressed(path: str) -> bytes:
+    """Decompressed contents of a file written by CompressedWriter, or any gzip file."""
+    with open(path, 'rb') as infile:
+        data = infile.read()
+    codec = detectCodec(data[:4])
+    if codec == GZIP:
+        return gzip.decompress(data)
+    if codec == ZSTD:
+        if zstandard is None:
+            raise ValueError("%s is zstd compressed, install the 'zstandard' package to load it" % path)
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    if lz4frame is None:
+        raise ValueError("%s is lz4 compressed, install the 'lz4' package to load it" % path)
+    return lz4frame.decompress(data)
@@ -1,38 +1,17 @@
 import attr
 import json
-import gzip
 import numpy as np
 
-from pydynamo_brain.util import SAVE_KEY
+from typing import Any, Dict, List
+
+from pydynamo_brain.util import SAVE_KEY, SAVE_UNLESS_DEFAULT_KEY
 from pydynamo_brain.model import *
 
+from .compression import CompressedWriter, readCompressed
+
 def attrFilter(attrData, value):
     return (SAVE_KEY in attrData.metadata) and attrData.metadata[SAVE_KEY]
 
-# WORKAROUND: attr.asdict does not support lists of lists
-#   see https://github.com/python-attrs/attrs/issues/469
-# until that is fixed, manually work around this:
-def _hackUpdateChildDicts(v):
-    result, changed = v, False
-    if isinstance(v, list):
-        result = []
-        for childI, childV in enumerate(v):
-            newV, childChanged = _hackUpdateChildDicts(childV)
-            result.append(newV)
-            changed = changed or childChanged
-    elif isinstance(v, Point):
-        # We have a list of list of Points:
-        result, _ = _hackUpdateChildDicts(attr.asdict(v, filter=attrFilter))
-        changed = True
-    elif isinstance(v, dict):
-        result = {}
-        for childK, childV in v.items():
-            newV, childChanged = _hackUpdateChildDicts(childV)
-            result[childK] = newV
-            changed = changed or childChanged
-    return result, changed
-
-
 # https://stackoverflow.com/questions/11942364/typeerror-integer-is-not-json-serializable-when-serializing-json-in-python
 def typeFix(o):
     if isinstance(o, np.int64):
@@ -44,15 +23,123 @@ def typeFix(o):
     print ("ERROR - Can't save type: ", type(o))
     raise TypeError
 
+# Saved field names for each attrs class, sorted to keep the output stable.
+_savedFieldsCache: Dict[type, List[str]] = {}
+
+# Default values of saved fields that are left out when they hold them, for each attrs class.
+_skippedDefaultsCache: Dict[type, Dict[str, Any]] = {}
+
+# Chunks are passed on to the output once they add up to this many characters:
+_FLUSH_CHARS = 64 * 1024
+
+def _savedFields(cls):
+    if cls not in _savedFieldsCache:
+        _savedFieldsCache[cls] = sorted(
+            field.name for field in attr.fields(cls) if attrFilter(field, None)
+        )
+    return _savedFieldsCache[cls]
+
+def _skippedDefaults(cls):
+    if cls not in _skippedDefaultsCache:
+        _skippedDefaultsCache[cls] = {
+            field.name: field.default for field in attr.fields(cls)
+            if attrFilter(field, None) and field.metadata.get(SAVE_UNLESS_DEFAULT_KEY, False)
+        }
+    return _skippedDefaultsCache[cls]
+
+def _fieldsToWrite(value):
+    skipped = _skippedDefaults(type(value))
+    names = _savedFields(type(value))
+    if len(skipped) == 0:
+        return names
+    return [name for name in names if name not in skipped or getattr(value, name) != skipped[name]]
+
+def _pointToDict(point):
+    return {name: getattr(point, name) for name in _savedFields(Point)}
+
+def _jsonDefault(o):
+    if isinstance(o, Point):
+        return _pointToDict(o)
+    return typeFix(o)
+
+class _JSONStreamWriter():
+    """Writes saved fields as compact JSON in one pass over the state, without an intermediate dict.
+
+    Output matches json.dumps(attr.asdict(...), sort_keys=True) apart from whitespace, and
+    fields saved with SAVE_UNLESS_DEFAULT_META being left out while they hold their default.
+    Lists of points (e.g. a branch) are encoded together, everything above them is walked here,
+    and text is passed to the output in chunks as it is produced."""
+
+    def __init__(self, output):
+        self.output = output
+        self.chunks = []
+        self.chunkChars = 0
+        self.encode = json.JSONEncoder(
+            separators=(',', ':'), sort_keys=True, default=_jsonDefault
+        ).encode
+
+    def write(self, text):
+        self.chunks.append(text)
+        self.chunkChars += len(text)
+        if self.chunkChars >= _FLUSH_CHARS:
+            self.flush()
+
+    def flush(self):
+        if len(self.chunks) > 0:
+            self.output(''.join(self.chunks))
+            self.chunks, self.chunkChars = [], 0
+
+    def writeValue(self, value):
+        if isinstance(value, Point):
+            self.write(self.encode(value))
+        elif attr.has(type(value)):
+            self.write('{')
+            for i, name in enumerate(_fieldsToWrite(value)):
+                self.write((',"%s":' if i > 0 else '"%s":') % name)
+                self.writeValue(getattr(value, name))
+            self.write('}')
+        elif isinstance(value, (list, tuple)):
+            if all(isinstance(child, Point) for child in value):
+                self.write(self.encode(value))
+                return
+            self.write('[')
+            for i, child in enumerate(value):
+                if i > 0:
+                    self.write(',')
+                self.writeValue(child)
+            self.write(']')
+        elif isinstance(value, dict):
+            self.write('{')
+            for i, key in enumerate(sorted(value.keys())):
+                self.write((',%s:' if i > 0 else '%s:') % self.encode(key))
+                self.writeValue(value[key])
+            self.write('}')
+        else:
+            self.write(self.encode(value))
+
+def writeFullState(fullState, output):
+    """Stream the saved parts of the state as JSON text, calling output() with each chunk."""
+    writer = _JSONStreamWriter(output)
+    writer.writeValue(fullState)
+    writer.flush()
+
 def fullStateToString(fullState):
-    asDict, changed = attr.asdict(fullState, filter=attrFilter), True
-    while changed:
-        asDict, changed = _hackUpdateChildDicts(asDict)
-    return json.dumps(asDict, indent=2, sort_keys=True, default=typeFix).encode('utf-8')
+    chunks = []
+    writeFullState(fullState, chunks.append)
+    return ''.join(chunks).encode('utf-8')
 
 def saveState(fullState, path):
-    with gzip.GzipFile(path, 'w') as outfile:
-        outfile.write(fullStateToString(fullState))
+    # Imported here, as the binary format reuses the conversions in this file.
+    from .columnar import isBinaryPath, saveStateBinary
+    if isBinaryPath(path):
+        saveStateBinary(fullState, path)
+    else:
+        options = fullState.projectOptions
+        with CompressedWriter(path, options.compression, options.compressionLevel) as outfile:
+            writeFullState(fullState, lambda text: outfile.write(text.encode('utf-8')))
+    # Copies elsewhere (e.g. autosaves) don't count as saving the project:
+    if path == fullState._rootPath:
+        fullState.markSaved()
 
 ### HACK - use cattrs?
 def convert(asDict, key, conversion, isArray=False):
@@ -137,8 +224,12 @@ def indexTree(tree):
 def findNextPointID(fullState):
     nextID = 0
     for tree in fullState.trees:
-        for point in tree.flattenPoints():
-            nextID = max(nextID, 1 + int(point.id, 16))
+        # All points on branches, connected or not, so new IDs can't clash with any of them.
+        if tree.rootPoint is not None:
+            nextID = max(nextID, 1 + int(tree.rootPoint.id, 16))
+        for branch in tree.branches:
+            if len(branch.points) > 0:
+                nextID = max(nextID, 1 + max(int(point.id, 16) for point in branch.points))
     for puncta in fullState.puncta:
         for point in puncta:
             nextID = max(nextID, 1 + int(point.id, 16))
@@ -151,31 +242,35 @@ def findNextBranchID(fullState):
             nextID = max(nextID, 1 + int(branch.id, 16))
     return nextID
 
-def indexFullState(fullState, path):
-    for tree in fullState.trees:
-        indexTree(tree)
+def indexFullState(fullState, path, nextIDs=None, indexTrees=True):
+    if indexTrees:
+        for tree in fullState.trees:
+            indexTree(tree)
     for i, state in enumerate(fullState.uiStates):
         state._parent = fullState
         state._tree = fullState.trees[i]
         state._tree._parentState = state
         state.imagePath = fullState.filePaths[i]
-    fullState._nextPointID = findNextPointID(fullState)
-    fullState._nextBranchID = findNextBranchID(fullState)
+    if nextIDs is None:
+        nextIDs = (findNextPointID(fullState), findNextBranchID(fullState))
+    fullState._nextPointID, fullState._nextBranchID = nextIDs
     fullState._rootPath = path
+    fullState.markSaved()
     return fullState
 
 def stringToFullState(text, path):
     return indexFullState(convertToFullState(json.loads(text)), path)
 
-def loadState(path):
-    fileText = ""
-    with gzip.GzipFile(path, 'r') as infile:
-        fileText = infile.read().decode('utf-8')
+def loadState(path, lazy=False):
+    """Load a project. For .dynb files, lazy only loads each stack's tree when first used."""
+    from .columnar import isBinaryPath, loadStateBinary
+    if isBinaryPath(path):
+        return loadStateBinary(path, lazy=lazy)
+    fileText = readCompressed(path).decode('utf-8')
     return stringToFullState(fileText, path)
 
 def checkIfChanged(fullState, path):
-    if path is None:
+    """Whether the state has unsaved changes. Only edits are tracked, so this never reads the file."""
+    if path is None or path != fullState._rootPath:
         return True
-    oldString = fullStateToString(loadState(path))
-    newString = fullStateToString(fullState)
-    return oldString != newString
+    return fullState.hasUnsavedChanges()
@@ -0,0 +1,182 @@
+"""
+Write-ahead journal of edits made since a project was last saved.
+
+The journal sits next to the project file, and starts with a fingerprint of that file.
+Each edit is appended as a compressed patch from the previous recorded state, so after a
+crash the project file plus the journal gives back the last state. Saving the project
+starts a fresh journal, and the journal is rewritten as a single patch once it gets large.
+"""
+import os
+import pickle
+import struct
+import zlib
+
+from typing import BinaryIO, List, Optional, Tuple
+
+from pydynamo_brain.model import FullState
+from pydynamo_brain.model.stateDiff import StatePatch, StateSnapshot, applyPatch, diffStates, recordState
+
+from .files import findNextBranchID, findNextPointID
+
+JOURNAL_EXTENSION = '.journal'
+
+_MAGIC = b'DYNJRNL1'
+
+# Size and modification time of the project file the journal applies to.
+_HEADER = struct.Struct('<qq')
+
+# Length and CRC32 of each compressed record.
+_RECORD_HEADER = struct.Struct('<II')
+
+# Rewrite the journal as one patch from the project file once it gets this big.
+_COMPACT_BYTES = 4 * 1024 * 1024
+
+def journalPathFor(projectPath: str) -> str:
+    return projectPath + JOURNAL_EXTENSION
+
+def hasJournal(projectPath: str) -> bool:
+    """Whether there are journaled edits that were never saved into the project file."""
+    path = journalPathFor(projectPath)
+    return os.path.isfile(path) and os.path.getsize(path) > len(_MAGIC) + _HEADER.size
+
+def _fingerprint(projectPath: str) -> Tuple[int, int]:
+    stat = os.stat(projectPath)
+    return (stat.st_size, stat.st_mtime_ns)
+
+def _isEmptyPatch(patch: StatePatch, previous: StateSnapshot) -> bool:
+    return len(patch.values) == 0 and len(patch.trees) == 0 and \
+        len(patch.uiStates) == 0 and len(patch.puncta) == 0 and \
+        patch.stackCount == len(previous.trees) and \
+        patch.uiStateCount == len(previous.uiStates) and \
+        patch.punctaCount == len(previous.puncta)
+
+def _encodeRecord(patch: StatePatch) -> bytes:
+    data = zlib.compress(pickle.dumps(patch, protocol=pickle.HIGHEST_PROTOCOL))
+    return _RECORD_HEADER.pack(len(data), zlib.crc32(data)) + data
+
+def _readRecords(infile: BinaryIO) -> List[StatePatch]:
+    """All complete records, stopping at the first torn or corrupt one (e.g. from a crash mid-write)."""
+    patches = []
+    while True:
+        header = infile.read(_RECORD_HEADER.size)
+        if len(header) < _RECORD_HEADER.size:
+            break
+        length, crc = _RECORD_HEADER.unpack(header)
+        data = infile.read(length)
+        if len(data) < length or zlib.crc32(data) != crc:
+            print ("WARNING: Ignoring incomplete journal record")
+            break
+        patches.append(pickle.loads(zlib.decompress(data)))
+    return patches
+
+
+class Journal():
+    """Append-only log of edits to a project, used to recover them after a crash."""
+
+    projectPath: str
+    """Project file the journaled edits apply on top of."""
+
+    _file: Optional[BinaryIO]
+    """Journal file, open for appending."""
+
+    _baseSnapshot: Optional[StateSnapshot]
+    """Record of the state as saved in the project file, for compacting."""
+
+    _lastSnapshot: Optional[StateSnapshot]
+    """Record of the state as of the most recent journal entry."""
+
+    _lastGeneration: int
+    """Edit generation of the state when last recorded, to skip recording when nothing changed."""
+
+    def __init__(self, projectPath: str) -> None:
+        self.projectPath = projectPath
+        self._file = None
+        self._baseSnapshot = None
+        self._lastSnapshot = None
+        self._lastGeneration = -1
+
+    @property
+    def path(self) -> str:
+        return journalPathFor(self.projectPath)
+
+    def start(self, fullState: FullState) -> None:
+        """Begin a new, empty journal. The state must match what is saved in the project file."""
+        self.close()
+        self._baseSnapshot = recordState(fullState)
+        self._lastSnapshot = self._baseSnapshot
+        self._lastGeneration = fullState._editGeneration
+        self._writeFile([])
+
+    def replay(self, fullState: FullState) -> int:
+        """Apply journaled edits to the state loaded from the project file, and keep journaling after them.
+
+        Returns the number of edits recovered, or zero if the journal doesn't match the project file."""
+        self.close()
+        patches: List[StatePatch] = []
+        try:
+            with open(self.path, 'rb') as infile:
+                header = infile.read(len(_MAGIC) + _HEADER.size)
+                if header[:len(_MAGIC)] == _MAGIC and \
+                        _HEADER.unpack(header[len(_MAGIC):]) == _fingerprint(self.projectPath):
+                    patches = _readRecords(infile)
+                else:
+                    print ("WARNING: Journal is for a different version of %s, ignoring" % self.projectPath)
+        except (OSError, struct.error) as e:
+            print ("WARNING: Can't read journal: %s" % e)
+
+        self._baseSnapshot = recordState(fullState)
+        for patch in patches:
+            applyPatch(fullState, patch)
+        if len(patches) > 0:
+            fullState._nextPointID = max(fullState._nextPointID, findNextPointID(fullState))
+            fullState._nextBranchID = max(fullState._nextBranchID, findNextBranchID(fullState))
+            fullState.markEdited()
+
+        # Keep the recovered edits, as one patch from the project file:
+        self._lastSnapshot = recordState(fullState)
+        self._lastGeneration = fullState._editGeneration
+        recovered = diffStates(self._baseSnapshot, self._lastSnapshot)
+        self._writeFile([] if len(patches) == 0 else [recovered])
+        return len(patches)
+
+    def record(self, fullState: FullState) -> bool:
+        """Append any edits since the last record. Returns whether anything was written."""
+        if self._file is None or fullState._editGeneration == self._lastGeneration:
+            return False
+        # Both are set by start() / replay(), which open the file:
+        assert self._baseSnapshot is not None and self._lastSnapshot is not None
+        snapshot = recordState(fullState, self._lastSnapshot)
+        patch = diffStates(self._lastSnapshot, snapshot)
+        self._lastGeneration = fullState._editGeneration
+        if _isEmptyPatch(patch, self._lastSnapshot):
+            return False
+        self._lastSnapshot = snapshot
+
+        self._file.write(_encodeRecord(patch))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        if self._file.tell() > _COMPACT_BYTES:
+            self._writeFile([diffStates(self._baseSnapshot, self._lastSnapshot)])
+        return True
+
+    def close(self, delete: bool=False) -> None:
+        """Stop journaling. Deleting is for when the edits are saved or deliberately thrown away."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if delete and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _writeFile(self, patches: List[StatePatch]) -> None:
+        """Replace the journal with just these records, then keep it open for appending."""
+        if self._file is not None:
+            self._file.close()
+        tmpPath = self.path + '.partial'
+        with open(tmpPath, 'wb') as outfile:
+            outfile.write(_MAGIC + _HEADER.pack(*_fingerprint(self.projectPath)))
+            for patch in patches:
+                outfile.write(_encodeRecord(patch))
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(tmpPath, self.path)
+        self._file = open(self.path, 'ab')
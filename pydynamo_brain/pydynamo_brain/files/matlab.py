@@ -1,7 +1,8 @@
 import numpy as np
 import scipy.io as sio
 
-from scipy.spatial.distance import euclidean
+from scipy.optimize import linear_sum_assignment
+from scipy.spatial import cKDTree
 
 from pydynamo_brain.model import *
 from pydynamo_brain.util import deltaSz
@@ -91,7 +92,19 @@ def parseMatlabTree(fullState, saveState, removeOrphanBranches=True):
     tree.transform = parseTransform(saveState['info'][0])
     return tree
 
-def alignPointID(fullState):
+# Points further apart than this on any axis (in pixels, after shifting by the soma) never match.
+MATCH_TOLERANCE = 25
+
+# Matlab files don't keep point IDs, so give points that look like the same one across
+# consecutive stacks the same ID. Both stacks are matched in one pass each way using KD-trees:
+#   - The soma keeps its ID throughout.
+#   - Branches with the same ID and number of points match point by point.
+#   - Otherwise points on the same branch match to the closest one within MATCH_TOLERANCE.
+#     By default the closest pairs are taken first, with each point used at most once.
+#     With bipartite=True, the pairing with the smallest total distance is used instead.
+#   - Anything still unmatched takes the ID of the closest point on the same branch in the
+#     other stack, if that point is unmatched too.
+def alignPointID(fullState, bipartite=False):
     treeList = fullState.trees
     if len(treeList) <= 1:
         return fullState
@@ -99,57 +112,100 @@ def alignPointID(fullState):
         fullState.setPointIDWithoutCollision(treeList[i+1], treeList[i+1].rootPoint, treeList[i].rootPoint.id)
 
     for i in range(len(treeList)-1):
-        treeShift = np.array(treeList[i+1].rootPoint.location) - np.array(treeList[i].rootPoint.location)
-        
-        
-        _branchesT0 = [branch.id for branch in treeList[i].branches]
-        _branchesT1 = [branch.id for branch in treeList[i+1].branches]
-        for _branch in _branchesT0:
-            if treeList[i+1].getBranchByID(_branch) is not None:
-                if len(treeList[i+1].getBranchByID(_branch).points) == len(treeList[i].getBranchByID(_branch).points):
-                    for pairPoints in zip(treeList[i+1].getBranchByID(_branch).points, treeList[i].getBranchByID(_branch).points): 
-                        fullState.setPointIDWithoutCollision(treeList[i+1], pairPoints[0], pairPoints[1].id)    
-                else:
-                    _matchedPoint = None
-                    for _pointT0 in treeList[i].getBranchByID(_branch).points:
-                        for _pointT1 in treeList[i+1].getBranchByID(_branch).points:
-                            #if treeList[i].getPointByID(_pointT1) is None:
-                                #print(np.allclose(np.array(_pointT1.location), (np.array(_pointT0.location) + treeShift), atol=15))
-                                #print(_pointT0.location, _pointT1.location)
-                            if np.allclose(np.array(_pointT1.location), (np.array(_pointT0.location) + treeShift), atol=25):
-                                if _matchedPoint is None:
-                                    fullState.setPointIDWithoutCollision(treeList[i+1], _pointT1, _pointT0.id)
-                                    _matchedPoint = _pointT0
-                                else:
-                                    if euclidean(np.array(_pointT1.location), (np.array(_pointT0.location) + treeShift)) <=  euclidean(np.array(_pointT1.location), (np.array(_matchedPoint.location) + treeShift)):
-                                        fullState.setPointIDWithoutCollision(treeList[i+1], _pointT1, _pointT0.id)
-                                        _matchedPoint = _pointT0    
-        
-        
-        for _pointT1 in treeList[i+1].flattenPoints():
-            if treeList[i].getPointByID(_pointT1.id) is None:
-                _tempPoint = treeList[i].closestPointTo(np.array(_pointT1.location)-treeShift)
-                if treeList[i+1].getPointByID(_tempPoint.id) is None:
-                    print(np.array(_pointT1.location), (np.array(_tempPoint.location) + treeShift))
-                    if _pointT1.parentBranch.id == _tempPoint.parentBranch.id:
-                        fullState.setPointIDWithoutCollision(treeList[i+1], _pointT1, _tempPoint.id)
-
-        for _pointT0 in treeList[i].flattenPoints():
-            if treeList[i+1].getPointByID(_pointT0.id) is None:
-                _tempPoint = treeList[i+1].closestPointTo(np.array(_pointT0.location)+treeShift)
-                if treeList[i].getPointByID(_tempPoint.id) is None:
-                    if _pointT0.parentBranch.id == _tempPoint.parentBranch.id:
-                        print(np.array(_pointT1.location), (np.array(_tempPoint.location) + treeShift))
-                        fullState.setPointIDWithoutCollision(treeList[i+1], _pointT1, _tempPoint.id)
-                        
-                            
-                                    
+        _alignTreePair(fullState, treeList[i], treeList[i+1], bipartite)
     return fullState
 
+# Copy IDs from tree t0 on to the matching points of the following tree t1.
+def _alignTreePair(fullState, t0, t1, bipartite):
+    treeShift = np.array(t1.rootPoint.location) - np.array(t0.rootPoint.location)
+    points0, points1 = t0.flattenPoints(), t1.flattenPoints()
+
+    # ID -> point for both trees. Only t1 changes, so its index is kept up to date here.
+    byID0, byID1 = {}, {}
+    for points, byID in [(points0, byID0), (points1, byID1)]:
+        for point in points:
+            byID.setdefault(point.id, point)
+
+    def _setID(point, newID):
+        # Same as fullState.setPointIDWithoutCollision, using the local index.
+        if point.id == newID:
+            return
+        existingWithID = byID1.get(newID)
+        if existingWithID is not None and existingWithID is not point:
+            existingWithID.id = fullState.nextPointID()
+            byID1[existingWithID.id] = existingWithID
+        if byID1.get(point.id) is point:
+            del byID1[point.id]
+        point.id = newID
+        byID1[newID] = point
+
+    for branch0 in t0.branches:
+        branch1 = t1.getBranchByID(branch0.id)
+        if branch1 is None or len(branch0.points) == 0 or len(branch1.points) == 0:
+            continue
+        if len(branch1.points) == len(branch0.points):
+            for point1, point0 in zip(branch1.points, branch0.points):
+                _setID(point1, point0.id)
+        else:
+            for row1, row0 in _matchBranchPoints(branch0, branch1, treeShift, bipartite):
+                _setID(branch1.points[row1], branch0.points[row0].id)
+
+    # Then closest points for those still unmatched, each way:
+    locations0, locations1 = _locationArray(points0), _locationArray(points1)
+    _, closestTo1 = cKDTree(locations0).query(locations1 - treeShift)
+    _, closestTo0 = cKDTree(locations1).query(locations0 + treeShift)
+
+    for point1, row0 in zip(points1, closestTo1.tolist()):
+        if point1.id not in byID0:
+            closest0 = points0[row0]
+            if closest0.id not in byID1 and _sameBranch(point1, closest0):
+                _setID(point1, closest0.id)
+
+    for point0, row1 in zip(points0, closestTo0.tolist()):
+        if point0.id not in byID1:
+            closest1 = points1[row1]
+            if closest1.id not in byID0 and _sameBranch(point0, closest1):
+                _setID(closest1, point0.id)
+
+# (row in branch1, row in branch0) of points that match, in branch1 order.
+def _matchBranchPoints(branch0, branch1, treeShift, bipartite):
+    locations0 = _locationArray(branch0.points) + treeShift
+    locations1 = _locationArray(branch1.points)
+    # Candidates are within the tolerance on every axis, then closer is better.
+    candidates = cKDTree(locations0).query_ball_point(locations1, r=MATCH_TOLERANCE, p=np.inf)
+    rows1 = np.repeat(np.arange(len(locations1)), [len(rows0) for rows0 in candidates])
+    rows0 = np.array([row0 for rows0 in candidates for row0 in rows0], dtype=np.int64)
+    if len(rows0) == 0:
+        return []
+    dists = np.linalg.norm(locations1[rows1] - locations0[rows0], axis=1)
+
+    if bipartite:
+        unmatchedCost = 1 + dists.max() * len(locations1)
+        costs = np.full((len(locations1), len(locations0)), unmatchedCost)
+        costs[rows1, rows0] = dists
+        matched1, matched0 = linear_sum_assignment(costs)
+        keep = costs[matched1, matched0] < unmatchedCost
+        return list(zip(matched1[keep].tolist(), matched0[keep].tolist()))
+
+    # Greedy: closest pairs first, each point used at most once. Ties go in branch order.
+    order = np.lexsort((rows0, rows1, dists))
+    matchFor1, matched0 = {}, set()
+    for row1, row0 in zip(rows1[order].tolist(), rows0[order].tolist()):
+        if row1 not in matchFor1 and row0 not in matched0:
+            matchFor1[row1] = row0
+            matched0.add(row0)
+    return sorted(matchFor1.items())
+
+def _locationArray(points):
+    return np.array([point.location for point in points], dtype=np.float64).reshape((-1, 3))
+
+def _sameBranch(pointA, pointB):
+    branchA, branchB = pointA.parentBranch, pointB.parentBranch
+    return branchA is not None and branchB is not None and branchA.id == branchB.id
 
 
 # Load an existing dynamo matlab file, and convert it into the python dynamo format.
-def importFromMatlab(matlabPath, removeOrphanBranches=True):
+def importFromMatlab(matlabPath, removeOrphanBranches=True, bipartite=False):
     fullState = FullState()
     filePaths, treeData = [], []
 
@@ -175,5 +231,5 @@ def importFromMatlab(matlabPath, removeOrphanBranches=True):
         treeData.append(tree)
        
     fullState.addFiles(filePaths, treeData)
-    fullState = alignPointID(fullState)
+    fullState = alignPointID(fullState, bipartite)
     return fullState
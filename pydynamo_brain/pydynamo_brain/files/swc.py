@@ -1,88 +1,206 @@
+import attr
 from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import glob
+import io
+import numpy as np
 import os
+import re
+
+from typing import List, Tuple
 
 from pydynamo_brain.model import *
 
+# Column order of each node line, and how they're written out.
+SWC_COLUMNS_LINE = "##n,type,x,y,z,radius,parent\n"
+SWC_NODE_FORMAT = "%d %d %.4f %.4f %.4f %.5f %d\n"
+
 ###
 ### IMPORT
 ###
 
 # SWC file -> Tree
 def importFromSWC(path):
-    childMap, metadata, comments = {}, {}, []
+    return _treeFromTable(_readSWCTable(path))
+
+# Import many SWC files (e.g. one per timepoint) as the stacks of a new project, in order.
+# Files are parsed in parallel by a pool of worker processes; workers=1 parses them here instead.
+# stackPaths are the image for each SWC, by default the same path ending in .tif
+# Points and branches get new project IDs, same as importing each through the UI.
+def importSWCFiles(swcPaths, stackPaths=None, workers=None):
+    if stackPaths is None:
+        stackPaths = [os.path.splitext(path)[0] + '.tif' for path in swcPaths]
+    assert len(stackPaths) == len(swcPaths), "Need one stack for each SWC file"
+
+    if workers == 1 or len(swcPaths) <= 1:
+        tables = [_readSWCTable(path) for path in swcPaths]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            tables = list(pool.map(_readSWCTable, swcPaths))
+
+    fullState = FullState()
+    for swcPath, stackPath, table in zip(swcPaths, stackPaths, tables):
+        tree = Tree()
+        if table is None:
+            # Keep an empty stack, so later timepoints stay in the right place.
+            print ("WARNING: Couldn't import %s, leaving its stack empty" % swcPath)
+        else:
+            tree = _treeFromTable(table, idMaker=fullState)
+        fullState.addFiles([stackPath], [tree])
+    return fullState
+
+# SWC files to import: everything in a directory, or matching a glob pattern.
+# Sorted with numbers in order, so e.g. scan2.swc is before scan10.swc
+def findSWCFiles(pathOrPattern):
+    if os.path.isdir(pathOrPattern):
+        pathOrPattern = os.path.join(pathOrPattern, '*.swc')
+    return sorted(glob.glob(pathOrPattern), key=_naturalSortKey)
+
+def _naturalSortKey(path):
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', path)]
+
+# Points and branches of a parsed SWC file, everything needed to make its tree.
+# Only numbers, so it can be quickly passed back from worker processes.
+@attr.s(frozen=True)
+class _SWCTable():
+    nodeIDs: np.ndarray = attr.ib()
+    """SWC ID of each node."""
 
-    swcLines = [line.rstrip('\n') for line in open(path)]
-    for line in swcLines:
-        # Process metdata values into map:
-        metaKey, metaValue = _parseMeta(line)
-        if metaKey is not None:
-            metadata[metaKey] = metaValue
+    locations: np.ndarray = attr.ib()
+    """(N, 3) x/y/z of each node."""
 
-        # Collect comments, just in case it's useful for later:
-        if line[0] == '#':
+    radii: np.ndarray = attr.ib()
+    """Radius of each node."""
+
+    somaRow: int = attr.ib()
+    """Row of the root node."""
+
+    branchRuns: List[Tuple[int, List[int]]] = attr.ib()
+    """(parent row, rows of points) for each branch, in the order they should be added."""
+
+# SWC file -> _SWCTable, or None if it can't be converted.
+def _readSWCTable(path):
+    metadata, comments, nodeLines = {}, [], []
+
+    with open(path) as swcFile:
+        for line in swcFile:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            if line[0] != '#':
+                nodeLines.append(line)
+                continue
+
+            # Process metdata values into map:
+            metaKey, metaValue = _parseMeta(line)
+            if metaKey is not None:
+                metadata[metaKey] = metaValue
+
+            # Collect comments, just in case it's useful for later:
             comments.append(line)
-            continue
-
-        # And otherwise, build the tree:
-        # n,type,x,y,z,radius,parent
-        parts = line.split(' ')
-        if len(parts) != 7:
-            print ("Unsupported SWC file format. All node lines must be n,type,x,y,z,radius,parent")
-            return None
-        nodeID, nodeType, x, y, z, radius, parent = tuple(parts)
-        x, y, z, radius = float(x), float(y), float(z), float(radius) # TODO: Scale?
-        if parent not in childMap:
-            childMap[parent] = []
-        childMap[parent].append((nodeID, (x, y, z), radius)) # TODO: Use nodeType later?
-
-    return _convertChildMapToTree(childMap)
-
-# Given mapping of parent -> list of (child ID, child XYZ), convert this to a tree model
-def _convertChildMapToTree(childMap):
-    if '-1' not in childMap or len(childMap['-1']) != 1:
+
+    # And otherwise, build the tree, parsing all nodes at once:
+    # n,type,x,y,z,radius,parent, separated by any whitespace.
+    nodes = np.zeros((0, 7))
+    try:
+        if len(nodeLines) > 0:
+            nodes = np.loadtxt(nodeLines, dtype=np.float64, ndmin=2)
+    except ValueError:
+        nodes = None
+    if nodes is None or nodes.shape[1] != 7:
+        print ("Unsupported SWC file format. All node lines must be n,type,x,y,z,radius,parent")
+        return None
+
+    # TODO: Use nodeType later? Scale?
+    return _nodesToTable(
+        nodes[:, 0].astype(np.int64), nodes[:, 2:5], nodes[:, 5], nodes[:, 6].astype(np.int64)
+    )
+
+# Given each node's ID, XYZ, radius and parent ID, work out the branches of its tree
+def _nodesToTable(nodeIDs, locations, radii, parentIDs):
+    somaRows = np.flatnonzero(parentIDs == -1)
+    if len(somaRows) != 1:
         print ("Can't parse SWC file: Has more than one Soma (parent -1)")
         return None
-    somaID, somaLocation, somaRadius = childMap['-1'][0]
+    somaRow = int(somaRows[0])
+    nNodes = len(nodeIDs)
 
-    tree = Tree()
-    tree.rootPoint = Point(somaID, somaLocation, somaRadius)
+    # Row of each node's parent, or -1 for the soma and parents that aren't in the file.
+    sortedRows = np.argsort(nodeIDs, kind='stable')
+    at = np.minimum(np.searchsorted(nodeIDs[sortedRows], parentIDs), max(nNodes - 1, 0))
+    parentRows = np.where(nodeIDs[sortedRows[at]] == parentIDs, sortedRows[at], -1)
+
+    # Children of each row in file order, as runs of childRows ending at childEnds[row]
+    hasParent = parentRows >= 0
+    childRows = np.flatnonzero(hasParent)[np.argsort(parentRows[hasParent], kind='stable')].tolist()
+    childCounts = np.bincount(parentRows[hasParent], minlength=nNodes)
+    childEnds = np.cumsum(childCounts)
+    nextChild = (childEnds - childCounts).tolist() # Next unused child of each row
+    childEnds = childEnds.tolist()
 
     # Keep track of where branches have come off that still need processing
     toProcess = deque()
-    toProcess.append(somaID)
+    toProcess.append(somaRow)
 
-    branchCounter = 0
+    branchRuns, nAdded = [], 1
     while len(toProcess) > 0:
-        nextParentID = toProcess.popleft()
-        nLeft = sum([len(childMap[k]) for k in childMap])
-        print ("%d remain, Processing %s " % (nLeft, nextParentID))
-        if nextParentID not in childMap or len(childMap[nextParentID]) == 0:
-            continue
-        parentPoint = tree.getPointByID(nextParentID)
-        assert parentPoint is not None
-
-        # Start this branch, but remember parent if it has more coming off...
-        branchPointID, branchPointLocation, branchPointRadius = childMap[nextParentID][0]
-        childMap[nextParentID].pop(0)
-        if len(childMap[nextParentID]) > 0:
-            toProcess.append(nextParentID)
-
-        newBranch = Branch('%04x' % branchCounter)
-        newBranch.setParentPoint(parentPoint)
-        branchCounter += 1
-
-        while True:
-            # Walk along the branch, adding points as we go
-            newBranch.addPoint(Point(branchPointID, branchPointLocation, branchPointRadius))
-            oldBranchPointID = branchPointID
-            if branchPointID not in childMap or len(childMap[branchPointID]) == 0:
-                break
-            # Remember any intermediate points that have more children coming off them
-            branchPointID, branchPointLocation, branchPointRadius = childMap[oldBranchPointID][0]
-            childMap[oldBranchPointID].pop(0)
-            if len(childMap[oldBranchPointID]) > 0:
-                toProcess.append(oldBranchPointID)
-        tree.addBranch(newBranch)
+        parentRow = toProcess.popleft()
+        branchRows = []
+        pointRow = parentRow
+        # Walk along the first unused child each time, adding points as we go
+        while nextChild[pointRow] < childEnds[pointRow]:
+            childRow = childRows[nextChild[pointRow]]
+            nextChild[pointRow] += 1
+            # Remember any points that have more children coming off them
+            if nextChild[pointRow] < childEnds[pointRow]:
+                toProcess.append(pointRow)
+            branchRows.append(childRow)
+            pointRow = childRow
+        if len(branchRows) > 0:
+            branchRuns.append((parentRow, branchRows))
+            nAdded += len(branchRows)
+
+    if nAdded < nNodes:
+        print ("WARNING: Skipping %d SWC nodes not connected to the soma" % (nNodes - nAdded))
+    return _SWCTable(nodeIDs, locations, radii, somaRow, branchRuns)
+
+# _SWCTable -> Tree. IDs come from idMaker if given, otherwise they're the SWC node and branch numbers.
+def _treeFromTable(table, idMaker=None):
+    if table is None:
+        return None
+    if idMaker is None:
+        pointIDs = ['%d' % nodeID for nodeID in table.nodeIDs.tolist()]
+        branchIDs = ['%04x' % i for i in range(len(table.branchRuns))]
+    else:
+        # Same order as cloning the tree: root, then each branch's points.
+        pointIDs = [None] * len(table.nodeIDs)
+        pointIDs[table.somaRow] = idMaker.nextPointID()
+        for _, rows in table.branchRuns:
+            for row in rows:
+                pointIDs[row] = idMaker.nextPointID()
+        branchIDs = [idMaker.nextBranchID() for _ in table.branchRuns]
+
+    locations, radii = table.locations.tolist(), table.radii.tolist()
+    newPoint, setField = Point.fromSaved, object.__setattr__
+    points = [None] * len(pointIDs)
+    somaRow = table.somaRow
+    points[somaRow] = newPoint(pointIDs[somaRow], tuple(locations[somaRow]), radii[somaRow])
+
+    branches = []
+    for branchID, (parentRow, rows) in zip(branchIDs, table.branchRuns):
+        branchPoints = [newPoint(pointIDs[row], tuple(locations[row]), radii[row]) for row in rows]
+        for row, point in zip(rows, branchPoints):
+            points[row] = point
+        branch = Branch(id=branchID, parentPoint=points[parentRow], points=branchPoints)
+        points[parentRow].children.append(branch)
+        # Points aren't in a tree yet, so skip the change hooks like Point.fromSaved does.
+        for point in branchPoints:
+            setField(point, 'parentBranch', branch)
+        branches.append(branch)
+
+    tree = Tree(rootPoint=points[somaRow], branches=branches)
+    for branch in branches:
+        branch._parentTree = tree
     # Done!
     return tree
 
@@ -105,6 +223,36 @@ def exportToSWC(dirPath, filePath, tree, fullState, forNeuroM=False):
         _exportHeader(file, tree, filePath, fullState)
         _exportNodes(file, tree, forNeuroM)
 
+# SWC file name to export a stack's tree to, e.g. 'scan1.tif' -> 'scan1.swc'
+def swcNameForStack(stackPath):
+    name = os.path.basename(stackPath)
+    name = name.replace(".tif", "").replace(".tiff", "").replace(".mat", "")
+    return name + ".swc"
+
+# Write every stack's tree to its own SWC file in dirPath, several files at once.
+# Returns the paths written, in stack order.
+def exportAllToSWC(dirPath, fullState, forNeuroM=False, threads=None):
+    # Build everything from the model here, as e.g. loading lazy trees isn't thread safe,
+    # then only the formatting and writing is shared out.
+    jobs = []
+    for stackPath, tree in zip(fullState.filePaths, fullState.trees):
+        filePath = swcNameForStack(stackPath)
+        header = io.StringIO()
+        _exportHeader(header, tree, filePath, fullState)
+        jobs.append((os.path.join(dirPath, filePath), header.getvalue(), _buildNodeTable(tree, forNeuroM)))
+
+    def _write(job):
+        totalPath, header, nodeTable = job
+        with open(totalPath, 'w') as file:
+            file.write(header)
+            file.write(SWC_COLUMNS_LINE)
+            file.write(_formatNodes(*nodeTable))
+        return totalPath
+
+    threads = threads if threads is not None else (os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=max(1, threads), thread_name_prefix='dynamo-swc') as pool:
+        return list(pool.map(_write, jobs))
+
 # Writes the SWC header, a bunch of key=value pairs in SWC comments
 def _exportHeader(file, tree, filePath, fullState):
     (_, zSz, xSz, ySz) = fullState.volumeSize
@@ -119,38 +267,35 @@ def _exportHeader(file, tree, filePath, fullState):
 
 # Writes out each point's data in the standard format.
 def _exportNodes(file, tree, forNeuroM=False):
-    allPoints = tree.flattenPoints()
-
-    # Maps node IDs (strings of base-16 numbers) to SWC indexes (1-based ints)
-    idToSWCIndex = {}
-    indexAt = 1
-    for point in allPoints:
-        if point.id not in idToSWCIndex:
-            idToSWCIndex[point.id] = indexAt
-            indexAt += 1
-
-    file.write("##n,type,x,y,z,radius,parent\n")
-    for point in tree.flattenPoints():
-        n = idToSWCIndex[point.id]
-        if forNeuroM:
-            #      0        1     2         3                4              5          6         7
-            # (UNDEFINED, SOMA, AXON, BASAL_DENDRITE, APICAL_DENDRITE, FORK_POINT, END_POINT, CUSTOM)
-            type = 0
-            if point.isRoot():
-                type = 1 # Soma
-            else:
-                type = 3 # Force everything else to be BASAL for now...
-
-            x, y, z = tree.worldCoordPoints([point])
-            x, y, z = x[0], y[0], z[0]
-            radius = point.radius if point.radius is not None else 1
-            radius = tree.worldCoordPoints([(radius, radius, radius)])[0][0]
-
-        else: # For Vaa 3D
-            # Note: Vaa3D appears to encode branch ID in this property?
-            type = int(point.parentBranch.id, 16) if point.parentBranch is not None else -1
-            x, y, z = point.location
-            radius = point.radius if point.radius is not None else 1
-        nextPoint = point.nextPointInBranch(delta=-1)
-        parent = -1 if nextPoint is None else idToSWCIndex[nextPoint.id]
-        file.write("%d %d %.4f %.4f %.4f %.5f %d\n" % (n,type,x,y,z,radius,parent))
+    file.write(SWC_COLUMNS_LINE)
+    file.write(_formatNodes(*_buildNodeTable(tree, forNeuroM)))
+
+# Type, x, y, z, radius and parent SWC index (1-based, -1 for none) for every point, as arrays.
+# Rows are in flattenPoints() order, so each point's SWC index is its row + 1.
+def _buildNodeTable(tree, forNeuroM=False):
+    arrays = tree.arrays()
+    radii = np.where(np.isnan(arrays.radii), 1.0, arrays.radii)
+    if forNeuroM:
+        #      0        1     2         3                4              5          6         7
+        # (UNDEFINED, SOMA, AXON, BASAL_DENDRITE, APICAL_DENDRITE, FORK_POINT, END_POINT, CUSTOM)
+        types = np.full(len(arrays), 3, dtype=np.int64) # Force everything else to be BASAL for now...
+        types[arrays.parents < 0] = 1 # Soma
+        locations = arrays.worldLocations
+        radii = radii * arrays.pixelSizes[0]
+    else: # For Vaa 3D
+        # Note: Vaa3D appears to encode branch ID in this property?
+        # Last entry is for the root, which has branch index -1.
+        branchTypes = np.array([int(branch.id, 16) for branch in tree.branches] + [-1], dtype=np.int64)
+        types = branchTypes[arrays.branchIndices]
+        locations = arrays.locations
+    parents = np.where(arrays.parents >= 0, arrays.parents + 1, -1)
+    return types, locations, radii, parents
+
+# Node table -> SWC node lines, all as one string.
+def _formatNodes(types, locations, radii, parents):
+    rows = zip(
+        range(1, len(types) + 1), types.tolist(),
+        locations[:, 0].tolist(), locations[:, 1].tolist(), locations[:, 2].tolist(),
+        radii.tolist(), parents.tolist()
+    )
+    return ''.join(map(SWC_NODE_FORMAT.__mod__, rows))
@@ -1,65 +1,65 @@
-import pynwb
-
-TRACE_PREFIX = 'POI '
-
-def loadTraces(path, verbose=False):
-    try:
-        # Note: NWB HD5 traces are lazily ready, so this IO must remain
-        # open until we actively read all trace data out of file.
-        io = pynwb.NWBHDF5IO(path, 'r+')
-        nwbFile = io.read()
-
-        traces = {}
-        for key, value in nwbFile.acquisition.items():
-            if key.startswith(TRACE_PREFIX):
-                nodeID = key[len(TRACE_PREFIX):]
-                loadedData = value.data[:] # This is where data is loaded...
-                traces[nodeID] = pynwb.base.TimeSeries(
-                    name=key,
-                    data=loadedData,
-                    unit=value.unit,
-                    rate=value.rate,
-                )
-                if verbose:
-                    print ("%s: %s values @ %dhz" % (
-                        nodeID, traces[nodeID].data.shape, int(traces[nodeID].rate)
-                    ))
-        return traces
+from collections import OrderedDict
 
+import pynwb
 
+from typing import Dict, List, Optional, Tuple
 
-    except Exception as e:
-        print ("Error reading file!")
-        print (e)
-        return None
+TRACE_PREFIX = 'POI '
 
-def loadStim(path, verbose=False):
-    try:
-        # Note: NWB HD5 traces are lazily ready, so this IO must remain
-        # open until we actively read all trace data out of file.
-        io = pynwb.NWBHDF5IO(path, 'r+')
-        nwbFile = io.read()
-        if nwbFile.stimulus is not None:
-            for _, value in nwbFile.stimulus.items():
+# Most NWB files kept open at once, the least recently used is closed after this.
+MAX_OPEN_FILES = 8
+
+# Default size of trace data kept in memory, the least recently used traces are dropped after this.
+DEFAULT_BUDGET_BYTES = 256 * 1024 * 1024
+
+class _NWBHandle():
+    """One NWB file, opened read-only. Trace data is only read when asked for."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.io = pynwb.NWBHDF5IO(path, 'r')
+        try:
+            self.nwbFile = self.io.read()
+        except Exception:
+            self.io.close()
+            raise
+        # Maps POI ID -> acquisition name, without touching any of the data.
+        self.traceNames = {
+            key[len(TRACE_PREFIX):]: key for key in self.nwbFile.acquisition.keys() if key.startswith(TRACE_PREFIX)
+        }
+
+    def readTrace(self, pointID: str, verbose: bool=False) -> pynwb.base.TimeSeries:
+        key = self.traceNames[pointID]
+        value = self.nwbFile.acquisition[key]
+        trace = pynwb.base.TimeSeries(
+            name=key,
+            data=value.data[:], # This is where data is loaded...
+            unit=value.unit,
+            rate=value.rate,
+        )
+        if verbose:
+            print ("%s: %s values @ %dhz" % (pointID, trace.data.shape, int(trace.rate)))
+        return trace
+
+    def readStim(self) -> Optional[List[float]]:
+        stim = None
+        if self.nwbFile.stimulus is not None:
+            for _, value in self.nwbFile.stimulus.items():
                 if value.timestamps is not None:
-                    stim = list(value.timestamps)
-        else:
-            stim = None
+                    stim = list(value.timestamps[:])
         return stim
 
-
-
-    except Exception as e:
-        print ("Error reading file!")
-        print (e)
-        return None
+    def close(self) -> None:
+        self.io.close()
 
 
 class TraceCache:
-    """Singleton cache mapping .nwb file path to loaded POI -> NWB TimeSeries maps.
+    """Singleton cache of POI traces and stimuli from .nwb files.
 
     Used so that the model can store just paths, and traces are lazily loaded only
-    when displayed, and not saved to file/history.
+    when displayed, and not saved to file/history. Files are kept open read-only and
+    shared by trace and stimulus lookups, and each POI's trace is only read when first
+    asked for. Loaded traces are kept up to budgetBytes, dropping the least recently used.
     """
 
     # Singleton instance - create TraceCache() and get back the same cache each time.
@@ -69,23 +69,30 @@ class TraceCache:
             cls._instance = object.__new__(TraceCache)
         return cls._instance
 
-    # Maps path string -> map: poi id -> NWB TimeSeries
-    _loadedTraces = dict()
+    budgetBytes: int = DEFAULT_BUDGET_BYTES
+    """How much trace data to keep in memory."""
 
-    _loadedStim = dict()
+    # Maps path -> open file, least recently used first.
+    _handles: 'OrderedDict[str, _NWBHandle]' = OrderedDict()
 
-    # Returns TimeSeries for POI, possibly loading it first if not yet cached.
+    # Paths that couldn't be read, so errors are only reported once.
+    _failedPaths: Dict[str, str] = dict()
+
+    # Maps (path, POI ID) -> loaded TimeSeries, least recently used first.
+    _loadedTraces: 'OrderedDict[Tuple[str, str], pynwb.base.TimeSeries]' = OrderedDict()
+    _loadedBytes: int = 0
+
+    # Maps path -> list of stimulus times, or None if it has none.
+    _loadedStim: Dict[str, Optional[List[float]]] = dict()
+
+    # Returns stimulus times for the first of the paths, possibly loading it first if not yet cached.
     def getStim(self, tracePaths, loadIfMissing=True, verbose=False):
         for path in tracePaths:
             if path not in self._loadedStim and loadIfMissing:
-                stimMap = loadStim(path, verbose)
-                if stimMap is not None:
-                    print('3')
-
-                    self._loadedStim[path] = stimMap
-                    print('StimMap: ', stimMap)
-                else:
-                    self._loadedStim[path] = None
+                handle = self._handle(path)
+                self._loadedStim[path] = None if handle is None else handle.readStim()
+                if verbose:
+                    print ("Stimuli: ", self._loadedStim[path])
 
             if path in self._loadedStim:
                 return self._loadedStim[path]
@@ -96,29 +103,67 @@ class TraceCache:
     # Returns TimeSeries for POI, possibly loading it first if not yet cached.
     def getTraceForPOI(self, tracePaths, pointID, loadIfMissing=True, verbose=False):
         for path in tracePaths:
-            if path not in self._loadedTraces and loadIfMissing:
-                traceMap = loadTraces(path, verbose)
-                if traceMap is not None:
-                    self._loadedTraces[path] = traceMap
+            trace = self._loadedTraces.get((path, pointID))
+            if trace is not None:
+                self._loadedTraces.move_to_end((path, pointID))
+                return trace
 
-            if path in self._loadedTraces and pointID in self._loadedTraces[path]:
-                return self._loadedTraces[path][pointID]
+            if loadIfMissing:
+                handle = self._handle(path)
+                if handle is not None and pointID in handle.traceNames:
+                    return self._loadTrace(handle, pointID, verbose)
 
         # Not found :(
         return None
 
-    # Returns a list of list of TimeSeries for all POI in the given paths
+    # Returns POI ID -> TimeSeries for all POI in the given paths
     def getAllTraces(self, tracePaths):
         mergedTraces = {}
-
         for path in tracePaths:
-            if path not in self._loadedTraces:
-                traceMap = loadTraces(path, verbose=False)
-                if traceMap is not None:
-                    self._loadedTraces[path] = traceMap
-
-            if path in self._loadedTraces and self._loadedTraces[path] is not None:
-                for k, v in self._loadedTraces[path].items():
-                    mergedTraces[k] = v
-
+            handle = self._handle(path)
+            if handle is not None:
+                for pointID in handle.traceNames:
+                    mergedTraces[pointID] = self.getTraceForPOI([path], pointID)
         return mergedTraces
+
+    # Close all files and drop everything loaded, e.g. if the files have changed.
+    def clear(self):
+        for handle in self._handles.values():
+            handle.close()
+        self._handles.clear()
+        self._failedPaths.clear()
+        self._loadedTraces.clear()
+        self._loadedStim.clear()
+        self._loadedBytes = 0
+
+    # Open file for a path, reusing it if already open.
+    def _handle(self, path: str) -> Optional[_NWBHandle]:
+        if path in self._handles:
+            self._handles.move_to_end(path)
+            return self._handles[path]
+        if path in self._failedPaths:
+            return None
+
+        try:
+            handle = _NWBHandle(path)
+        except Exception as e:
+            print ("Error reading file!")
+            print (e)
+            self._failedPaths[path] = str(e)
+            return None
+
+        self._handles[path] = handle
+        while len(self._handles) > MAX_OPEN_FILES:
+            _, oldest = self._handles.popitem(last=False)
+            oldest.close()
+        return handle
+
+    def _loadTrace(self, handle: _NWBHandle, pointID: str, verbose: bool) -> pynwb.base.TimeSeries:
+        trace = handle.readTrace(pointID, verbose)
+        self._loadedTraces[(handle.path, pointID)] = trace
+        self._loadedBytes += trace.data.nbytes
+        # Drop the least recently used, always keeping the one just loaded.
+        while self._loadedBytes > self.budgetBytes and len(self._loadedTraces) > 1:
+            _, dropped = self._loadedTraces.popitem(last=False)
+            self._loadedBytes -= dropped.data.nbytes
+        return trace
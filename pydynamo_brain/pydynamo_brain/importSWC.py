@@ -0,0 +1,42 @@
+# Command line tool to build a project from SWC reconstructions, e.g. one per timepoint,
+# without opening the UI. Run 'python -m pydynamo_brain.importSWC --help' for options,
+# or 'pydynamo_brain_swc --help' once installed.
+
+import argparse
+import sys
+
+import pydynamo_brain.files as files
+
+def runSWCImport(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Import SWC files as the stacks of a new pyDynamo project, in order."
+    )
+    parser.add_argument('swc', nargs='+',
+        help="SWC files, directories of them, or glob patterns like 'traces/*.swc'")
+    parser.add_argument('-o', '--output', required=True,
+        help="Project file to save, .dyn.gz or .dynb")
+    parser.add_argument('--stacks', nargs='+',
+        help="Image stack for each SWC file, in the same order. By default, the SWC path ending in .tif")
+    parser.add_argument('--workers', type=int, default=None,
+        help="How many processes to parse with, by default one per CPU")
+    args = parser.parse_args(argv)
+
+    swcPaths = []
+    for pathOrPattern in args.swc:
+        swcPaths.extend(files.findSWCFiles(pathOrPattern))
+    if len(swcPaths) == 0:
+        print ("No SWC files found")
+        return 1
+    if args.stacks is not None and len(args.stacks) != len(swcPaths):
+        print ("Found %d SWC files but given %d stacks" % (len(swcPaths), len(args.stacks)))
+        return 1
+
+    for i, path in enumerate(swcPaths):
+        print ("  Stack %d: %s" % (i, path))
+    fullState = files.importSWCFiles(swcPaths, stackPaths=args.stacks, workers=args.workers)
+    files.saveState(fullState, args.output)
+    print ("Imported %d SWC files, saved to %s" % (len(swcPaths), args.output))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(runSWCImport())
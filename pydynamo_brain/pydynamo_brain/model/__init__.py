@@ -6,6 +6,8 @@ from .tree.branch import Branch
 from .tree.point import Point
 from .tree.transform import Transform
 from .tree.tree import Tree, printTree
+from .tree.ancestorIndex import AncestorIndex
+from .tree.treeArrays import SubtreeMetrics, TreeArrays
 
 from .drawMode import DrawMode
 from .filoType import FiloType
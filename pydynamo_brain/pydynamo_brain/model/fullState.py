@@ -61,6 +61,12 @@ class FullState:
     # Keep track of the ID for the next branch created, used for making more unique identifiers.
     _nextBranchID: int = 0
 
+    # Counts edits to the state, bumped whenever something that gets saved may have changed.
+    _editGeneration: int = 0
+
+    # Value of _editGeneration when the state was last loaded from or saved to _rootPath.
+    _savedGeneration: int = 0
+
     # Get the index of a state, or -1 if it's not contained.
     def indexForState(self, uiState: UIState) -> int:
         try:
@@ -68,6 +74,23 @@ class FullState:
         except:
             return -1
 
+    # Unsaved changes tracking
+    def markEdited(self) -> None:
+        self._editGeneration += 1
+
+    def markSaved(self) -> None:
+        self._savedGeneration = self._editGeneration
+
+    def hasUnsavedChanges(self) -> bool:
+        """Whether anything may have changed since the last load/save, without touching disk."""
+        return self._rootPath is None or self._editGeneration != self._savedGeneration
+
+    def setProjectOptions(self, options: ProjectOptions) -> None:
+        """Replace the project options, counting it as an edit if any saved value changed."""
+        if attr.asdict(options) != attr.asdict(self.projectOptions):
+            self.markEdited()
+        self.projectOptions = options
+
     # Draw status
     def inDrawMode(self) -> bool:
         return self.drawMode == DrawMode.DEFAULT
@@ -96,6 +119,7 @@ class FullState:
             uiState = UIState(parent=self, tree=nextTree)
             self.uiStates.append(uiState)
             nextTree._parentState = uiState
+        self.markEdited()
 
     def toggleLineWidth(self) -> None:
         if self.lineWidth == 4:
@@ -201,6 +225,7 @@ class FullState:
         self.filePaths.pop(index)
         self.trees.pop(index)
         self.uiStates.pop(index)
+        self.markEdited()
         # TODO - remove undo state for that stack too
 
     def colorChannel(self) -> Optional[str]:
@@ -214,7 +239,7 @@ class FullState:
             return
 
         existingWithID = tree.getPointByID(newID)
-        if existingWithID == point:
+        if existingWithID is point:
             return
 
         if existingWithID is not None:
@@ -229,7 +254,7 @@ class FullState:
             return
 
         existingWithID = tree.getBranchByID(newID)
-        if existingWithID == branch:
+        if existingWithID is branch:
             return
 
         if existingWithID is not None:
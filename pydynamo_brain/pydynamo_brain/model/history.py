@@ -1,42 +1,92 @@
 import attr
-import copy
 
-from typing import List
+from typing import List, Optional, Union
 
 from .fullState import FullState
-from .tree.tree import Tree
+from .historySpill import SpilledPatch, SpillFile
+from .stateDiff import StatePatch, StateSnapshot, applyPatch, changesSavedState, diffStates, estimateBytes, patchSnapshot, recordState
+
+# Each history stack holds a full snapshot on top, and patches underneath it.
+# Applying the patch below a snapshot to that snapshot gives the next snapshot down.
+# Older patches are moved out to disk once over the memory budget.
+HistoryEntry = Union[StateSnapshot, StatePatch, SpilledPatch]
+
+@attr.s(frozen=True)
+class HistoryFootprint():
+    """How much undo/redo history is being kept, and where."""
+
+    undoCount: int = attr.ib()
+    """Number of states that can be undone."""
+
+    redoCount: int = attr.ib()
+    """Number of states that can be redone."""
+
+    memoryBytes: int = attr.ib()
+    """Approximate memory used by snapshots and patches kept in memory."""
+
+    spilledCount: int = attr.ib()
+    """Number of patches that have been moved to disk."""
+
+    diskBytes: int = attr.ib()
+    """Size of the compressed patches on disk."""
+
 
 class History:
     """Respresents the current live active state of the app, as well as a history of changes.
     After snapshotting with pushState(), the app can walk through history with undo/redo."""
 
-    MAX_HISTORY_LENGTH: int = 200
-    """Only this number of recent actions can be undone, to save memory."""
+    MAX_HISTORY_LENGTH: int = 1000
+    """Only this number of recent actions can be undone."""
+
+    MEMORY_BUDGET_BYTES: int = 64 * 1024 * 1024
+    """Default for how much memory patches can use before older ones are moved to disk."""
 
     liveState: FullState
     """State singleton that is being modified by the app."""
 
-    undoStack: List[FullState]
-    """List of previous state snapshots that can be undo'd to."""
+    undoStack: List[HistoryEntry]
+    """Previous states that can be undo'd to: a snapshot of the most recent, then diffs back from there."""
 
-    redoStack: List[FullState]
+    redoStack: List[HistoryEntry]
     """After undo, keep previous state in redo stack so undo can be redo'd."""
 
+    memoryBudgetBytes: int
+    """How much memory in-memory patches can use, older patches beyond this are spilled to disk."""
+
+    _lastRecorded: Optional[StateSnapshot]
+    """Most recent record of the live state, so unchanged trees don't need to be recorded again."""
+
+    _patchBytes: int
+    """Total byteSize of all patches still in memory."""
+
+    _spillFile: SpillFile
+    """Where patches go when over the memory budget."""
+
     def __init__(self, liveState: FullState) -> None:
         assert liveState is not None, "History must be created with non-None live state"
         self.liveState = liveState
         self.undoStack = []
         self.redoStack = []
+        self.memoryBudgetBytes = History.MEMORY_BUDGET_BYTES
+        self._lastRecorded = None
+        self._patchBytes = 0
+        self._spillFile = SpillFile()
+
+    def pushState(self) -> StateSnapshot:
+        """Remember the current live state so we can go back to it later if needed.
 
-    def pushState(self) -> FullState:
-        """Remember the current live state so we can go back to it later if needed."""
-        stateSnapshot = self._deepClone(self.liveState)
-        self.undoStack.append(stateSnapshot)
+        Returns a read-only snapshot, which compares equal to a FullState with the same contents."""
+        stateSnapshot = self._recordLive()
+        self._pushOnto(self.undoStack, stateSnapshot)
         # Constrain size, make sure to not run out of memory:
         while len(self.undoStack) > History.MAX_HISTORY_LENGTH:
-            del self.undoStack[0]
+            self._discard(self.undoStack.pop(0))
 
-        self.redoStack = [] # Previous redo stack cleared on state push
+        # Previous redo stack cleared on state push
+        for entry in self.redoStack:
+            self._discard(entry)
+        self.redoStack = []
+        self._enforceBudget()
         # print("History PUSH, #snapshots = (%d - %d)" % (len(self.undoStack), len(self.redoStack)))
         return stateSnapshot
 
@@ -44,9 +94,7 @@ class History:
         """Revert live state back to the most recent pushed state."""
         if len(self.undoStack) == 0:
             return False # Cannot undo with nothing to undo back to.
-        self.redoStack.append(self._deepClone(self.liveState))
-        self._copyInto(self.undoStack.pop(), self.liveState)
-        self._fixParents(self.liveState)
+        self._restoreFrom(self.undoStack, self.redoStack)
         # print("History UNDO, #snapshots = (%d - %d)" % (len(self.undoStack), len(self.redoStack)))
         return True
 
@@ -54,40 +102,105 @@ class History:
         """Undo an undo by reverting the live stack to a recently undone state."""
         if len(self.redoStack) == 0:
             return False # Cannot redo with nothing to redo back insertPointBefore
-        self.undoStack.append(self._deepClone(self.liveState))
-        self._copyInto(self.redoStack.pop(), self.liveState)
-        self._fixParents(self.liveState)
+        self._restoreFrom(self.redoStack, self.undoStack)
         # print("History REDO, #snapshots = (%d - %d)" % (len(self.undoStack), len(self.redoStack)))
         return True
 
-    def _deepClone(self, modelToClone: FullState) -> FullState:
-        """Perform a deep copy of the given object."""
-        return copy.deepcopy(modelToClone)
-
-    def _copyInto(self, modelFrom: FullState, modelTo: FullState) -> None:
-        """Copy all field values from one object into another."""
-        for field in attr.fields(modelFrom.__class__):
-            setattr(modelTo, field.name, getattr(modelFrom, field.name))
-
-    def _fixParents(self, liveState: FullState) -> None:
-        """Cloning ruins parent references, this will put them back."""
-        #if hasattr(liveState, 'uiStates'): # State is a fullState object
-        for idx, uiState in enumerate(liveState.uiStates):
-            uiState._parent = liveState
-            uiState._tree = liveState.trees[idx]
-        for tree in liveState.trees:
-            self._fixTreeParents(tree)
-
-        # TODO: Remove?
-        #elif hasattr(liveState, 'branches'): # State is a tree
-        #    self._fixTreeParents(liveState)
-
-    def _fixTreeParents(self, tree: Tree) -> None:
-        """Walk an entire tree and fix up branch and point parents."""
-        for branch in tree.branches:
-            branch._parentTree = tree
-            for point in branch.points:
-                point.parentBranch = branch
-        for point in tree.flattenPoints():
-            for child in point.children:
-                child.parentPoint = point
+    def setMemoryBudget(self, budgetBytes: int) -> None:
+        """Change how much memory patches can use, spilling older ones to disk if needed."""
+        self.memoryBudgetBytes = max(0, budgetBytes)
+        self._enforceBudget()
+
+    def footprint(self) -> HistoryFootprint:
+        """Current size of the history. Snapshots are measured on request, so this is not free."""
+        seen: set = set()
+        snapshotBytes = sum(
+            estimateBytes(stack[-1], seen) for stack in (self.undoStack, self.redoStack) if len(stack) > 0
+        )
+        entries = self.undoStack + self.redoStack
+        return HistoryFootprint(
+            undoCount=len(self.undoStack),
+            redoCount=len(self.redoStack),
+            memoryBytes=snapshotBytes + self._patchBytes,
+            spilledCount=sum(1 for entry in entries if isinstance(entry, SpilledPatch)),
+            diskBytes=self._spillFile.usedBytes(),
+        )
+
+    def _recordLive(self) -> StateSnapshot:
+        """Record the live state, only re-recording trees that have changed since last time."""
+        self._lastRecorded = recordState(self.liveState, self._lastRecorded)
+        return self._lastRecorded
+
+    def _pushOnto(self, stack: List[HistoryEntry], stateSnapshot: StateSnapshot) -> None:
+        """Put a snapshot on top of a stack, turning the previous top into a diff from it."""
+        if len(stack) > 0:
+            previousTop = stack[-1]
+            assert isinstance(previousTop, StateSnapshot)
+            patch = diffStates(stateSnapshot, previousTop)
+            patch.byteSize = estimateBytes(patch)
+            self._patchBytes += patch.byteSize
+            stack[-1] = patch
+        stack.append(stateSnapshot)
+
+    def _restoreFrom(self, fromStack: List[HistoryEntry], toStack: List[HistoryEntry]) -> None:
+        """Move the live state to the top of one stack, saving what it was onto the other."""
+        current = self._recordLive()
+        target = fromStack.pop()
+        assert isinstance(target, StateSnapshot)
+        self._pushOnto(toStack, current)
+
+        # Only the differences are applied, everything else in the live state is left alone:
+        patch = diffStates(current, target)
+        applyPatch(self.liveState, patch)
+        if changesSavedState(patch, current):
+            self.liveState.markEdited()
+        for record, tree in zip(target.trees, self.liveState.trees):
+            record.markSource(tree)
+        self._lastRecorded = target
+
+        if len(fromStack) > 0:
+            fromStack[-1] = patchSnapshot(target, self._takePatch(fromStack[-1]))
+        self._enforceBudget()
+
+    def _takePatch(self, entry: HistoryEntry) -> StatePatch:
+        """Patch is leaving the history, loading it back from disk if needed."""
+        if isinstance(entry, SpilledPatch):
+            return self._spillFile.read(entry)
+        assert isinstance(entry, StatePatch)
+        self._patchBytes -= entry.byteSize
+        return entry
+
+    def _discard(self, entry: HistoryEntry) -> None:
+        """Entry is being dropped, so stop accounting for it."""
+        if isinstance(entry, SpilledPatch):
+            self._spillFile.release(entry)
+        elif isinstance(entry, StatePatch):
+            self._patchBytes -= entry.byteSize
+
+    def _enforceBudget(self) -> None:
+        """Move the oldest in-memory patches to disk until within the memory budget."""
+        # Oldest first: the bottom of the undo stack, then the furthest redo.
+        for stack in (self.undoStack, self.redoStack):
+            for idx in range(len(stack) - 1):
+                if self._patchBytes <= self.memoryBudgetBytes:
+                    break
+                entry = stack[idx]
+                if isinstance(entry, StatePatch):
+                    stack[idx] = self._spillFile.write(entry)
+                    self._patchBytes -= entry.byteSize
+
+        if self._spillFile.needsCompacting():
+            self._compactSpillFile()
+
+    def _compactSpillFile(self) -> None:
+        """Rewrite the spill file without the space used by discarded patches."""
+        positions = []
+        entries: List[SpilledPatch] = []
+        for stack in (self.undoStack, self.redoStack):
+            for idx, entry in enumerate(stack):
+                if isinstance(entry, SpilledPatch):
+                    positions.append((stack, idx))
+                    entries.append(entry)
+        compacted = self._spillFile.compact(entries)
+        for (stack, idx), spilled in zip(positions, compacted):
+            stack[idx] = spilled
@@ -0,0 +1,102 @@
+"""
+.. module:: model
+"""
+import attr
+import pickle
+import tempfile
+import zlib
+
+from typing import BinaryIO, List, Optional
+
+from .stateDiff import StatePatch
+
+# Only rewrite the spill file once this much of it is no longer used.
+_MIN_COMPACT_BYTES = 8 * 1024 * 1024
+
+@attr.s(frozen=True)
+class SpilledPatch():
+    """Stand-in for a history patch that has been moved out of memory into a SpillFile."""
+
+    offset: int = attr.ib()
+    """Position of the compressed patch within the spill file."""
+
+    length: int = attr.ib()
+    """Number of compressed bytes."""
+
+    byteSize: int = attr.ib()
+    """Approximate memory the patch will use once loaded back."""
+
+
+class SpillFile():
+    """Anonymous temporary file holding compressed history patches.
+
+    The file is only created once something is spilled, and is deleted by the OS on close."""
+
+    _file: Optional[BinaryIO]
+    """Open temporary file, if anything has been spilled yet."""
+
+    _usedBytes: int
+    """Bytes of the file used by patches that are still referenced."""
+
+    def __init__(self) -> None:
+        self._file = None
+        self._usedBytes = 0
+
+    def write(self, patch: StatePatch) -> SpilledPatch:
+        """Compress and store a patch, returning the handle to load it back with."""
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(prefix='dynamo-history-')
+        data = zlib.compress(pickle.dumps(patch, protocol=pickle.HIGHEST_PROTOCOL))
+        offset = self._file.seek(0, 2)
+        self._file.write(data)
+        self._usedBytes += len(data)
+        return SpilledPatch(offset=offset, length=len(data), byteSize=patch.byteSize)
+
+    def read(self, spilled: SpilledPatch) -> StatePatch:
+        """Load a spilled patch back. The space it used is released."""
+        assert self._file is not None, "Reading from an empty spill file"
+        self._file.seek(spilled.offset)
+        patch = pickle.loads(zlib.decompress(self._file.read(spilled.length)))
+        self.release(spilled)
+        return patch
+
+    def release(self, spilled: SpilledPatch) -> None:
+        """Patch is no longer needed, so its space can be reused on the next compaction."""
+        self._usedBytes -= spilled.length
+
+    def diskBytes(self) -> int:
+        """Size of the spill file, including space no longer used."""
+        return 0 if self._file is None else self._file.seek(0, 2)
+
+    def usedBytes(self) -> int:
+        """Bytes of the spill file used by patches that can still be loaded."""
+        return self._usedBytes
+
+    def needsCompacting(self) -> bool:
+        unusedBytes = self.diskBytes() - self._usedBytes
+        return unusedBytes > _MIN_COMPACT_BYTES and unusedBytes > self._usedBytes
+
+    def compact(self, stillSpilled: List[SpilledPatch]) -> List[SpilledPatch]:
+        """Rewrite the file with just the given patches, returning their new handles in order."""
+        oldFile, self._file = self._file, None
+        self._usedBytes = 0
+        if oldFile is None:
+            return []
+        result = []
+        if len(stillSpilled) > 0:
+            self._file = tempfile.TemporaryFile(prefix='dynamo-history-')
+            for spilled in stillSpilled:
+                oldFile.seek(spilled.offset)
+                data = oldFile.read(spilled.length)
+                offset = self._file.seek(0, 2)
+                self._file.write(data)
+                self._usedBytes += len(data)
+                result.append(attr.evolve(spilled, offset=offset))
+        oldFile.close()
+        return result
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._usedBytes = 0
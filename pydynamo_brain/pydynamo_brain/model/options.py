@@ -2,7 +2,7 @@ import attr
 
 from typing import Any, Dict, List, Optional
 
-from pydynamo_brain.util import SAVE_META
+from pydynamo_brain.util import SAVE_META, SAVE_UNLESS_DEFAULT_META
 
 @attr.s
 class MotilityOptions():
@@ -37,3 +37,9 @@ class ProjectOptions():
 
     zProjectionMethod: Optional[str] = attr.ib(default=None, metadata=SAVE_META)
     """ What type of Z-projection is supported. 'max' / 'mean' / 'median' / 'std'. """
+
+    compression: str = attr.ib(default='gzip', metadata=SAVE_UNLESS_DEFAULT_META)
+    """ How to compress the project file. 'gzip' / 'zstd' / 'lz4', the latter two need extra packages. """
+
+    compressionLevel: Optional[int] = attr.ib(default=None, metadata=SAVE_UNLESS_DEFAULT_META)
+    """ Compression level, higher is smaller but slower. None for the codec's default. """
@@ -155,18 +155,13 @@ def recursiveAdjust(
 
 
 def _recursiveMoveBranch(tree: Tree, branch: Branch, shift: Point3D, fromPointIdx: int=0) -> None:
-    # TODO: make recursiveMovePoint?
     if branch is None: # Root branch
-        pointToMove = tree.rootPoint
-        pointToMove.location = util.locationPlus(pointToMove.location, shift)
-        for childBranch in tree.branches:
-            _recursiveMoveBranch(tree, childBranch, shift)
-
+        pointsToMove = tree.downstreamPoints(tree.rootPoint)
+    elif fromPointIdx < len(branch.points):
+        pointsToMove = tree.downstreamPoints(branch.points[fromPointIdx])
     else:
-        for pointToMove in branch.points[fromPointIdx:]:
-            pointToMove.location = util.locationPlus(pointToMove.location, shift)
-            for childBranch in pointToMove.children:
-                _recursiveMoveBranch(tree, childBranch, shift)
+        return
+    tree.translatePoints(pointsToMove, shift)
 
 # Mark all down-tree points (mark as un-registered), and return the number marked
 def _recursiveMark(tree: Tree, branch: Branch, fromPointIdx: int=0) -> int:
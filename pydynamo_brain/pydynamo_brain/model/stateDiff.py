@@ -0,0 +1,688 @@
+from __future__ import annotations
+"""
+.. module:: model
+"""
+import attr
+import copy
+import numpy as np
+import sys
+import weakref
+
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from .fullState import FullState
+from .tree.branch import Branch
+from .tree.point import Point
+from .tree.transform import Transform
+from .tree.tree import Tree
+from .uiState import UIState
+
+from pydynamo_brain.util import SAVE_KEY, Point3D
+
+# Immutable records of what is in a state, keyed by ID, so that two records can be
+# diffed cheaply and only the differences kept around for undo/redo.
+
+class PointRecord(NamedTuple):
+    """Everything about a point, with its child branches referenced by ID."""
+    location: Point3D
+    radius: Optional[float]
+    annotation: str
+    manuallyMarked: Optional[bool]
+    hilighted: Optional[bool]
+    childBranchIDs: Tuple[str, ...]
+
+class BranchRecord(NamedTuple):
+    """Everything about a branch, with its points referenced by ID."""
+    parentPointID: Optional[str]
+    pointIDs: Tuple[str, ...]
+    isEnded: bool
+    colorData: Any
+    reparentToID: Optional[str]
+
+TransformRecord = Tuple[Tuple[Tuple[float, ...], ...], Tuple[float, ...], Tuple[float, ...]]
+
+# Fields of UIState that hold the current point/puncta, recorded by ID.
+_CACHE_FIELDS = ('_currentPointCache', '_currentPunctaCache')
+
+# UIState fields that are links to other objects, rather than state.
+_LINK_FIELDS = ('_parent', '_tree')
+
+# FullState fields that are recorded separately from the generic (small) values.
+_STRUCTURE_FIELDS = ('trees', 'uiStates', 'puncta')
+
+# FullState fields tracking unsaved edits, which undo/redo must not restore.
+_EDIT_TRACKING_FIELDS = ('_editGeneration', '_savedGeneration')
+
+# Names of fields that are saved to file, for FullState and UIState.
+_SAVED_STATE_FIELDS = frozenset(field.name for field in attr.fields(FullState) if field.metadata.get(SAVE_KEY, False))
+_SAVED_UI_FIELDS = frozenset(field.name for field in attr.fields(UIState) if field.metadata.get(SAVE_KEY, False))
+
+class _Unrecordable(Exception):
+    """Tree structure can't be expressed by ID, e.g. duplicated or foreign points."""
+
+
+@attr.s(eq=False)
+class TreeRecord():
+    """Immutable record of a single tree.
+
+    Trees whose structure can't be keyed by ID are instead kept as a full copy."""
+
+    points: Dict[str, PointRecord] = attr.ib(factory=dict, repr=False)
+    """Point ID -> record, for the root and all points along branches."""
+
+    branches: Dict[str, BranchRecord] = attr.ib(factory=dict, repr=False)
+    """Branch ID -> record."""
+
+    branchOrder: Tuple[str, ...] = attr.ib(default=())
+    """IDs of tree.branches, in order."""
+
+    rootID: Optional[str] = attr.ib(default=None)
+    """ID of the root point, if set."""
+
+    transform: Optional[TransformRecord] = attr.ib(default=None, repr=False)
+    """Rotation, translation and scale of the tree's transform, None for the empty record."""
+
+    copiedTree: Optional[Tree] = attr.ib(default=None, repr=False)
+    """Full copy of the tree, used instead of the fields above if set."""
+
+    _source: Optional[weakref.ref] = attr.ib(default=None, repr=False)
+    """Live tree that is known to match this record..."""
+
+    _sourceVersion: int = attr.ib(default=-1, repr=False)
+    """...as long as it is still at this version."""
+
+    def matches(self, tree: Tree) -> bool:
+        """Whether the tree is known to be unchanged since this was recorded from it."""
+        return self._source is not None and self._source() is tree and self._sourceVersion == tree._version
+
+    def markSource(self, tree: Tree) -> None:
+        """Note that the tree currently has exactly the contents of this record."""
+        self._source = weakref.ref(tree)
+        self._sourceVersion = tree._version
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # The live tree can't be pickled, and won't match once the record is loaded back anyway.
+        state = self.__dict__.copy()
+        state['_source'] = None
+        state['_sourceVersion'] = -1
+        return state
+
+    def __eq__(self, other: Any) -> bool:
+        if not isinstance(other, TreeRecord):
+            return NotImplemented
+        if self is other:
+            return True
+        if self.copiedTree is not None or other.copiedTree is not None:
+            return self.copiedTree is not None and other.copiedTree is not None and \
+                self.copiedTree == other.copiedTree and self.transform == other.transform
+        return self.rootID == other.rootID and self.branchOrder == other.branchOrder and \
+            self.transform == other.transform and \
+            self.points == other.points and self.branches == other.branches
+
+    def __ne__(self, other: Any) -> bool:
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+
+@attr.s(eq=False)
+class TreePatch():
+    """Changes that turn one tree record into another."""
+
+    points: Dict[str, Optional[PointRecord]] = attr.ib(factory=dict, repr=False)
+    """New record for each changed point, None if removed."""
+
+    branches: Dict[str, Optional[BranchRecord]] = attr.ib(factory=dict, repr=False)
+    """New record for each changed branch, None if removed."""
+
+    branchOrder: Optional[Tuple[str, ...]] = attr.ib(default=None)
+    """New order of branches, if changed."""
+
+    rootChanged: bool = attr.ib(default=False)
+    """Whether the root point is now a different point."""
+
+    rootID: Optional[str] = attr.ib(default=None)
+    """New root point ID, if rootChanged."""
+
+    transform: Optional[TransformRecord] = attr.ib(default=None, repr=False)
+    """New transform, if changed."""
+
+    replacement: Optional[TreeRecord] = attr.ib(default=None, repr=False)
+    """Entire new record, if the tree can't be patched by ID."""
+
+    def isEmpty(self) -> bool:
+        return len(self.points) == 0 and len(self.branches) == 0 and self.branchOrder is None and \
+            not self.rootChanged and self.transform is None and self.replacement is None
+
+
+@attr.s(eq=False)
+class StateSnapshot():
+    """Immutable record of an entire FullState, as returned by History.pushState().
+
+    Compares equal to a FullState with the same contents. Records of unchanged
+    trees are shared between snapshots."""
+
+    values: Dict[str, Any] = attr.ib(repr=False)
+    """Copies of all FullState fields other than trees, uiStates and puncta."""
+
+    trees: Tuple[TreeRecord, ...] = attr.ib(repr=False)
+    """Record of each tree."""
+
+    uiStates: Tuple[Dict[str, Any], ...] = attr.ib(repr=False)
+    """Field values of each UIState, with current point/puncta replaced by their IDs."""
+
+    puncta: Tuple[Any, ...] = attr.ib(repr=False)
+    """Record of each stack's puncta."""
+
+    def __eq__(self, other: Any) -> bool:
+        if not isinstance(other, StateSnapshot):
+            if not isinstance(other, FullState):
+                return NotImplemented
+            other = recordState(other)
+        return all(_sameValue(v, other.values.get(k, _MISSING)) for k, v in self.values.items()) and \
+            len(self.values) == len(other.values) and \
+            self.trees == other.trees and self.uiStates == other.uiStates and self.puncta == other.puncta
+
+    def __ne__(self, other: Any) -> bool:
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+
+@attr.s(eq=False)
+class StatePatch():
+    """Changes that turn one state snapshot into another."""
+
+    values: Dict[str, Any] = attr.ib(factory=dict, repr=False)
+    """New copy of each changed FullState field."""
+
+    stackCount: int = attr.ib(default=0)
+    """Number of trees afterwards."""
+
+    trees: Dict[int, TreePatch] = attr.ib(factory=dict, repr=False)
+    """Patch for each changed tree, by stack index."""
+
+    uiStateCount: int = attr.ib(default=0)
+    """Number of UI states afterwards."""
+
+    uiStates: Dict[int, Dict[str, Any]] = attr.ib(factory=dict, repr=False)
+    """New value of each changed UI state field, by stack index."""
+
+    punctaCount: int = attr.ib(default=0)
+    """Number of puncta lists afterwards."""
+
+    puncta: Dict[int, Any] = attr.ib(factory=dict, repr=False)
+    """New record of each changed puncta list, by stack index."""
+
+    byteSize: int = attr.ib(default=0)
+    """Approximate memory used by the patch, see estimateBytes()."""
+
+
+_MISSING = object()
+
+EMPTY_TREE_RECORD = TreeRecord(transform=None)
+"""Record of a new, empty tree."""
+
+
+### Recording
+
+def recordState(fullState: FullState, previous: Optional[StateSnapshot]=None) -> StateSnapshot:
+    """Record everything in the state.
+
+    Trees that are unchanged since they were recorded for the previous snapshot reuse that record."""
+    reusable: Dict[int, TreeRecord] = {}
+    if previous is not None:
+        for previousRecord in previous.trees:
+            source = None if previousRecord._source is None else previousRecord._source()
+            if source is not None:
+                reusable[id(source)] = previousRecord
+
+    trees = []
+    for tree in fullState.trees:
+        record = reusable.get(id(tree))
+        if record is None or not record.matches(tree):
+            record = recordTree(tree)
+        else:
+            # Transforms are edited without the tree noticing, so always check them:
+            transform = _recordTransform(tree.transform)
+            if transform != record.transform:
+                record = _withTransform(record, transform, tree)
+        trees.append(record)
+
+    values = {}
+    for field in attr.fields(fullState.__class__):
+        if field.name not in _STRUCTURE_FIELDS and field.name not in _EDIT_TRACKING_FIELDS:
+            values[field.name] = copy.deepcopy(getattr(fullState, field.name))
+
+    return StateSnapshot(
+        values=values,
+        trees=tuple(trees),
+        uiStates=tuple(_recordUIState(uiState) for uiState in fullState.uiStates),
+        puncta=tuple(_recordPuncta(stackPuncta) for stackPuncta in fullState.puncta),
+    )
+
+def recordTree(tree: Tree) -> TreeRecord:
+    """Record a single tree, falling back to a full copy if it can't be keyed by ID."""
+    transform = _recordTransform(tree.transform)
+    try:
+        if not tree.isLoaded():
+            raise _Unrecordable() # Keep it unloaded, its copy loads the same contents if ever needed.
+        record = _recordTreeByID(tree, transform)
+    except _Unrecordable:
+        # Copy on write: this only happens when the tree's version has changed.
+        record = TreeRecord(transform=transform, copiedTree=tree.detachedCopy())
+    record.markSource(tree)
+    return record
+
+def _recordTreeByID(tree: Tree, transform: TransformRecord) -> TreeRecord:
+    pointObjects: Dict[str, Point] = {}
+    branchObjects: Dict[str, Branch] = {}
+    if tree.rootPoint is not None:
+        pointObjects[tree.rootPoint.id] = tree.rootPoint
+    nPoints = len(pointObjects)
+    for branch in tree.branches:
+        branchObjects[branch.id] = branch
+        for point in branch.points:
+            pointObjects[point.id] = point
+        nPoints += len(branch.points)
+    if len(pointObjects) != nPoints or len(branchObjects) != len(tree.branches):
+        raise _Unrecordable() # Duplicate IDs
+
+    def _localID(point: Optional[Point]) -> Optional[str]:
+        if point is None:
+            return None
+        if pointObjects.get(point.id) is not point:
+            raise _Unrecordable()
+        return point.id
+
+    # Records are built with tuple.__new__, as the NamedTuple constructor is slow for many points.
+    makeRecord = tuple.__new__
+    points = {}
+    for pointID, point in pointObjects.items():
+        childIDs: Tuple[str, ...] = ()
+        if len(point.children) > 0:
+            childIDs = tuple([child.id for child in point.children])
+            if any(branchObjects.get(childID) is not child for childID, child in zip(childIDs, point.children)):
+                raise _Unrecordable()
+        points[pointID] = makeRecord(PointRecord, (
+            tuple(point.location), point.radius, point.annotation,
+            point.manuallyMarked, point.hilighted, childIDs
+        ))
+
+    branches = {}
+    for branchID, branch in branchObjects.items():
+        branches[branchID] = makeRecord(BranchRecord, (
+            _localID(branch.parentPoint), tuple([p.id for p in branch.points]),
+            branch.isEnded, copy.deepcopy(branch.colorData), _localID(branch.reparentTo)
+        ))
+
+    return TreeRecord(
+        points=points,
+        branches=branches,
+        branchOrder=tuple(branchObjects.keys()),
+        rootID=None if tree.rootPoint is None else tree.rootPoint.id,
+        transform=transform,
+    )
+
+def _recordTransform(transform: Transform) -> TransformRecord:
+    return (
+        tuple(tuple(row) for row in transform.rotation),
+        tuple(transform.translation),
+        tuple(transform.scale),
+    )
+
+def _withTransform(record: TreeRecord, transform: TransformRecord, tree: Tree) -> TreeRecord:
+    if record.copiedTree is not None:
+        return recordTree(tree)
+    result = attr.evolve(record, transform=transform)
+    result.markSource(tree)
+    return result
+
+def _recordUIState(uiState: UIState) -> Dict[str, Any]:
+    result = {}
+    for field in attr.fields(UIState):
+        if field.name in _LINK_FIELDS:
+            continue
+        value = getattr(uiState, field.name)
+        if field.name in _CACHE_FIELDS:
+            value = None if value is None else value.id
+        result[field.name] = value
+    # A current point that is no longer in the tree can't be restored by ID, so is dropped:
+    current = uiState._currentPointCache
+    if current is not None:
+        tree = uiState._tree
+        if tree is None or tree.getPointByID(current.id, includeDisconnected=True) is not current:
+            result['_currentPointCache'] = None
+    return result
+
+def _recordPuncta(stackPuncta: Any) -> Any:
+    if isinstance(stackPuncta, list) and all(isinstance(p, Point) for p in stackPuncta):
+        return ('points', tuple(
+            (p.id, PointRecord(tuple(p.location), p.radius, p.annotation, p.manuallyMarked, p.hilighted, ()))
+            for p in stackPuncta
+        ))
+    return ('raw', copy.deepcopy(stackPuncta))
+
+_DEFAULT_UI_RECORD = _recordUIState(UIState())
+
+
+### Diffing
+
+def diffStates(fromState: StateSnapshot, toState: StateSnapshot) -> StatePatch:
+    """Calculate the patch that turns the first snapshot into the second."""
+    patch = StatePatch(
+        stackCount=len(toState.trees),
+        uiStateCount=len(toState.uiStates),
+        punctaCount=len(toState.puncta),
+    )
+    for name, value in toState.values.items():
+        if not _sameValue(fromState.values.get(name, _MISSING), value):
+            patch.values[name] = value
+
+    for idx, toTree in enumerate(toState.trees):
+        fromTree = fromState.trees[idx] if idx < len(fromState.trees) else EMPTY_TREE_RECORD
+        if fromTree is not toTree:
+            treePatch = diffTrees(fromTree, toTree)
+            if not treePatch.isEmpty():
+                patch.trees[idx] = treePatch
+
+    for idx, toUI in enumerate(toState.uiStates):
+        fromUI = fromState.uiStates[idx] if idx < len(fromState.uiStates) else _DEFAULT_UI_RECORD
+        changed = {k: v for k, v in toUI.items() if not _sameValue(fromUI.get(k, _MISSING), v)}
+        if idx >= len(fromState.uiStates) or len(changed) > 0:
+            patch.uiStates[idx] = changed
+
+    for idx, toPuncta in enumerate(toState.puncta):
+        if idx >= len(fromState.puncta) or fromState.puncta[idx] != toPuncta:
+            patch.puncta[idx] = toPuncta
+    return patch
+
+def changesSavedState(patch: StatePatch, previous: StateSnapshot) -> bool:
+    """Whether applying a patch to the previous snapshot changes anything saved to file.
+
+    Changes to e.g. just the selected point don't count."""
+    if patch.stackCount != len(previous.trees) or patch.uiStateCount != len(previous.uiStates) or \
+            patch.punctaCount != len(previous.puncta):
+        return True
+    if len(patch.trees) > 0 or len(patch.puncta) > 0:
+        return True
+    if any(name in _SAVED_STATE_FIELDS for name in patch.values):
+        return True
+    return any(name in _SAVED_UI_FIELDS for changes in patch.uiStates.values() for name in changes)
+
+def diffTrees(fromTree: TreeRecord, toTree: TreeRecord) -> TreePatch:
+    """Calculate the patch that turns the first tree record into the second."""
+    if fromTree.copiedTree is not None or toTree.copiedTree is not None:
+        return TreePatch(replacement=toTree)
+
+    patch = TreePatch()
+    _diffByID(fromTree.points, toTree.points, patch.points)
+    _diffByID(fromTree.branches, toTree.branches, patch.branches)
+    if fromTree.branchOrder != toTree.branchOrder:
+        patch.branchOrder = toTree.branchOrder
+    if fromTree.rootID != toTree.rootID:
+        patch.rootChanged, patch.rootID = True, toTree.rootID
+    if fromTree.transform != toTree.transform:
+        patch.transform = toTree.transform
+    return patch
+
+def _diffByID(fromRecords: Dict[str, Any], toRecords: Dict[str, Any], changes: Dict[str, Any]) -> None:
+    for recordID, record in toRecords.items():
+        if fromRecords.get(recordID) != record:
+            changes[recordID] = record
+    for recordID in fromRecords.keys():
+        if recordID not in toRecords:
+            changes[recordID] = None
+
+def _sameValue(a: Any, b: Any) -> bool:
+    if a is b:
+        return True
+    if type(a) is not type(b):
+        return False
+    if attr.has(type(a)):
+        # Compare every field, including those left out of attrs equality:
+        return _sameValue(attr.astuple(a, recurse=False), attr.astuple(b, recurse=False))
+    if isinstance(a, (list, tuple)):
+        return len(a) == len(b) and all(_sameValue(x, y) for x, y in zip(a, b))
+    if isinstance(a, np.ndarray):
+        return np.array_equal(a, b)
+    return bool(a == b)
+
+
+### Size accounting
+
+def estimateBytes(value: Any, seen: Optional[set]=None) -> int:
+    """Approximate memory used by a record or patch, including everything it contains.
+
+    Objects already in seen are not counted again, so shared records can be counted once."""
+    if seen is None:
+        seen = set()
+    total = 0
+    toVisit = [value]
+    while len(toVisit) > 0:
+        obj = toVisit.pop()
+        if obj is None or id(obj) in seen or isinstance(obj, (weakref.ref, type)):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            toVisit.extend(obj.keys())
+            toVisit.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            toVisit.extend(obj)
+        elif isinstance(obj, np.ndarray):
+            continue # getsizeof already includes owned data.
+        elif isinstance(obj, Tree) and not obj.isLoaded():
+            toVisit.append(obj.transform) # Don't load it just to measure it.
+        elif attr.has(type(obj)):
+            toVisit.extend(getattr(obj, field.name) for field in attr.fields(type(obj)))
+    return total
+
+
+### Patching snapshots
+
+def patchSnapshot(snapshot: StateSnapshot, patch: StatePatch) -> StateSnapshot:
+    """Apply a patch to a snapshot, returning the new snapshot. The original is unchanged."""
+    values = dict(snapshot.values)
+    values.update(patch.values)
+
+    trees = []
+    for idx in range(patch.stackCount):
+        record = snapshot.trees[idx] if idx < len(snapshot.trees) else EMPTY_TREE_RECORD
+        if idx in patch.trees:
+            record = patchTreeRecord(record, patch.trees[idx])
+        trees.append(record)
+
+    uiStates = []
+    for idx in range(patch.uiStateCount):
+        uiRecord = snapshot.uiStates[idx] if idx < len(snapshot.uiStates) else _DEFAULT_UI_RECORD
+        if idx in patch.uiStates:
+            uiRecord = dict(uiRecord)
+            uiRecord.update(patch.uiStates[idx])
+        uiStates.append(uiRecord)
+
+    puncta = [
+        patch.puncta[idx] if idx in patch.puncta else snapshot.puncta[idx]
+        for idx in range(patch.punctaCount)
+    ]
+    return StateSnapshot(values=values, trees=tuple(trees), uiStates=tuple(uiStates), puncta=tuple(puncta))
+
+def patchTreeRecord(record: TreeRecord, patch: TreePatch) -> TreeRecord:
+    """Apply a patch to a tree record, returning the new record."""
+    if patch.replacement is not None:
+        return patch.replacement
+    return TreeRecord(
+        points=_patchByID(record.points, patch.points),
+        branches=_patchByID(record.branches, patch.branches),
+        branchOrder=record.branchOrder if patch.branchOrder is None else patch.branchOrder,
+        rootID=patch.rootID if patch.rootChanged else record.rootID,
+        transform=record.transform if patch.transform is None else patch.transform,
+    )
+
+def _patchByID(records: Dict[str, Any], changes: Dict[str, Any]) -> Dict[str, Any]:
+    if len(changes) == 0:
+        return records
+    result = dict(records)
+    for recordID, record in changes.items():
+        if record is None:
+            result.pop(recordID, None)
+        else:
+            result[recordID] = record
+    return result
+
+
+### Patching live state
+
+def applyPatch(fullState: FullState, patch: StatePatch) -> None:
+    """Apply a patch to the live state, reusing existing points and branches where possible."""
+    for name, value in patch.values.items():
+        setattr(fullState, name, copy.deepcopy(value))
+
+    # Stack count may change, e.g. when undoing adding or removing a stack:
+    del fullState.trees[patch.stackCount:]
+    while len(fullState.trees) < patch.stackCount:
+        fullState.trees.append(Tree())
+    for idx, treePatch in patch.trees.items():
+        tree = fullState.trees[idx]
+        if treePatch.replacement is not None:
+            fullState.trees[idx] = materializeTree(treePatch.replacement)
+        else:
+            applyTreePatch(tree, treePatch)
+
+    del fullState.uiStates[patch.uiStateCount:]
+    while len(fullState.uiStates) < patch.uiStateCount:
+        fullState.uiStates.append(UIState(parent=fullState))
+    for idx, uiState in enumerate(fullState.uiStates):
+        uiState._parent = fullState
+        uiState._tree = fullState.trees[idx] if idx < len(fullState.trees) else None
+        if uiState._tree is not None:
+            uiState._tree._parentState = uiState
+        changes = patch.uiStates.get(idx, {})
+        for name, value in changes.items():
+            if name not in _CACHE_FIELDS:
+                setattr(uiState, name, value)
+        _restoreCaches(fullState, idx, uiState, changes)
+
+    del fullState.puncta[patch.punctaCount:]
+    while len(fullState.puncta) < patch.punctaCount:
+        fullState.puncta.append([])
+    for idx, punctaRecord in patch.puncta.items():
+        fullState.puncta[idx] = _materializePuncta(fullState.puncta[idx], punctaRecord)
+    for idx, uiState in enumerate(fullState.uiStates):
+        if idx in patch.puncta:
+            _restoreCaches(fullState, idx, uiState, patch.uiStates.get(idx, {}))
+
+def applyTreePatch(tree: Tree, patch: TreePatch) -> None:
+    """Update a live tree in place, so it matches the patched record."""
+    assert patch.replacement is None, "Replaced trees must be materialized instead"
+    pointObjects: Dict[str, Point] = {}
+    if tree.rootPoint is not None:
+        pointObjects[tree.rootPoint.id] = tree.rootPoint
+    branchObjects: Dict[str, Branch] = {}
+    for branch in tree.branches:
+        branchObjects[branch.id] = branch
+        for point in branch.points:
+            pointObjects[point.id] = point
+
+    # Fields are set directly, as change hooks expect an already consistent tree.
+    changedPoints = []
+    for pointID, pointRecord in patch.points.items():
+        if pointRecord is None:
+            pointObjects.pop(pointID, None)
+            continue
+        if pointID not in pointObjects:
+            pointObjects[pointID] = Point(id=pointID, location=pointRecord.location)
+        point = pointObjects[pointID]
+        object.__setattr__(point, 'location', pointRecord.location)
+        object.__setattr__(point, 'radius', pointRecord.radius)
+        object.__setattr__(point, 'annotation', pointRecord.annotation)
+        object.__setattr__(point, 'manuallyMarked', pointRecord.manuallyMarked)
+        object.__setattr__(point, 'hilighted', pointRecord.hilighted)
+        changedPoints.append((point, pointRecord))
+
+    for branchID, branchRecord in patch.branches.items():
+        if branchRecord is None:
+            branchObjects.pop(branchID, None)
+            continue
+        if branchID not in branchObjects:
+            branchObjects[branchID] = Branch(id=branchID)
+        branch = branchObjects[branchID]
+        points = [pointObjects[pointID] for pointID in branchRecord.pointIDs]
+        object.__setattr__(branch, '_parentTree', tree)
+        object.__setattr__(branch, 'parentPoint', _lookup(pointObjects, branchRecord.parentPointID))
+        object.__setattr__(branch, 'points', points)
+        object.__setattr__(branch, 'isEnded', branchRecord.isEnded)
+        object.__setattr__(branch, 'colorData', copy.deepcopy(branchRecord.colorData))
+        object.__setattr__(branch, 'reparentTo', _lookup(pointObjects, branchRecord.reparentToID))
+        object.__setattr__(branch, '_pointPositions', None)
+        for point in points:
+            object.__setattr__(point, 'parentBranch', branch)
+
+    for point, pointRecord in changedPoints:
+        object.__setattr__(point, 'children', [branchObjects[childID] for childID in pointRecord.childBranchIDs])
+
+    if patch.branchOrder is not None:
+        tree.branches = [branchObjects[branchID] for branchID in patch.branchOrder]
+    if patch.rootChanged:
+        tree.rootPoint = _lookup(pointObjects, patch.rootID)
+    if tree.rootPoint is not None:
+        object.__setattr__(tree.rootPoint, 'parentBranch', None)
+    if patch.transform is not None:
+        rotation, translation, scale = patch.transform
+        tree.transform = Transform(
+            rotation=[list(row) for row in rotation], translation=list(translation), scale=list(scale)
+        )
+    tree._invalidateIndexes()
+    tree._markChanged()
+
+def materializeState(snapshot: StateSnapshot) -> FullState:
+    """Create a new, separate FullState from a snapshot. The snapshot is left unchanged."""
+    fullState = FullState()
+    applyPatch(fullState, diffStates(recordState(FullState()), snapshot))
+    return fullState
+
+def materializeTree(record: TreeRecord) -> Tree:
+    """Create a new live tree from a record."""
+    if record.copiedTree is None:
+        tree = Tree()
+        applyTreePatch(tree, diffTrees(EMPTY_TREE_RECORD, record))
+        return tree
+    # The record's copy is shared by snapshots, so the live state gets its own:
+    return record.copiedTree.detachedCopy()
+
+def _lookup(pointObjects: Dict[str, Point], pointID: Optional[str]) -> Optional[Point]:
+    return None if pointID is None else pointObjects.get(pointID)
+
+def _materializePuncta(existing: Any, punctaRecord: Any) -> Any:
+    kind, data = punctaRecord
+    if kind == 'raw':
+        return copy.deepcopy(data)
+    existingByID = {}
+    if isinstance(existing, list):
+        existingByID = {p.id: p for p in existing if isinstance(p, Point)}
+    result: List[Point] = []
+    for pointID, pointRecord in data:
+        point = existingByID.pop(pointID, None)
+        if point is None:
+            point = Point(id=pointID, location=pointRecord.location)
+        point.location = pointRecord.location
+        point.radius = pointRecord.radius
+        point.annotation = pointRecord.annotation
+        point.manuallyMarked = pointRecord.manuallyMarked
+        point.hilighted = pointRecord.hilighted
+        result.append(point)
+    return result
+
+def _restoreCaches(fullState: FullState, idx: int, uiState: UIState, changes: Dict[str, Any]) -> None:
+    """Point the current point/puncta caches at the (possibly new) objects with the right IDs."""
+    current = uiState._currentPointCache
+    pointID = changes.get('_currentPointCache', None if current is None else current.id)
+    point = None
+    if pointID is not None and uiState._tree is not None:
+        point = uiState._tree.getPointByID(pointID, includeDisconnected=True)
+    uiState._currentPointCache = point
+
+    current = uiState._currentPunctaCache
+    punctaID = changes.get('_currentPunctaCache', None if current is None else current.id)
+    puncta = None
+    if punctaID is not None and idx < len(fullState.puncta) and isinstance(fullState.puncta[idx], list):
+        puncta = next((p for p in fullState.puncta[idx] if isinstance(p, Point) and p.id == punctaID), None)
+    uiState._currentPunctaCache = puncta
@@ -0,0 +1,91 @@
+from __future__ import annotations
+"""
+.. module:: tree
+"""
+import attr
+import numpy as np
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .treeArrays import SubtreeMetrics, TreeArrays
+
+# Limit on how many point pairs are resolved at once when building distance matrices.
+_MAX_PAIRS_PER_CHUNK = 1 << 20
+
+@attr.s(frozen=True)
+class AncestorIndex():
+    """Binary lifting table for lowest common ancestor queries, indexed by TreeArrays row.
+
+    Obtain via Tree.ancestorIndex(), which caches the result alongside Tree.arrays()."""
+
+    depths: np.ndarray = attr.ib(repr=False)
+    """Number of edges from the soma to each point."""
+
+    jumps: np.ndarray = attr.ib(repr=False)
+    """(levels, N) array, jumps[k][row] is the row 2^k steps towards the soma (root stays at root)."""
+
+    pathLengthFromRoot: np.ndarray = attr.ib(repr=False)
+    """World distance along the tree from the soma to each point."""
+
+    def lowestCommonAncestors(self, rowsA: np.ndarray, rowsB: np.ndarray) -> np.ndarray:
+        """For each pair of rows, the row of the deepest point that is upstream of (or is) both."""
+        rowsA, rowsB = np.broadcast_arrays(np.asarray(rowsA, dtype=np.int64), np.asarray(rowsB, dtype=np.int64))
+        # Make A the deeper of each pair, then lift it to the same depth as B:
+        swap = self.depths[rowsA] < self.depths[rowsB]
+        a, b = np.where(swap, rowsB, rowsA), np.where(swap, rowsA, rowsB)
+        depthDiff = self.depths[a] - self.depths[b]
+        for level in range(len(self.jumps)):
+            a = np.where((depthDiff >> level) & 1 == 1, self.jumps[level][a], a)
+
+        # Then lift both as far as possible while they remain different:
+        for level in reversed(range(len(self.jumps))):
+            jumpA, jumpB = self.jumps[level][a], self.jumps[level][b]
+            different = jumpA != jumpB
+            a, b = np.where(different, jumpA, a), np.where(different, jumpB, b)
+        return np.where(a == b, a, self.jumps[0][a])
+
+    def treeDistances(self, rowsA: np.ndarray, rowsB: np.ndarray) -> np.ndarray:
+        """For each pair of rows, the world distance travelled along the tree between them."""
+        rowsA, rowsB = np.broadcast_arrays(np.asarray(rowsA, dtype=np.int64), np.asarray(rowsB, dtype=np.int64))
+        common = self.lowestCommonAncestors(rowsA, rowsB)
+        paths = self.pathLengthFromRoot
+        return paths[rowsA] + paths[rowsB] - 2 * paths[common]
+
+    def treeDistanceMatrix(self, rowsA: np.ndarray, rowsB: np.ndarray) -> np.ndarray:
+        """(len(rowsA), len(rowsB)) array of tree distances between all pairs of rows."""
+        rowsA, rowsB = np.asarray(rowsA, dtype=np.int64), np.asarray(rowsB, dtype=np.int64)
+        result = np.zeros((len(rowsA), len(rowsB)))
+        if len(rowsA) == 0 or len(rowsB) == 0:
+            return result
+        chunkSize = max(1, _MAX_PAIRS_PER_CHUNK // len(rowsB))
+        for start in range(0, len(rowsA), chunkSize):
+            chunk = rowsA[start:start + chunkSize]
+            result[start:start + len(chunk)] = self.treeDistances(chunk[:, np.newaxis], rowsB[np.newaxis, :])
+        return result
+
+
+def buildAncestorIndex(arrays: TreeArrays, metrics: SubtreeMetrics) -> AncestorIndex:
+    """Build the lifting table, relying on rows being in pre-order so parents come first."""
+    n = len(arrays)
+    parents = arrays.parents.tolist()
+    depths = [0] * n
+    for row in range(1, n):
+        depths[row] = depths[parents[row]] + 1
+
+    # Root points to itself, so jumps past the root stay there.
+    firstJump = np.maximum(arrays.parents, 0)
+    maxDepth = max(depths) if n > 0 else 0
+    jumps = [firstJump]
+    while (1 << len(jumps)) <= maxDepth:
+        jumps.append(jumps[-1][jumps[-1]])
+
+    jumpTable = np.array(jumps, dtype=np.int64).reshape((len(jumps), n))
+    jumpTable.setflags(write=False)
+    depthArray = np.array(depths, dtype=np.int64)
+    depthArray.setflags(write=False)
+    return AncestorIndex(
+        depths=depthArray,
+        jumps=jumpTable,
+        pathLengthFromRoot=metrics.pathLengthFromRoot,
+    )
@@ -6,21 +6,39 @@ from __future__ import annotations
 import attr
 import numpy as np
 
-from typing import Any, List, Optional, Tuple, TYPE_CHECKING
+from typing import Any, Dict, List, Optional, Tuple, TYPE_CHECKING
 
 import pydynamo_brain.util as util
 from pydynamo_brain.util import SAVE_META
 
-from .point import Point
+from .point import Point, internID
+from .traversal import iterPoints
 
 if TYPE_CHECKING:
     from .tree import Tree
 
-@attr.s
+
+def _onBranchIDChange(branch: Branch, attribute: attr.Attribute, newID: str) -> str:
+    """Keeps the owning tree's ID index in sync when a branch's ID is changed."""
+    newID = internID(newID)
+    if branch._parentTree is not None:
+        branch._parentTree._reindexBranch(branch, branch.id, newID)
+        branch._parentTree._markChanged()
+    return newID
+
+def _onPointsReplaced(branch: Branch, attribute: attr.Attribute, value: List[Point]) -> List[Point]:
+    """Wholesale replacement of the point list invalidates the positional index."""
+    branch._pointPositions = None
+    if branch._parentTree is not None:
+        branch._parentTree._markChanged()
+    return value
+
+
+@attr.s(slots=True)
 class Branch():
     """Single connected branch on a Tree"""
 
-    id: str = attr.ib(metadata=SAVE_META)
+    id: str = attr.ib(metadata=SAVE_META, converter=internID, on_setattr=_onBranchIDChange)
     """Identifier of a branch, can be shared across stacks."""
 
     _parentTree: Tree = attr.ib(default=None, repr=False, eq=False, order=False)
@@ -29,7 +47,7 @@ class Branch():
     parentPoint: Optional[Point] = attr.ib(default=None, repr=False, eq=False, order=False, metadata=SAVE_META)
     """Node this branched off, or None for root branch"""
 
-    points: List[Point] = attr.ib(default=attr.Factory(list), metadata=SAVE_META)
+    points: List[Point] = attr.ib(default=attr.Factory(list), metadata=SAVE_META, on_setattr=_onPointsReplaced)
     """Points along this dendrite branch, in order."""
 
     isEnded: bool = attr.ib(default=False, eq=False, order=False)
@@ -41,16 +59,33 @@ class Branch():
     reparentTo: Optional[Point] = attr.ib(default=None, metadata=SAVE_META)
     """HACK - document"""
 
+    _pointPositions: Optional[Dict[str, int]] = attr.ib(default=None, init=False, repr=False, eq=False, order=False)
+    """Lazily built map of point ID -> index along the branch."""
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Positions are cheap to rebuild, so don't copy them into history snapshots.
+        state = {field.name: getattr(self, field.name) for field in attr.fields(Branch)}
+        state['_pointPositions'] = None
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        # Restore directly, as the change hooks expect an already complete branch.
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
+
     def indexInParent(self) -> int:
         """Ordinal number of branch within the tree it is owned by."""
-        return self._parentTree.branches.index(self)
+        return self._parentTree.indexForBranch(self)
 
     def indexForPointID(self, pointID: str) -> int:
         """Given a point ID, return how far along the branch it sits."""
-        for idx, point in enumerate(self.points):
-            if point.id == pointID:
-                return idx
-        return -1
+        positions = self._indexedPositions()
+        idx = positions.get(pointID, -1)
+        if idx >= len(self.points) or (idx >= 0 and self.points[idx].id != pointID):
+            # Points were changed without going through the branch, so rebuild.
+            self._pointPositions = None
+            idx = self._indexedPositions().get(pointID, -1)
+        return idx
 
     def indexForPoint(self, pointTarget: Point) -> int:
         """Given a point, return how far along the branch it sits."""
@@ -134,6 +169,11 @@ class Branch():
         :returns: the index of the new point."""
         self.points.append(point)
         point.parentBranch = self
+        if self._pointPositions is not None:
+            self._pointPositions.setdefault(point.id, len(self.points) - 1)
+        if self._parentTree is not None:
+            self._parentTree._indexPoint(point)
+            self._parentTree._markChanged()
         return len(self.points) - 1
 
     def insertPointBefore(self, point: Point, index: int) -> int:
@@ -142,17 +182,29 @@ class Branch():
         :returns: the index of the new point."""
         self.points.insert(index, point)
         point.parentBranch = self
+        self._pointPositions = None
+        if self._parentTree is not None:
+            self._parentTree._indexPoint(point)
+            self._parentTree._markChanged()
         return index
 
     def removePointLocally(self, point: Point) -> Optional[Point]:
         """Remove a single point from the branch, leaving points before and after.
 
         :returns: The point before this one"""
-        if point not in self.points:
+        index = self.indexForPoint(point)
+        if index == -1 or self.points[index] is not point:
             print ("Deleting point not in the branch? Whoops")
             return None
-        index = self.points.index(point)
-        self.points.remove(point)
+        del self.points[index]
+        if index == len(self.points) and self._pointPositions is not None:
+            # Removed from the end, so the other positions are unchanged.
+            self._pointPositions.pop(point.id, None)
+        else:
+            self._pointPositions = None
+        if self._parentTree is not None:
+            self._parentTree._unindexPoint(point)
+            self._parentTree._markChanged()
         return self.parentPoint if index == 0 else self.points[index - 1]
 
     def setParentPoint(self, parentPoint: Point) -> None:
@@ -161,19 +213,16 @@ class Branch():
             self.parentPoint.children.remove(self) # Remove from previous parent first, if needed
         self.parentPoint = parentPoint
         self.parentPoint.children.append(self)
+        if self._parentTree is not None:
+            self._parentTree._markChanged()
 
     def flattenSubtreePoints(self, startIdx: int=0) -> List[Point]:
         """Return all points on this branch and subbranches."""
-        points = []
-        for p in self.points[startIdx:]:
-            points.append(p)
-            for child in p.children:
-                points.extend(child.flattenSubtreePoints())
-        return points
+        return list(iterPoints(self.points, startIdx))
 
     def subtreeContainsID(self, pointID: str) -> bool:
         """Whether the given point ID exists on this branch or subbranches down the tree."""
-        return pointID in [p.id for p in self.flattenSubtreePoints()]
+        return any(p.id == pointID for p in iterPoints(self.points))
 
     def worldLengths(self, fromIdx: int=0) -> Tuple[float, float]:
         """Returns world length of the branch, plus the length to the last branch point.
@@ -184,14 +233,10 @@ class Branch():
         parentRadius = 0
         if pointsWithRoot[0].isRoot() == False:
             parentRadius = pointsWithRoot[0].returnWorldRadius(self._parentTree._fullState())
-        x, y, z = self._parentTree.worldCoordPoints(pointsWithRoot)
+        edgeDistances = self._worldEdgeDistances(pointsWithRoot)
         lastBranchPoint = _lastPointWithChildren(pointsWithRoot)
-        totalLength, totalLengthToLastBranch = 0.0, 0.0
-        for i in range(len(x) - 1):
-            edgeDistance = util.deltaSz((x[i], y[i], z[i]), (x[i+1], y[i+1], z[i+1]))
-            totalLength += edgeDistance
-            if i < lastBranchPoint:
-                totalLengthToLastBranch += edgeDistance
+        totalLength = float(edgeDistances.sum())
+        totalLengthToLastBranch = float(edgeDistances[:max(0, lastBranchPoint)].sum())
         totalLength = totalLength-parentRadius
         return totalLength, totalLengthToLastBranch
 
@@ -200,19 +245,33 @@ class Branch():
 
         :returns: List of cumulative lengths, how far along the branch to get to each point."""
         pointsWithRoot = self.pointsWithParentIfExists()
-        x, y, z = self._parentTree.worldCoordPoints(pointsWithRoot)
-        cumulativeLength, lengths = 0.0, []
-        for i in range(len(x) - 1):
-            edgeDistance = util.deltaSz((x[i], y[i], z[i]), (x[i+1], y[i+1], z[i+1]))
-            cumulativeLength += edgeDistance
-            lengths.append(cumulativeLength)
-        return lengths
+        return np.cumsum(self._worldEdgeDistances(pointsWithRoot)).tolist()
+
+    def _worldEdgeDistances(self, points: List[Point]) -> np.ndarray:
+        """World distance between each consecutive pair of points."""
+        if len(points) < 2:
+            return np.zeros(0)
+        world = self._parentTree.worldCoordArray(points)
+        return np.linalg.norm(np.diff(world, axis=0), axis=1)
 
     def pointsWithParentIfExists(self) -> List[Point]:
         if self.parentPoint is not None:
             return [self.parentPoint] + self.points
         return self.points
 
+    def _indexedPositions(self) -> Dict[str, int]:
+        """Point ID -> index along the branch, built if needed."""
+        if self._pointPositions is None or len(self._pointPositions) != len(self.points):
+            self._pointPositions = {}
+            for idx, point in enumerate(self.points):
+                self._pointPositions.setdefault(point.id, idx)
+        return self._pointPositions
+
+    def _reindexPosition(self, oldID: str, newID: str) -> None:
+        """Point on this branch has changed ID."""
+        if self._pointPositions is not None and oldID in self._pointPositions:
+            self._pointPositions[newID] = self._pointPositions.pop(oldID)
+
 ### Utilities
 
 # Return the index of the last point with child branches, or -1 if not found.
@@ -5,44 +5,110 @@ from __future__ import annotations
 import attr
 import math
 import numpy as np
+import sys
 
-from typing import List, Optional, TYPE_CHECKING
+from typing import Any, Iterator, List, Optional, TYPE_CHECKING
 
 import pydynamo_brain.util as util
 from pydynamo_brain.util import SAVE_META, Point3D
 
+from .traversal import PRE_ORDER, iterPoints
+
 if TYPE_CHECKING:
     from .branch import Branch
-
-
-@attr.s
+    from .tree import Tree
+
+
+def _owningTree(point: Point) -> Optional[Tree]:
+    """Tree a point is in, if it can be found from the point's branches, or it is a tree's root."""
+    if point.parentBranch is not None:
+        return point.parentBranch._parentTree
+    if point._rootOfTree is not None:
+        return point._rootOfTree
+    for child in point.children:
+        if child._parentTree is not None:
+            return child._parentTree
+    return None
+
+def internID(value: Any) -> Any:
+    """Share one copy of each ID string, as the same IDs are repeated across every stack.
+
+    Also lets ID comparisons short-circuit on identity."""
+    return sys.intern(value) if type(value) is str else value
+
+def _onPointIDChange(point: Point, attribute: attr.Attribute, newID: str) -> str:
+    """Keeps the owning branch and tree indexes in sync when a point's ID is changed."""
+    newID = internID(newID)
+    branch = point.parentBranch
+    if branch is not None:
+        branch._reindexPosition(point.id, newID)
+        if branch._parentTree is not None:
+            branch._parentTree._reindexPoint(point, point.id, newID)
+    tree = _owningTree(point)
+    if tree is not None:
+        tree._markChanged()
+    return newID
+
+def _onPointDataChange(point: Point, attribute: attr.Attribute, value: Any) -> Any:
+    """Lets the owning tree know that data for one of its points has changed."""
+    tree = _owningTree(point)
+    if tree is not None:
+        tree._markChanged()
+    return value
+
+
+@attr.s(slots=True)
 class Point():
     """Node in the tree, a point in 3D space."""
 
-    id: str = attr.ib(metadata=SAVE_META)
+    id: str = attr.ib(metadata=SAVE_META, converter=internID, on_setattr=_onPointIDChange)
     """Identifier of point, can be shared across stacks."""
 
-    location: Point3D = attr.ib(metadata=SAVE_META)
+    location: Point3D = attr.ib(metadata=SAVE_META, on_setattr=_onPointDataChange)
     """Node position as an (x, y, z) tuple, in pixels."""
 
-    radius: Optional[float] = attr.ib(default=None, metadata=SAVE_META)
+    radius: Optional[float] = attr.ib(default=None, metadata=SAVE_META, on_setattr=_onPointDataChange)
     """(optional) radius of the point, in pixels."""
 
     parentBranch: Optional[Branch] = attr.ib(default=None, repr=False, eq=False, order=False)
     """Branch this point belongs to."""
 
-    annotation: str = attr.ib(default="", eq=False, order=False, metadata=SAVE_META)
+    annotation: str = attr.ib(default="", eq=False, order=False, metadata=SAVE_META, on_setattr=_onPointDataChange)
     """Text annotation for node."""
 
-    children: List[Branch] = attr.ib(default=attr.Factory(list))
+    children: List[Branch] = attr.ib(default=attr.Factory(list), on_setattr=_onPointDataChange)
     """Branches coming off the node."""
 
-    manuallyMarked: Optional[bool] = attr.ib(default=None, eq=False, order=False, metadata=SAVE_META)
+    manuallyMarked: Optional[bool] = attr.ib(default=None, eq=False, order=False, metadata=SAVE_META, on_setattr=_onPointDataChange)
     """Indicates which points have been marked to be revisited."""
 
     hilighted: Optional[bool] = attr.ib(default=None, eq=False, order=False, metadata=SAVE_META)
     """ NOTE: Hilighting has been removed, keep here for backwards compatibility."""
 
+    _rootOfTree: Optional[Tree] = attr.ib(default=None, init=False, repr=False, eq=False, order=False)
+    """Tree this point is the root of, as a root with no branches has no other way back to it."""
+
+    @classmethod
+    def fromSaved(cls, id: str, location: Point3D, radius: Optional[float]=None, annotation: Optional[str]="",
+        manuallyMarked: Optional[bool]=None, hilighted: Optional[bool]=None
+    ) -> Point:
+        """Same as the constructor, for a point not yet in any tree, but much faster for loading many.
+
+        The attrs constructor goes through the change hook dispatch for every field.
+        annotation may be None, as some saved files have null annotations that load back as-is."""
+        point = object.__new__(cls)
+        setField = object.__setattr__
+        setField(point, 'id', internID(id))
+        setField(point, 'location', location)
+        setField(point, 'radius', radius)
+        setField(point, 'parentBranch', None)
+        setField(point, 'annotation', annotation)
+        setField(point, 'children', [])
+        setField(point, 'manuallyMarked', manuallyMarked)
+        setField(point, 'hilighted', hilighted)
+        setField(point, '_rootOfTree', None)
+        return point
+
     def isRoot(self) -> bool:
         """Whether this point represents the root of the whole tree."""
         return self.parentBranch is None
@@ -102,17 +168,20 @@ class Point():
 
     def flattenSubtreePoints(self) -> List[Point]:
         """Return all points downstream from this point."""
-        if self.parentBranch is not None:
-            return self.parentBranch.flattenSubtreePoints(startIdx=self.indexInParent())
-        # Root point, needs special logic
-        points = [self]
-        for child in self.children:
-            points.extend(child.flattenSubtreePoints())
-        return points
+        return list(self.iterSubtree())
+
+    def iterSubtree(self, order: str=PRE_ORDER) -> Iterator[Point]:
+        """Lazily walk this point, later points in its branch, and everything branching off those.
+
+        :param order: traversal.PRE_ORDER (same order as flattenSubtreePoints) or traversal.POST_ORDER."""
+        if self.parentBranch is None:
+            # Root point, needs special logic
+            return iterPoints([self], order=order)
+        return iterPoints(self.parentBranch.points, self.indexInParent(), order=order)
 
     def subtreeContainsID(self, pointID:str) -> bool:
         """Whether the given point ID exists anywhere further down the tree."""
-        return pointID in [p.id for p in self.flattenSubtreePoints()]
+        return any(p.id == pointID for p in self.iterSubtree())
 
     def pathFromRoot(self) -> List[Point]:
         """Points in order to get from the root to this point."""
@@ -143,6 +212,14 @@ class Point():
         return ancestorRadius
 
     def longestDistanceToLeaf(self) -> float:
+        tree = _owningTree(self)
+        if tree is not None:
+            arrays = tree.arrays()
+            row = arrays.rowForID.get(self.id)
+            if row is not None and arrays.points[row] is self:
+                return float(tree.subtreeMetrics().longestDistanceToLeaf[row])
+
+        # Not connected to the tree, so walk the subtree instead.
         branchForTree = self.parentBranch
         if branchForTree is None and len(self.children) > 0:
             branchForTree = self.children[0]
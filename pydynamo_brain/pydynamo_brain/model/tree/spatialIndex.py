@@ -0,0 +1,83 @@
+from __future__ import annotations
+"""
+.. module:: tree
+"""
+import attr
+import numpy as np
+
+from scipy.spatial import cKDTree
+from typing import Dict, List, Optional, Tuple, TYPE_CHECKING
+
+from pydynamo_brain.util import Point3D
+
+if TYPE_CHECKING:
+    from .point import Point
+    from .treeArrays import TreeArrays
+
+@attr.s
+class SpatialIndex():
+    """KD-tree lookups of the points in a tree, in pixel and world space.
+
+    Obtain via Tree.spatialIndex(), which caches the result alongside Tree.arrays().
+    Each KD-tree is only built the first time it is needed."""
+
+    arrays: TreeArrays = attr.ib(repr=False)
+    """Columnar snapshot the index is built from."""
+
+    _pixelTree: Optional[cKDTree] = attr.ib(default=None, init=False, repr=False)
+    """KD-tree of all pixel locations."""
+
+    _worldTree: Optional[cKDTree] = attr.ib(default=None, init=False, repr=False)
+    """KD-tree of all world locations."""
+
+    _zBuckets: Optional[Dict[int, Tuple[np.ndarray, cKDTree]]] = attr.ib(default=None, init=False, repr=False)
+    """Rounded z plane -> (rows on that plane, KD-tree of their pixel locations)."""
+
+    def closestPoint(self, targetLocation: Point3D) -> Optional[Point]:
+        """Point closest to the target, in pixel space."""
+        if self._pixelTree is None:
+            self._pixelTree = cKDTree(self.arrays.locations)
+        return self._closest(self._pixelTree, self.arrays.locations, None, targetLocation)
+
+    def closestPointToWorldLocation(self, targetWorldLocation: Point3D) -> Optional[Point]:
+        """Point closest to the target, in world space."""
+        if self._worldTree is None:
+            self._worldTree = cKDTree(self.arrays.worldLocations)
+        return self._closest(self._worldTree, self.arrays.worldLocations, None, targetWorldLocation)
+
+    def closestPointInZPlane(self, targetLocation: Point3D) -> Optional[Point]:
+        """Point closest to the target in pixel space, out of those on the same z plane."""
+        bucket = self._zBucketsByPlane().get(round(targetLocation[2]))
+        if bucket is None:
+            return None
+        rows, kdTree = bucket
+        return self._closest(kdTree, self.arrays.locations[rows], rows, targetLocation)
+
+    def pointsInZPlane(self, z: float) -> List[Point]:
+        """All points on the same (rounded) z plane, in tree order."""
+        bucket = self._zBucketsByPlane().get(round(z))
+        if bucket is None:
+            return []
+        return [self.arrays.points[row] for row in bucket[0]]
+
+    def _zBucketsByPlane(self) -> Dict[int, Tuple[np.ndarray, cKDTree]]:
+        if self._zBuckets is None:
+            # np.round rounds half to even, the same as round() on a single value.
+            planes = np.round(self.arrays.locations[:, 2]).astype(np.int64)
+            self._zBuckets = {}
+            for plane in np.unique(planes):
+                rows = np.flatnonzero(planes == plane)
+                self._zBuckets[int(plane)] = (rows, cKDTree(self.arrays.locations[rows]))
+        return self._zBuckets
+
+    def _closest(self, kdTree: cKDTree, locations: np.ndarray, rows: Optional[np.ndarray], target: Point3D) -> Optional[Point]:
+        if len(locations) == 0:
+            return None
+        targetArr = np.array(target, dtype=np.float64)
+        closestDist, _ = kdTree.query(targetArr)
+        # Break ties by tree order, to match a scan over flattenPoints():
+        nearby = np.array(kdTree.query_ball_point(targetArr, closestDist * (1 + 1e-9) + 1e-12), dtype=np.int64)
+        nearbyDists = np.linalg.norm(locations[nearby] - targetArr, axis=1)
+        tied = nearby[nearbyDists == nearbyDists.min()]
+        idx = int(tied.min())
+        return self.arrays.points[idx if rows is None else int(rows[idx])]
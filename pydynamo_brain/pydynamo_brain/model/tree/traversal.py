@@ -0,0 +1,74 @@
+from __future__ import annotations
+"""
+.. module:: tree
+"""
+from typing import Callable, Iterator, List, Optional, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .branch import Branch
+    from .point import Point
+
+# Walks use an explicit stack of (list of points, index along it), so they neither
+# recurse nor copy point lists, and only hold one entry per pending branch.
+
+PRE_ORDER = 'pre'
+"""Each point before everything downstream of it, matching Tree.flattenPoints()."""
+POST_ORDER = 'post'
+"""Each point after everything downstream of it."""
+
+def iterPoints(points: List[Point], startIdx: int=0, order: str=PRE_ORDER) -> Iterator[Point]:
+    """Lazily walk points[startIdx:] plus all branches coming off them.
+
+    :param order: PRE_ORDER or POST_ORDER."""
+    if order == PRE_ORDER:
+        return _iterPreOrder(points, startIdx)
+    elif order == POST_ORDER:
+        return _iterPostOrder(points, startIdx)
+    raise ValueError("Unknown traversal order '%s'" % order)
+
+def iterBranches(points: List[Point], startIdx: int=0,
+    descendInto: Optional[Callable[[Branch], bool]]=None
+) -> Iterator[Branch]:
+    """Lazily walk the branches coming off points[startIdx:], and all their descendants.
+
+    Each branch comes before its child branches, which are in order along the branch.
+
+    :param descendInto: Optional filter, called with each branch once the caller has moved
+        on from it. If it returns False, branches coming off that branch are skipped."""
+    toVisit: List[Branch] = []
+    for point in reversed(points[startIdx:]):
+        toVisit.extend(reversed(point.children))
+    while len(toVisit) > 0:
+        branch = toVisit.pop()
+        yield branch
+        if descendInto is None or descendInto(branch):
+            for point in reversed(branch.points):
+                toVisit.extend(reversed(point.children))
+
+def _iterPreOrder(points: List[Point], startIdx: int) -> Iterator[Point]:
+    toVisit: List[Tuple[List[Point], int]] = [(points, startIdx)]
+    while len(toVisit) > 0:
+        pointsAt, idx = toVisit.pop()
+        if idx >= len(pointsAt):
+            continue
+        point = pointsAt[idx]
+        yield point
+        # Rest of this branch is visited after all the child branches:
+        toVisit.append((pointsAt, idx + 1))
+        for child in reversed(point.children):
+            toVisit.append((child.points, 0))
+
+def _iterPostOrder(points: List[Point], startIdx: int) -> Iterator[Point]:
+    # Third value is whether everything downstream has already been queued.
+    toVisit: List[Tuple[List[Point], int, bool]] = [(points, startIdx, False)]
+    while len(toVisit) > 0:
+        pointsAt, idx, expanded = toVisit.pop()
+        if idx >= len(pointsAt):
+            continue
+        if expanded:
+            yield pointsAt[idx]
+            continue
+        toVisit.append((pointsAt, idx, True))
+        toVisit.append((pointsAt, idx + 1, False))
+        for child in reversed(pointsAt[idx].children):
+            toVisit.append((child.points, 0, False))
@@ -4,30 +4,46 @@ from __future__ import annotations
 .. module:: tree
 """
 import attr
+import copy
 import numpy as np
 
-from typing import List
-
 import pydynamo_brain.util as util
 from pydynamo_brain.util import SAVE_META, Point3D
 
-from typing import Callable, Dict, List, Optional, Tuple, TYPE_CHECKING
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, TYPE_CHECKING
 
+from .ancestorIndex import AncestorIndex, buildAncestorIndex
 from .branch import Branch
 from .point import Point
+from .spatialIndex import SpatialIndex
+from .traversal import PRE_ORDER, iterBranches, iterPoints
 from .transform import Transform
+from .treeArrays import SubtreeMetrics, TreeArrays, buildSubtreeMetrics, buildTreeArrays
 
 if TYPE_CHECKING:
     from pydynamo_brain.model import FullState, UIState
 
+def _onStructureReplaced(tree: Tree, attribute: attr.Attribute, value: Any) -> Any:
+    """Wholesale replacement of tree structure invalidates any indexes."""
+    if attribute.name == 'rootPoint':
+        oldRoot = tree.__dict__.get('rootPoint')
+        if oldRoot is not None and oldRoot._rootOfTree is tree:
+            oldRoot._rootOfTree = None
+        if value is not None:
+            value._rootOfTree = tree
+    tree._invalidateIndexes()
+    tree._markChanged()
+    return value
+
+
 @attr.s
 class Tree():
     """3D Tree structure."""
 
-    rootPoint: Optional[Point] = attr.ib(default=None, metadata=SAVE_META)
+    rootPoint: Optional[Point] = attr.ib(default=None, metadata=SAVE_META, on_setattr=_onStructureReplaced)
     """Soma, initial start of the main branch."""
 
-    branches: List[Branch] = attr.ib(default=attr.Factory(list), metadata=SAVE_META)
+    branches: List[Branch] = attr.ib(default=attr.Factory(list), metadata=SAVE_META, on_setattr=_onStructureReplaced)
     """All branches making up this dendrite tree."""
 
     transform: Transform = attr.ib(default=attr.Factory(Transform), metadata=SAVE_META)
@@ -36,20 +52,150 @@ class Tree():
     _parentState: Optional[UIState] = attr.ib(default=None, repr=False, eq=False, order=False)
     """UI State this belongs to."""
 
-    # HACK - make faster, index points by ID
+    _pointIndex: Optional[Dict[str, Point]] = attr.ib(default=None, init=False, repr=False, eq=False, order=False)
+    """Lazily built map of point ID -> point, for all non-root points on the tree's branches."""
+
+    _branchIndex: Optional[Dict[str, Branch]] = attr.ib(default=None, init=False, repr=False, eq=False, order=False)
+    """Lazily built map of branch ID -> branch, for all branches in the tree."""
+
+    _branchPositions: Optional[Dict[int, int]] = attr.ib(default=None, init=False, repr=False, eq=False, order=False)
+    """Lazily built map of branch object identity -> index within branches."""
+
+    _version: int = attr.ib(default=0, init=False, repr=False, eq=False, order=False)
+    """Incremented every time the tree or any of its points are changed."""
+
+    _arraysCache: Optional[TreeArrays] = attr.ib(default=None, init=False, repr=False, eq=False, order=False)
+    """Columnar snapshot of the tree, valid while the version is unchanged."""
+
+    _arraysVersion: int = attr.ib(default=-1, init=False, repr=False, eq=False, order=False)
+    """Tree version the columnar snapshot was built at."""
+
+    _metricsCache: Optional[Tuple[TreeArrays, SubtreeMetrics]] = attr.ib(default=None, init=False, repr=False, eq=False, order=False)
+    """Subtree metrics, along with the columnar snapshot they were calculated from."""
+
+    _ancestorCache: Optional[Tuple[TreeArrays, AncestorIndex]] = attr.ib(default=None, init=False, repr=False, eq=False, order=False)
+    """Lowest common ancestor index, along with the columnar snapshot it was built from."""
+
+    _spatialCache: Optional[SpatialIndex] = attr.ib(default=None, init=False, repr=False, eq=False, order=False)
+    """KD-tree index of point locations, valid while built from the current columnar snapshot."""
+
+    _pendingLoad: Optional[Callable[[Tree], None]] = attr.ib(default=None, init=False, repr=False, eq=False, order=False)
+    """For lazily loaded trees, fills in rootPoint and branches on first access. None once loaded."""
+
+    def __attrs_post_init__(self) -> None:
+        # on_setattr hooks don't run in the constructor:
+        if self.rootPoint is not None:
+            self.rootPoint._rootOfTree = self
+
+    @classmethod
+    def lazy(cls, loader: Callable[[Tree], None], transform: Transform) -> Tree:
+        """Tree whose points and branches are only loaded when first used.
+
+        loader(tree) must set tree.rootPoint and tree.branches, and can be called again for copies."""
+        tree = cls(transform=transform)
+        del tree.__dict__['rootPoint']
+        del tree.__dict__['branches']
+        tree._pendingLoad = loader
+        return tree
+
+    def isLoaded(self) -> bool:
+        return self._pendingLoad is None
+
+    def __getattr__(self, name: str) -> Any:
+        # Only called for missing attributes, i.e. the structure of a tree that isn't loaded yet.
+        loader = self.__dict__.get('_pendingLoad')
+        if loader is None or name not in ('rootPoint', 'branches'):
+            raise AttributeError("'%s' object has no attribute '%s'" % (type(self).__name__, name))
+        # Loading isn't an edit, so don't let the owning state know:
+        parentState, self._parentState = self._parentState, None
+        try:
+            self._pendingLoad = None
+            loader(self)
+        except:
+            self.__dict__.pop('rootPoint', None)
+            self.__dict__.pop('branches', None)
+            self._pendingLoad = loader
+            raise
+        finally:
+            self._parentState = parentState
+        return self.__dict__[name]
+
+    def __getstate__(self) -> Dict[str, Any]:
+        self.rootPoint # Make sure lazy trees are loaded before copying.
+        # Indexes are cheap to rebuild, so don't copy them into history snapshots.
+        state = self.__dict__.copy()
+        state['_pointIndex'] = None
+        state['_branchIndex'] = None
+        state['_branchPositions'] = None
+        state['_arraysCache'] = None
+        state['_metricsCache'] = None
+        state['_ancestorCache'] = None
+        state['_spatialCache'] = None
+        return state
+
+    def arrays(self) -> TreeArrays:
+        """Columnar (struct-of-arrays) snapshot of all points in the tree.
+
+        The result is cached until the tree is next changed, or the project pixel sizes change."""
+        pixelSizes = tuple(self._fullState().projectOptions.pixelSizes)
+        cached = self._arraysCache
+        if cached is None or self._arraysVersion != self._version or cached.pixelSizes != pixelSizes:
+            cached = buildTreeArrays(self, pixelSizes)
+            self._arraysCache, self._arraysVersion = cached, self._version
+        return cached
+
+    def subtreeMetrics(self) -> SubtreeMetrics:
+        """Longest distance to leaf, path length and spatial distance from the soma for all points.
+
+        Indexed by the rows of arrays(), and cached for as long as that is."""
+        arrays = self.arrays()
+        cached = self._metricsCache
+        if cached is None or cached[0] is not arrays:
+            cached = (arrays, buildSubtreeMetrics(arrays))
+            self._metricsCache = cached
+        return cached[1]
+
+    def ancestorIndex(self) -> AncestorIndex:
+        """Index for finding lowest common ancestors and tree distances between points.
+
+        Indexed by the rows of arrays(), and cached for as long as that is."""
+        arrays = self.arrays()
+        cached = self._ancestorCache
+        if cached is None or cached[0] is not arrays:
+            cached = (arrays, buildAncestorIndex(arrays, self.subtreeMetrics()))
+            self._ancestorCache = cached
+        return cached[1]
+
+    def spatialIndex(self) -> SpatialIndex:
+        """Index for nearest point lookups, in pixel or world space.
+
+        Rebuilt lazily after the tree changes, the next time it's needed."""
+        arrays = self.arrays()
+        if self._spatialCache is None or self._spatialCache.arrays is not arrays:
+            self._spatialCache = SpatialIndex(arrays)
+        return self._spatialCache
+
     def getPointByID(self, pointID: str, includeDisconnected: bool=False) -> Optional[Point]:
         """Given the ID of a point, find the point object that matches."""
-        for point in self.flattenPoints(includeDisconnected):
-            if point.id == pointID:
-                return point
+        if self.rootPoint is not None and self.rootPoint.id == pointID:
+            return self.rootPoint
+        point = self._indexedPoints().get(pointID)
+        if point is not None and not self._isIndexedPoint(point, pointID):
+            # Index is out of date, so rebuild and try again.
+            self._invalidateIndexes()
+            point = self._indexedPoints().get(pointID)
+        if point is None or includeDisconnected or self._isConnected(point):
+            return point
         return None
 
     def getBranchByID(self, branchID: str) -> Optional[Branch]:
         """Given the ID of a branch, find the branch object that matches."""
-        for branch in self.branches:
-            if branch.id == branchID:
-                return branch
-        return None
+        branch = self._indexedBranches().get(branchID)
+        if branch is not None and branch.id != branchID:
+            # Index is out of date, so rebuild and try again.
+            self._invalidateIndexes()
+            branch = self._indexedBranches().get(branchID)
+        return branch
 
     def addBranch(self, branch: Branch) -> int:
         """Adds a branch to the tree.
@@ -57,6 +203,13 @@ class Tree():
         :returns: Index of branch within the tree."""
         self.branches.append(branch)
         branch._parentTree = self
+        if self._branchIndex is not None:
+            self._branchIndex[branch.id] = branch
+        if self._branchPositions is not None:
+            self._branchPositions.setdefault(id(branch), len(self.branches) - 1)
+        for point in branch.points:
+            self._indexPoint(point)
+        self._markChanged()
         return len(self.branches) - 1
 
     def removeBranch(self, branch: Branch) -> None:
@@ -70,6 +223,23 @@ class Tree():
         if branch.parentPoint is not None:
             branch.parentPoint.removeChildrenByID(branch.id)
         self.branches.remove(branch)
+        self._branchPositions = None
+        self._reindexBranch(branch, branch.id, None)
+        self._markChanged()
+
+    def indexForBranch(self, branch: Branch) -> int:
+        """Ordinal number of a branch within this tree.
+
+        :raises ValueError: if the branch is not in the tree."""
+        positions = self._indexedBranchPositions()
+        idx = positions.get(id(branch), -1)
+        if idx < 0 or idx >= len(self.branches) or self.branches[idx] is not branch:
+            # Branches were changed without going through the tree, so rebuild.
+            self._branchPositions = None
+            idx = self._indexedBranchPositions().get(id(branch), -1)
+        if idx < 0:
+            raise ValueError("Branch %s is not in the tree" % branch.id)
+        return idx
 
     def removePointByID(self, pointID: str) -> Optional[Point]:
         """Removes a single point from the tree, identified by ID."""
@@ -138,7 +308,7 @@ class Tree():
         assert pointToMove is not None, "Trying to move an unknown point ID"
         delta = util.locationMinus(newLocation, pointToMove.location)
         if downstream:
-            self._recursiveMovePointDelta(pointToMove, delta)
+            self.translatePoints(self.downstreamPoints(pointToMove), delta)
         else:
             # Non-recursive, so just move this one point:
             pointToMove.location = newLocation
@@ -148,13 +318,30 @@ class Tree():
         if self.rootPoint is None:
             return []
         if not includeDisconnected:
-            return self.rootPoint.flattenSubtreePoints()
+            return list(self.iterPoints())
         # Use this version when the parent/child tree structure hasn't been set up:
         points = [self.rootPoint]
         for b in self.branches:
             points.extend(b.points)
         return points
 
+    def iterPoints(self, order: str=PRE_ORDER) -> Iterator[Point]:
+        """Lazily walk all points connected to the root.
+
+        :param order: traversal.PRE_ORDER (same order as flattenPoints) or traversal.POST_ORDER."""
+        if self.rootPoint is None:
+            return iter([])
+        return iterPoints([self.rootPoint], order=order)
+
+    def iterBranches(self, descendInto: Optional[Callable[[Branch], bool]]=None) -> Iterator[Branch]:
+        """Lazily walk all branches connected to the root, each before the branches coming off it.
+
+        :param descendInto: Optional filter, called with each branch once the caller has moved
+            on from it. If it returns False, branches coming off that branch are skipped."""
+        if self.rootPoint is None:
+            return iter([])
+        return iterBranches([self.rootPoint], descendInto=descendInto)
+
     def nextPointFilteredWithCount(self,
             sourcePoint: Point, filterFunc: Callable[[Point], bool], delta:int
     ) -> Tuple[Optional[Point], int]:
@@ -213,33 +400,47 @@ class Tree():
         if point is None:
             return
 
-        # Step 1: find the longest child, see if it's longer than the continuation
-        nextPoint = point.nextPointInBranch(noWrap=True)
-        nextDist = None if nextPoint is None else nextPoint.longestDistanceToLeaf()
-        longestContinuation = (None, nextDist)
-        for i, childBranch in enumerate(point.children):
-            if len(childBranch.points) > 0:
-                childPoint = childBranch.points[0]
-                childDist = childPoint.longestDistanceToLeaf()
-                if nextDist is None or nextDist < childDist:
-                    nextPoint, nextDist = childPoint, childDist
-        if nextDist is not None:
-            self.continueParentBranchIfFirst(nextPoint)
-
-        # Step 2: Normalize by sorting branches by remaining length:
+        # Reassigning branches doesn't change the shape of the tree, so calculate all distances once.
+        arrays = self.arrays()
+        longestDistances = self.subtreeMetrics().longestDistanceToLeaf.tolist()
+        distToLeaf = {id(p): dist for p, dist in zip(arrays.points, longestDistances)}
+
+        def _distToLeaf(p: Point) -> float:
+            dist = distToLeaf.get(id(p))
+            return p.longestDistanceToLeaf() if dist is None else dist
+
         def _branchDistRemaining(branch: Branch) -> float:
             if len(branch.points) > 0:
-                return -branch.points[0].longestDistanceToLeaf()
+                return -_distToLeaf(branch.points[0])
             return 0.0
-        point.children.sort(key=_branchDistRemaining)
 
-        # Step 3: Recurse down tree:
-        nextPoint = point.nextPointInBranch(noWrap=True)
-        if nextPoint is not None:
-            self.updateAllPrimaryBranches(nextPoint)
-        for childBranch in point.children:
-            if len(childBranch.points) > 0:
-                self.updateAllPrimaryBranches(childBranch.points[0])
+        toVisit = [point]
+        while len(toVisit) > 0:
+            point = toVisit.pop()
+
+            # Step 1: find the longest child, see if it's longer than the continuation
+            nextPoint = point.nextPointInBranch(noWrap=True)
+            nextDist = None if nextPoint is None else _distToLeaf(nextPoint)
+            for childBranch in point.children:
+                if len(childBranch.points) > 0:
+                    childPoint = childBranch.points[0]
+                    childDist = _distToLeaf(childPoint)
+                    if nextDist is None or nextDist < childDist:
+                        nextPoint, nextDist = childPoint, childDist
+            if nextDist is not None:
+                self.continueParentBranchIfFirst(nextPoint)
+
+            # Step 2: Normalize by sorting branches by remaining length:
+            point.children.sort(key=_branchDistRemaining)
+
+            # Step 3: Continue down the tree, continuation first then children in order:
+            for childBranch in reversed(point.children):
+                if len(childBranch.points) > 0:
+                    toVisit.append(childBranch.points[0])
+            nextPoint = point.nextPointInBranch(noWrap=True)
+            if nextPoint is not None:
+                toVisit.append(nextPoint)
+        self._markChanged()
 
     def updateAllBranchesMinimalAngle(self, point: Optional[Point]=None) -> None:
         """For all branching points, continue the parent branch with small angle at bifurications"""
@@ -307,12 +508,10 @@ class Tree():
 
     def spatialAndTreeRadius(self) -> Tuple[float, float]:
         """External and internal longest distance to points from soma."""
-        maxS, maxT = 0.0, 0.0
-        if self.rootPoint is not None:
-            for point in self.flattenPoints():
-                pS, pT = self.spatialAndTreeDist(self.rootPoint, point)
-                maxS, maxT = max(maxS, pS), max(maxT, pT)
-        return maxS, maxT
+        if self.rootPoint is None:
+            return 0.0, 0.0
+        metrics = self.subtreeMetrics()
+        return float(metrics.spatialDistFromRoot.max()), float(metrics.pathLengthFromRoot.max())
 
     def closestPointTo(self, targetLocation: Point3D, zFilter: bool=False) -> Optional[Point]:
         """Given a position in the volume, find the point closest to it in image space.
@@ -320,92 +519,150 @@ class Tree():
         :param targetLocation: (x, y, z) location tuple.
         :param zFilter: If true, only items on the same zStack are considered.
         :returns: Point object of point closest to the target location."""
-        closestDist, closestPoint = None, None
-        for point in self.flattenPoints():
-            if zFilter and round(point.location[2]) != round(targetLocation[2]):
-                continue
-            dist = util.deltaSz(targetLocation, point.location)
-            if closestDist is None or dist < closestDist:
-                closestDist, closestPoint = dist, point
-        return closestPoint
+        if self._parentState is None or self._parentState._parent is None:
+            # Not yet part of a project, so scan all the points.
+            closestDist, closestPoint = None, None
+            for point in self.flattenPoints():
+                if zFilter and round(point.location[2]) != round(targetLocation[2]):
+                    continue
+                dist = util.deltaSz(targetLocation, point.location)
+                if closestDist is None or dist < closestDist:
+                    closestDist, closestPoint = dist, point
+            return closestPoint
+
+        if zFilter:
+            return self.spatialIndex().closestPointInZPlane(targetLocation)
+        return self.spatialIndex().closestPoint(targetLocation)
 
     def closestPointToWorldLocation(self, targetWorldLocation: Point3D) -> Optional[Point]:
         """Given a position in world space, find the point closest to it in world space.
 
         :param targetWorldLocation: (x, y, z) location tuple.
         :returns: Point object of point closest to the target location."""
-        closestDist, closestPoint = None, None
-        allPoints = self.flattenPoints()
-        allX, allY, allZ = self.worldCoordPoints(allPoints)
-        for point, loc in zip(allPoints, zip(allX, allY, allZ)):
-            dist = util.deltaSz(targetWorldLocation, loc)
-            if closestDist is None or dist < closestDist:
-                closestDist, closestPoint = dist, point
-        return closestPoint
+        return self.spatialIndex().closestPointToWorldLocation(targetWorldLocation)
+
+    def pointsInZPlane(self, z: float) -> List[Point]:
+        """All points in the tree whose location rounds to the same z plane."""
+        return self.spatialIndex().pointsInZPlane(z)
+
+    def worldCoordArray(self, points: Optional[List[Point]] = None) -> np.ndarray:
+        """Convert image pixel (x, y, z) to real-world positions, all in one go.
+
+        :param points: Points (or raw pixel (x, y, z) tuples) to convert.
+            If not provided, returns all points in the tree, in flattenPoints() order,
+            using the cached coordinates from arrays().
+        :returns: (N, 3) float array of world (x, y, z) positions."""
+        if points is None:
+            return self.arrays().worldLocations
+
+        # Note: For now, tree-specific transforms are unsupported!
+        globalScale = np.array(self._fullState().projectOptions.pixelSizes, dtype=np.float64)
+        locations = [p.location if hasattr(p, 'location') else p for p in points]
+        return np.array(locations, dtype=np.float64).reshape((-1, 3)) * globalScale
 
     def worldCoordPoints(self, points: List[Point]) -> Tuple[List[float], List[float], List[float]]:
         """Convert image pixel (x, y, z) to a real-world (x, y, z) position."""
-        x: List[float] = []
-        y: List[float] = []
-        z: List[float] = []
-
-        globalScale = self._fullState().projectOptions.pixelSizes
-        for p in points:
-            # POIUY: support calling with list of locations?
-            #pAt = p
-            #if hasattr(p, 'location'):
-            pAt = p.location
-
-            # Note: For now, tree-specific transforms are unsupported!
-            #pAt = np.matmul(np.array(self.transform.rotation), np.array(pAt).T).T
-            #pAt = (pAt + np.array(self.transform.translation)) * np.array(self.transform.scale)
-            pAt = np.array(pAt) * globalScale
-            x.append(pAt[0])
-            y.append(pAt[1])
-            z.append(pAt[2])
-        return x, y, z
+        world = self.worldCoordArray(points)
+        return world[:, 0].tolist(), world[:, 1].tolist(), world[:, 2].tolist()
 
     def spatialDist(self, p1: Point, p2: Point) -> float:
         """Given two points in the tree, return the 3D spatial distance"""
-        x, y, z = self.worldCoordPoints([p1, p2])
-        p1Location = (x[0], y[0], z[0])
-        p2Location = (x[1], y[1], z[1])
-        return util.deltaSz(p1Location, p2Location)
+        world = self.worldCoordArray([p1, p2])
+        return float(np.linalg.norm(world[1] - world[0]))
 
     def spatialAndTreeDist(self, p1: Point, p2: Point) -> Tuple[float, float]:
         """Given two points in the tree, return both the 3D spatial distance,
         as well as how far to travel along the tree."""
+        rows = self._connectedRows([p1, p2])
+        if rows is not None:
+            treeDist = float(self.ancestorIndex().treeDistances(rows[:1], rows[1:])[0])
+            return self.spatialDist(p1, p2), treeDist
+
+        # Not connected to the tree, so compare the paths from the root instead:
         path1, path2 = p1.pathFromRoot(), p2.pathFromRoot()
         lastMatch = 0
         while lastMatch < len(path1) and lastMatch < len(path2) and path1[lastMatch].id == path2[lastMatch].id:
             lastMatch += 1
         lastMatch -= 1
-        path1X, path1Y, path1Z = self.worldCoordPoints(path1[lastMatch:])
-        path2X, path2Y, path2Z = self.worldCoordPoints(path2[lastMatch:])
         treeDist = 0.0
-        for i in range(len(path1X) - 1):
-            pA = (path1X[ i ], path1Y[ i ], path1Z[ i ])
-            pB = (path1X[i+1], path1Y[i+1], path1Z[i+1])
-            treeDist += util.deltaSz(pA, pB)
-        for i in range(len(path2X) - 1):
-            pA = (path2X[ i ], path2Y[ i ], path2Z[ i ])
-            pB = (path2X[i+1], path2Y[i+1], path2Z[i+1])
-            treeDist += util.deltaSz(pA, pB)
+        for path in [path1[lastMatch:], path2[lastMatch:]]:
+            if len(path) > 1:
+                world = self.worldCoordArray(path)
+                treeDist += float(np.linalg.norm(np.diff(world, axis=0), axis=1).sum())
         return self.spatialDist(p1, p2), treeDist
 
-    def _recursiveMovePointDelta(self, point: Point, delta: Point3D) -> None:
-        """Recursively move a point, plus all its children and later neighbours."""
-        point.location = util.locationPlus(point.location, delta)
-        # First, move any branches coming off this point, by moving their first point
-        for branch in self.branches:
-            if branch.parentPoint is not None and branch.parentPoint.id == point.id and len(branch.points) > 0:
-                self._recursiveMovePointDelta(branch.points[0], delta)
-        # Next, move the next point on this branch (which will recursively do likewise...)
-        if point.parentBranch is not None:
-            nextIdx = point.parentBranch.indexForPoint(point) + 1
-            assert nextIdx > 0, "Moving a point on a branch that doesn't know the point is there?"
-            if nextIdx < len(point.parentBranch.points):
-                self._recursiveMovePointDelta(point.parentBranch.points[nextIdx], delta)
+    def treeDistances(self, pointsA: List[Point], pointsB: List[Point]) -> np.ndarray:
+        """World distance travelled along the tree between each pointsA[i] and pointsB[i].
+
+        :raises ValueError: if any point is not connected to the tree."""
+        if len(pointsA) != len(pointsB):
+            raise ValueError("Need the same number of points on each side, got %d and %d" % (len(pointsA), len(pointsB)))
+        return self.ancestorIndex().treeDistances(self._requireConnectedRows(pointsA), self._requireConnectedRows(pointsB))
+
+    def treeDistanceMatrix(self, pointsA: List[Point], pointsB: Optional[List[Point]]=None) -> np.ndarray:
+        """World distances travelled along the tree between every pair of points.
+
+        :param pointsB: Points for the matrix columns, defaults to the same as pointsA.
+        :returns: (len(pointsA), len(pointsB)) array of distances.
+        :raises ValueError: if any point is not connected to the tree."""
+        rowsA = self._requireConnectedRows(pointsA)
+        rowsB = rowsA if pointsB is None else self._requireConnectedRows(pointsB)
+        return self.ancestorIndex().treeDistanceMatrix(rowsA, rowsB)
+
+    def _connectedRows(self, points: List[Point]) -> Optional[np.ndarray]:
+        """Rows within arrays() for each point, or None if any aren't connected to the tree."""
+        arrays = self.arrays()
+        rows = []
+        for point in points:
+            row = arrays.rowForID.get(point.id)
+            if row is None or arrays.points[row] is not point:
+                return None
+            rows.append(row)
+        return np.array(rows, dtype=np.int64)
+
+    def _requireConnectedRows(self, points: List[Point]) -> np.ndarray:
+        rows = self._connectedRows(points)
+        if rows is None:
+            raise ValueError("All points must be connected to the tree")
+        return rows
+
+    def downstreamPoints(self, point: Point) -> List[Point]:
+        """The given point, all later points on its branch, and everything branching off those."""
+        if point.parentBranch is None:
+            toVisit = [[point]]
+        else:
+            toVisit = [point.parentBranch.points[point.indexInParent():]]
+        result: List[Point] = []
+        while len(toVisit) > 0:
+            for pointAt in toVisit.pop():
+                result.append(pointAt)
+                toVisit.extend(child.points for child in pointAt.children)
+        return result
+
+    def translatePoints(self, points: List[Point], delta: Point3D) -> None:
+        """Move all the given points by the same (x, y, z) offset, in one go."""
+        if len(points) == 0:
+            return
+        locations = np.array([p.location for p in points], dtype=np.float64) + np.array(delta, dtype=np.float64)
+        for point, location in zip(points, locations.tolist()):
+            # Bypass the per-point change hook, the tree is marked as changed once below.
+            object.__setattr__(point, 'location', tuple(location))
+        self._markChanged()
+
+    def detachedCopy(self) -> Tree:
+        """Deep copy of only this tree, without the UI state (and everything else) it links to.
+
+        The copy keeps the same version, so it can be matched up with history records."""
+        loader = self._pendingLoad
+        if loader is not None:
+            # Nothing loaded can have been changed, so the copy can load its own:
+            copied = Tree.lazy(loader, copy.deepcopy(self.transform))
+            copied._version = self._version
+            return copied
+        # Map the parent state to None, so deepcopy doesn't follow it:
+        copied = copy.deepcopy(self, {id(self._parentState): None})
+        copied._relinkParents()
+        return copied
 
     def clearAndCopyFrom(self, otherTree: Tree, idMaker: FullState) -> None:
         pointMap: Dict[str, Point] = {}
@@ -429,6 +686,101 @@ class Tree():
                 else:
                     newBranch.reparentTo = pointMap[oldBranch.reparentTo.id]
 
+    def _indexedPoints(self) -> Dict[str, Point]:
+        """ID -> Point map for all points on the tree's branches, built if needed."""
+        if self._pointIndex is None:
+            self._pointIndex = {}
+            for branch in self.branches:
+                for point in branch.points:
+                    self._pointIndex.setdefault(point.id, point)
+        return self._pointIndex
+
+    def _indexedBranches(self) -> Dict[str, Branch]:
+        """ID -> Branch map for all branches in the tree, built if needed."""
+        if self._branchIndex is None:
+            self._branchIndex = {}
+            for branch in self.branches:
+                self._branchIndex.setdefault(branch.id, branch)
+        return self._branchIndex
+
+    def _indexedBranchPositions(self) -> Dict[int, int]:
+        """Branch object identity -> index within branches, built if needed."""
+        if self._branchPositions is None:
+            self._branchPositions = {}
+            for idx, branch in enumerate(self.branches):
+                self._branchPositions.setdefault(id(branch), idx)
+        return self._branchPositions
+
+    def _relinkParents(self) -> None:
+        """Point every branch and point in the tree back at their owners."""
+        if self.rootPoint is not None:
+            self.rootPoint._rootOfTree = self
+        for branch in self.branches:
+            branch._parentTree = self
+            for point in branch.points:
+                point.parentBranch = branch
+        for point in self.iterPoints():
+            for child in point.children:
+                child.parentPoint = point
+
+    def _markChanged(self) -> None:
+        """Something in the tree has changed, so cached snapshots are out of date."""
+        self._version += 1
+        uiState = self._parentState
+        if uiState is not None and uiState._parent is not None:
+            uiState._parent.markEdited()
+
+    def _invalidateIndexes(self) -> None:
+        """Drop the ID and position indexes, they will be rebuilt on next lookup."""
+        self._pointIndex = None
+        self._branchIndex = None
+        self._branchPositions = None
+
+    def _indexPoint(self, point: Point) -> None:
+        """Point has been added to a branch in this tree."""
+        if self._pointIndex is not None:
+            self._pointIndex[point.id] = point
+
+    def _unindexPoint(self, point: Point) -> None:
+        """Point has been removed from a branch in this tree."""
+        self._reindexPoint(point, point.id, None)
+
+    def _reindexPoint(self, point: Point, oldID: str, newID: Optional[str]) -> None:
+        """Point in this tree has changed ID (or been removed, if newID is None)."""
+        if self._pointIndex is None:
+            return
+        if self._pointIndex.get(oldID) is point:
+            del self._pointIndex[oldID]
+        if newID is not None:
+            self._pointIndex[newID] = point
+
+    def _reindexBranch(self, branch: Branch, oldID: str, newID: Optional[str]) -> None:
+        """Branch in this tree has changed ID (or been removed, if newID is None)."""
+        if self._branchIndex is None:
+            return
+        if self._branchIndex.get(oldID) is branch:
+            del self._branchIndex[oldID]
+        if newID is not None:
+            self._branchIndex[newID] = branch
+
+    def _isIndexedPoint(self, point: Point, pointID: str) -> bool:
+        """Sanity check that an indexed point is still in this tree with the right ID."""
+        return point.id == pointID and \
+            point.parentBranch is not None and point.parentBranch._parentTree is self
+
+    def _isConnected(self, point: Point) -> bool:
+        """Whether a point can be reached by walking down the tree from the root."""
+        stepsLeft = len(self.branches)
+        while point is not self.rootPoint:
+            branch = point.parentBranch
+            if branch is None or stepsLeft == 0:
+                return False
+            parent = branch.reparentTo or branch.parentPoint
+            if parent is None or not any(child is branch for child in parent.children):
+                return False
+            point, stepsLeft = parent, stepsLeft - 1
+        return True
+
     def _fullState(self) -> FullState:
         """
         Utility to return the non-none fullstate object.
@@ -464,21 +816,27 @@ def _cloneBranch(branch: Branch, idMaker: FullState, pointMap: Dict[str, Point])
 def printPoint(tree: Tree, point: Optional[Point], pad: str="", isFirst: bool=False) -> None:
     if point is None:
         return
-    print (pad + ("-> " if isFirst else "   ") + str(point))
-    pad = pad + "   "
-    for branch in point.children:
-        if branch.parentPoint == point:
-            printBranch(tree, branch, pad)
+    _printAll([(point, pad, isFirst)])
 
 def printBranch(tree: Tree, branch: Optional[Branch], pad:str="") -> None:
     if branch is None:
         return
-    if len(branch.points) > 0 and branch.points[0] == branch.parentPoint:
-        print ("BRANCH IS OWN PARENT? :(")
-        return
-    print (pad + "-> Branch " + branch.id + " = ")
-    for point in branch.points:
-        printPoint(tree, point, pad)
+    _printAll([(branch, pad, False)])
+
+# Print points and branches from a stack of (point or branch, padding, isFirst) to visit.
+def _printAll(toPrint: List[Tuple[Any, str, bool]]) -> None:
+    while len(toPrint) > 0:
+        item, pad, isFirst = toPrint.pop()
+        if isinstance(item, Branch):
+            if len(item.points) > 0 and item.points[0] is item.parentPoint:
+                print ("BRANCH IS OWN PARENT? :(")
+                continue
+            print (pad + "-> Branch " + item.id + " = ")
+            toPrint.extend((point, pad, False) for point in reversed(item.points))
+        else:
+            print (pad + ("-> " if isFirst else "   ") + str(item))
+            childPad = pad + "   "
+            toPrint.extend((branch, childPad, False) for branch in reversed(item.children) if branch.parentPoint is item)
 
 def printTree(tree: Tree) -> None:
     printPoint(tree, tree.rootPoint)
@@ -0,0 +1,197 @@
+from __future__ import annotations
+"""
+.. module:: tree
+"""
+import attr
+import numpy as np
+
+from typing import Dict, List, Sequence, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .point import Point
+    from .tree import Tree
+
+# Bits set in TreeArrays.annotationFlags, one per point:
+FLAG_ANNOTATED = 1 << 0
+"""Point has any non-empty annotation."""
+FLAG_AXON = 1 << 1
+"""Point annotation contains 'axon'."""
+FLAG_BASAL = 1 << 2
+"""Point annotation contains 'basal'."""
+FLAG_LAMELLA = 1 << 3
+"""Point annotation contains 'lam'."""
+FLAG_SOMA = 1 << 4
+"""Point annotation contains 'soma'."""
+FLAG_MARKED = 1 << 5
+"""Point has been manually marked."""
+
+_LABEL_FLAGS = [('axon', FLAG_AXON), ('basal', FLAG_BASAL), ('lam', FLAG_LAMELLA), ('soma', FLAG_SOMA)]
+
+@attr.s(frozen=True)
+class TreeArrays():
+    """Read-only columnar snapshot of a tree, one row per point.
+
+    Rows are in the same order as Tree.flattenPoints(), so every point comes
+    after its parent. Obtain via Tree.arrays(), which caches the result until
+    the tree is next changed."""
+
+    points: List[Point] = attr.ib(repr=False)
+    """Point objects for each row."""
+
+    ids: List[str] = attr.ib(repr=False)
+    """Point ID for each row."""
+
+    locations: np.ndarray = attr.ib(repr=False)
+    """(N, 3) float array of pixel (x, y, z) locations."""
+
+    worldLocations: np.ndarray = attr.ib(repr=False)
+    """(N, 3) float array of world (x, y, z) locations, in microns."""
+
+    parents: np.ndarray = attr.ib(repr=False)
+    """Row of each point's parent, -1 for the root."""
+
+    branchIndices: np.ndarray = attr.ib(repr=False)
+    """Index within tree.branches of each point's branch, -1 for the root."""
+
+    radii: np.ndarray = attr.ib(repr=False)
+    """Pixel radius of each point, NaN if not set."""
+
+    annotationFlags: np.ndarray = attr.ib(repr=False)
+    """Bitmask of FLAG_* values for each point."""
+
+    pixelSizes: Sequence[float] = attr.ib()
+    """x/y/z pixel size used to calculate worldLocations."""
+
+    rowForID: Dict[str, int] = attr.ib(repr=False)
+    """Maps point ID to its row."""
+
+    def __len__(self) -> int:
+        return len(self.points)
+
+    def rowsFor(self, points: List[Point]) -> np.ndarray:
+        """Rows for each of the given points."""
+        return np.array([self.rowForID[p.id] for p in points], dtype=np.int64)
+
+    def edgeLengths(self) -> np.ndarray:
+        """World distance from each point to its parent, 0 for the root."""
+        lengths = np.zeros(len(self.points))
+        hasParent = self.parents >= 0
+        deltas = self.worldLocations[hasParent] - self.worldLocations[self.parents[hasParent]]
+        lengths[hasParent] = np.linalg.norm(deltas, axis=1)
+        return lengths
+
+    def hasFlag(self, flag: int) -> np.ndarray:
+        """Boolean array of which points have the given annotation flag."""
+        return (self.annotationFlags & flag) != 0
+
+
+@attr.s(frozen=True)
+class SubtreeMetrics():
+    """Per-point distances along and across the tree, indexed by TreeArrays row.
+
+    Obtain via Tree.subtreeMetrics(), which caches the result alongside Tree.arrays()."""
+
+    longestDistanceToLeaf: np.ndarray = attr.ib(repr=False)
+    """World distance along the tree from each point to its furthest downstream leaf."""
+
+    pathLengthFromRoot: np.ndarray = attr.ib(repr=False)
+    """World distance along the tree from the soma to each point."""
+
+    spatialDistFromRoot: np.ndarray = attr.ib(repr=False)
+    """Straight-line world distance from the soma to each point."""
+
+
+def buildSubtreeMetrics(arrays: TreeArrays) -> SubtreeMetrics:
+    """Calculate all subtree metrics in one pre-order and one post-order pass.
+
+    Relies on rows being in pre-order, so a parent's row is always before its children's."""
+    n = len(arrays)
+    parents = arrays.parents.tolist()
+    edges = arrays.edgeLengths().tolist()
+
+    # Pre-order: each point is its parent's path length plus the edge to it.
+    pathLengths = [0.0] * n
+    for row in range(1, n):
+        pathLengths[row] = pathLengths[parents[row]] + edges[row]
+
+    # Post-order: push each point's longest path up to its parent.
+    longest = [0.0] * n
+    for row in range(n - 1, 0, -1):
+        parent, dist = parents[row], longest[row] + edges[row]
+        if dist > longest[parent]:
+            longest[parent] = dist
+
+    spatial = np.zeros(n)
+    if n > 0:
+        spatial = np.linalg.norm(arrays.worldLocations - arrays.worldLocations[0], axis=1)
+
+    def _readOnly(array: np.ndarray) -> np.ndarray:
+        array.setflags(write=False)
+        return array
+
+    return SubtreeMetrics(
+        longestDistanceToLeaf=_readOnly(np.array(longest, dtype=np.float64)),
+        pathLengthFromRoot=_readOnly(np.array(pathLengths, dtype=np.float64)),
+        spatialDistFromRoot=_readOnly(spatial),
+    )
+
+def buildTreeArrays(tree: Tree, pixelSizes: Sequence[float]) -> TreeArrays:
+    """Walk the tree once, collecting all per-point data into arrays."""
+    points: List[Point] = []
+    parents: List[int] = []
+    branchIndices: List[int] = []
+
+    if tree.rootPoint is not None:
+        branchIdx = {id(branch): idx for idx, branch in enumerate(tree.branches)}
+        points.append(tree.rootPoint)
+        parents.append(-1)
+        branchIndices.append(-1)
+        # Stack of (branch, index of next point, row of parent for that point)
+        toVisit = [(child, 0, 0) for child in reversed(tree.rootPoint.children)]
+        while len(toVisit) > 0:
+            branch, pointIdx, parentRow = toVisit.pop()
+            branchPoints, branchIndex = branch.points, branchIdx.get(id(branch), -1)
+            # Walk straight along the branch, until reaching a point with branches coming off it:
+            while pointIdx < len(branchPoints):
+                point = branchPoints[pointIdx]
+                row = len(points)
+                points.append(point)
+                parents.append(parentRow)
+                branchIndices.append(branchIndex)
+                pointIdx, parentRow = pointIdx + 1, row
+                if len(point.children) > 0:
+                    # Continue along this branch after all child branches are done:
+                    toVisit.append((branch, pointIdx, row))
+                    toVisit.extend((child, 0, row) for child in reversed(point.children))
+                    break
+
+    n = len(points)
+    locations = np.array([p.location for p in points], dtype=np.float64).reshape((n, 3))
+    radii = np.array([np.nan if p.radius is None else p.radius for p in points], dtype=np.float64)
+    flags = np.array([_flagsForPoint(point) for point in points], dtype=np.uint8).reshape(n)
+
+    def _readOnly(array: np.ndarray) -> np.ndarray:
+        array.setflags(write=False)
+        return array
+
+    return TreeArrays(
+        points=points,
+        ids=[p.id for p in points],
+        locations=_readOnly(locations),
+        worldLocations=_readOnly(locations * np.array(pixelSizes, dtype=np.float64)),
+        parents=_readOnly(np.array(parents, dtype=np.int64)),
+        branchIndices=_readOnly(np.array(branchIndices, dtype=np.int64)),
+        radii=_readOnly(radii),
+        annotationFlags=_readOnly(flags),
+        pixelSizes=tuple(pixelSizes),
+        rowForID={p.id: row for row, p in reversed(list(enumerate(points)))},
+    )
+
+def _flagsForPoint(point: Point) -> int:
+    flags = FLAG_MARKED if point.manuallyMarked else 0
+    if point.annotation:
+        flags |= FLAG_ANNOTATED
+        for label, flag in _LABEL_FLAGS:
+            if point.annotation.find(label) != -1:
+                flags |= flag
+    return flags
@@ -16,14 +16,18 @@ def findNextPoints(pointAt: Point) -> List[Point]:
     firstChildPoints = [b.points[0] for b in pointAt.children if len(b.points) > 0]
     return branchPoint + firstChildPoints
 
-# Return all (A, B, C) adjacent triples
+# Return all (A, B, C) adjacent triples, for every point C downstream of pointAt, in tree order
 def findAllTriples(tree: Tree, pointAt: Point, pointBefore: Optional[Point]) -> List[Tuple[Point, Point, Point]]:
-    nextPoints = findNextPoints(pointAt)
-    triples = []
-    for nextPoint in nextPoints:
-        if pointBefore is not None:
-            triples.append((pointBefore, pointAt, nextPoint))
-        triples += findAllTriples(tree, nextPoint, pointAt)
+    triples: List[Tuple[Point, Point, Point]] = []
+    for pointC in pointAt.iterSubtree():
+        if pointC is pointAt:
+            continue
+        pointB = pointC.nextPointInBranch(-1, noWrap=True)
+        if pointB is None:
+            continue
+        pointA = pointBefore if pointB is pointAt else pointB.nextPointInBranch(-1, noWrap=True)
+        if pointA is not None:
+            triples.append((pointA, pointB, pointC))
     return triples
 
 # Return all (A, B, C) adjacent triples where the angle AB->BC is sharp.
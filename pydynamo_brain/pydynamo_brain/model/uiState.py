@@ -4,7 +4,7 @@ import attr
 import math
 import numpy as np
 
-from typing import Optional, Tuple, TYPE_CHECKING
+from typing import Any, Optional, Tuple, TYPE_CHECKING
 
 from .tree.branch import Branch
 from .tree.point import Point
@@ -17,6 +17,12 @@ from pydynamo_brain.util import snapToRange, normDelta, dotDelta, deltaSz, SAVE_
 if TYPE_CHECKING:
     from .fullState import FullState
 
+def _onSavedFieldChange(uiState: UIState, attribute: attr.Attribute, value: Any) -> Any:
+    """Lets the full state know that a field saved to file has been changed."""
+    if uiState._parent is not None and getattr(uiState, attribute.name) != value:
+        uiState._parent.markEdited()
+    return value
+
 @attr.s
 class UIState():
     # Full state this belongs within
@@ -29,10 +35,10 @@ class UIState():
     imagePath: Optional[str] = attr.ib(default=None)
 
     # Whether the stack is shown or hidden
-    isHidden: bool = attr.ib(default=False, metadata=SAVE_META)
+    isHidden: bool = attr.ib(default=False, metadata=SAVE_META, on_setattr=_onSavedFieldChange)
 
     # Which z Axis to display
-    zAxisAt: int = attr.ib(default=0, metadata=SAVE_META)
+    zAxisAt: int = attr.ib(default=0, metadata=SAVE_META, on_setattr=_onSavedFieldChange)
 
     # ID of currently active point
     currentPointID: Optional[str] = attr.ib(default=None)
@@ -50,10 +56,10 @@ class UIState():
     pointMode: PointMode = attr.ib(default=PointMode.DEFAULT)
 
     # UI Option for whether or not to show annotations.
-    showAnnotations: bool = attr.ib(default=False, metadata=SAVE_META)
+    showAnnotations: bool = attr.ib(default=False, metadata=SAVE_META, on_setattr=_onSavedFieldChange)
 
     # UI Option for whether or not to show IDs (drawn like annotations).
-    showIDs: bool = attr.ib(default=False, metadata=SAVE_META)
+    showIDs: bool = attr.ib(default=False, metadata=SAVE_META, on_setattr=_onSavedFieldChange)
 
     # UI Option for which branches to show.
     # 0 = nearby, 1 = all, 2 = only on this Z plane
@@ -69,7 +75,7 @@ class UIState():
     hideAll: bool = attr.ib(default=False)
 
     # (lower-, upper-) bounds for intensities to show
-    colorLimits: Tuple[float, float] = attr.ib(default=(0.0, 1.0), metadata=SAVE_META)
+    colorLimits: Tuple[float, float] = attr.ib(default=(0.0, 1.0), metadata=SAVE_META, on_setattr=_onSavedFieldChange)
 
     # Name of matplotlib color map to use
     colorMap: Optional[str] = attr.ib(default=None)
@@ -0,0 +1,453 @@
+import attr
+import gzip
+import json
+import numpy as np
+import os
+import tempfile
+import threading
+
+import pydynamo_brain.files as files
+import pydynamo_brain.files.compression as compression
+from pydynamo_brain.files.traceCache import TRACE_PREFIX, TraceCache
+import pydynamo_brain.files.journal as journalModule
+from pydynamo_brain.files.files import attrFilter
+from pydynamo_brain.model import *
+
+EXAMPLE_PATH = "pydynamo_brain/pydynamo_brain/test/files/example2.dyn.gz"
+
+def _roundTrip(fullState, extension):
+    with tempfile.TemporaryDirectory() as tmpDir:
+        path = os.path.join(tmpDir, 'state' + extension)
+        files.saveState(fullState, path)
+        return files.loadState(path)
+
+# Tests that the streamed JSON has the same contents as the full dictionary version.
+def testStreamingJSON():
+    fullState = files.loadState(EXAMPLE_PATH)
+    fullState.puncta = [[Point(id='0000ffff', location=(1, 2, 3), radius=1.5)] for _ in fullState.trees]
+    asDict = attr.asdict(fullState, filter=attrFilter)
+    # Compression options are left out while they hold their defaults:
+    del asDict['projectOptions']['compression']
+    del asDict['projectOptions']['compressionLevel']
+
+    chunks = []
+    files.writeFullState(fullState, chunks.append)
+    assert json.loads(''.join(chunks)) == json.loads(json.dumps(asDict))
+    assert len(chunks) > 1, "Expected output to be written in parts"
+
+    reloaded = _roundTrip(fullState, '.dyn.gz')
+    assert files.fullStateToString(reloaded) == files.fullStateToString(fullState)
+    assert reloaded.trees == fullState.trees
+    print ("Streaming JSON passed! 🙌")
+
+# Tests that the binary format loads back exactly the same as the JSON format.
+def testBinaryMatchesJSON():
+    fullState = files.loadState(EXAMPLE_PATH)
+    fromBinary = _roundTrip(fullState, '.dynb')
+    assert files.fullStateToString(fromBinary) == files.fullStateToString(fullState)
+    assert fromBinary.trees == fullState.trees
+    for i, uiState in enumerate(fromBinary.uiStates):
+        assert uiState.parent() is fromBinary
+        assert uiState._tree is fromBinary.trees[i]
+    print ("Binary format matches JSON passed! 🙌")
+
+# Tests the unusual values that JSON keeps: ints, Nones, empty and disconnected bits.
+def testBinaryEdgeCases():
+    fullState = FullState()
+    rootedTree, emptyTree = Tree(), Tree()
+    fullState.addFiles(['a.tif', 'b.tif'], [rootedTree, emptyTree])
+    rootedTree.rootPoint = Point(id='00000000', location=(1, 2, 3), radius=2)
+    b0 = Branch(id='0000')
+    rootedTree.addBranch(b0)
+    b0.setParentPoint(rootedTree.rootPoint)
+    b0.addPoint(Point(id='00000001', location=(1.5, 2, 3.25), annotation="axon", manuallyMarked=True))
+    b0.addPoint(Point(id='00000002', location=(2.5, 2.5, 3.5), radius=1.25, annotation=None, hilighted=False))
+    # Branch whose parent has since been removed from the tree:
+    b1 = Branch(id='0001', parentPoint=Point(id='0000000a', location=(9, 9, 9)))
+    rootedTree.addBranch(b1)
+    b1.addPoint(Point(id='00000003', location=(8.0, 8.0, 8.0)))
+    rootedTree.transform.scale = [2, 2, 1]
+    fullState.puncta = [[Point(id='00000004', location=(1, 1, 1), radius=3.5)], {}]
+    fullState.projectOptions.analysisOptions['shollBinSize'] = 2.5
+
+    viaJSON = _roundTrip(fullState, '.dyn.gz')
+    viaBinary = _roundTrip(fullState, '.dynb')
+    assert files.fullStateToString(viaBinary) == files.fullStateToString(viaJSON)
+    assert viaBinary.trees[1].rootPoint is None
+    assert viaBinary.trees[0].rootPoint.radius == 2 and type(viaBinary.trees[0].rootPoint.radius) is int
+    print ("Binary format edge cases passed! 🙌")
+
+# Tests that unsaved changes are tracked without needing to read the saved file.
+def testUnsavedChanges():
+    with tempfile.TemporaryDirectory() as tmpDir:
+        path = os.path.join(tmpDir, 'state.dyn.gz')
+        files.saveState(files.loadState(EXAMPLE_PATH), path)
+        fullState = files.loadState(path)
+        os.remove(path)
+        assert not files.checkIfChanged(fullState, path)
+
+        point = fullState.trees[0].rootPoint
+        point.location = (1.0, 2.0, 3.0)
+        assert files.checkIfChanged(fullState, path)
+        files.saveState(fullState, path)
+        assert not files.checkIfChanged(fullState, path)
+
+        # Saving a copy elsewhere doesn't count:
+        history = History(fullState)
+        history.pushState()
+        fullState.setProjectOptions(attr.evolve(fullState.projectOptions, pixelSizes=[1.0, 1.0, 1.0]))
+        files.saveState(fullState, os.path.join(tmpDir, 'copy.dyn.gz'))
+        assert files.checkIfChanged(fullState, path)
+        files.saveState(fullState, path)
+        history.undo()
+        assert files.checkIfChanged(fullState, path)
+        assert files.checkIfChanged(FullState(), None)
+
+        # Options edited in settings count, unless nothing changed:
+        files.saveState(fullState, path)
+        fullState.setProjectOptions(attr.evolve(fullState.projectOptions))
+        assert not fullState.hasUnsavedChanges()
+        newOptions = attr.evolve(fullState.projectOptions, pixelSizes=[2.0, 2.0, 2.0])
+        fullState.setProjectOptions(newOptions)
+        assert fullState.hasUnsavedChanges()
+        assert fullState.projectOptions is newOptions
+
+        # Selecting a point isn't an edit, nor is undoing it:
+        uiState = fullState.uiStates[0]
+        point = fullState.trees[0].rootPoint
+        uiState.zAxisAt = int(round(point.location[2]))
+        files.saveState(fullState, path)
+        autoSaver = files.AutoSaver(fullState)
+        history.pushState()
+        uiState.selectPointByID(point.id)
+        assert uiState.currentPointID == point.id
+        history.undo()
+        history.redo()
+        assert not fullState.hasUnsavedChanges()
+        autoSaver.handleStateChange()
+        assert not files.hasJournal(path)
+
+        # ...but undoing an edit is, as is editing a root with no branches:
+        history.pushState()
+        point.location = (4.0, 5.0, 6.0)
+        files.saveState(fullState, path)
+        history.undo()
+        assert fullState.hasUnsavedChanges()
+        files.saveState(fullState, path)
+        fullState.trees[1].rootPoint = Point(id=fullState.nextPointID(), location=(0.0, 0.0, 0.0))
+        files.saveState(fullState, path)
+        fullState.trees[1].rootPoint.annotation = 'soma'
+        assert fullState.hasUnsavedChanges()
+        autoSaver.close()
+    print ("Unsaved changes passed! 🙌")
+
+# Tests autosaving on a worker thread, from a snapshot taken when the save starts.
+def testBackgroundAutoSave():
+    with tempfile.TemporaryDirectory() as tmpDir:
+        path = os.path.join(tmpDir, 'state.dyn.gz')
+        files.saveState(files.loadState(EXAMPLE_PATH), path)
+        fullState = files.loadState(path)
+        expected = files.fullStateToString(fullState)
+
+        messages = []
+        files.AutoSaver.USE_JOURNAL = False
+        try:
+            autoSaver = files.AutoSaver(fullState)
+        finally:
+            files.AutoSaver.USE_JOURNAL = True
+        autoSaver.lastSaveMs = 0
+        autoSaver.handleStateChange(messages.append)
+        # Edits after the save starts don't end up in it:
+        fullState.trees[0].rootPoint.location = (1.0, 2.0, 3.0)
+        autoSaver.waitForSave()
+        assert not autoSaver.isSaving()
+        assert len(messages) == 1 and messages[0].startswith("Autosaved to ")
+        savedPath = messages[0][len("Autosaved to "):]
+        assert files.fullStateToString(files.loadState(savedPath)) == expected
+        assert files.checkIfChanged(fullState, path)
+
+        # Failures are reported rather than raised:
+        os.remove(savedPath)
+        os.makedirs(savedPath)
+        autoSaver.lastSaveMs = 0
+        autoSaver.handleStateChange(messages.append)
+        autoSaver.waitForSave()
+        assert len(messages) == 2 and messages[1].startswith("Autosave failed")
+        assert not os.path.exists(savedPath + ".partial")
+    print ("Background autosave passed! 🙌")
+
+# Tests that journaled edits can be replayed on top of the project file after a crash.
+def testJournal():
+    with tempfile.TemporaryDirectory() as tmpDir:
+        path = os.path.join(tmpDir, 'state.dyn.gz')
+        files.saveState(files.loadState(EXAMPLE_PATH), path)
+        fullState = files.loadState(path)
+        history = History(fullState)
+        autoSaver = files.AutoSaver(fullState)
+        assert os.path.exists(files.Journal(path).path) and not files.hasJournal(path)
+
+        # Nothing changed, nothing written:
+        autoSaver.handleStateChange()
+        assert not files.hasJournal(path)
+
+        history.pushState()
+        fullState.trees[0].rootPoint.location = (1.0, 2.0, 3.0)
+        autoSaver.handleStateChange()
+        assert files.hasJournal(path)
+
+        history.pushState()
+        tree = fullState.trees[1]
+        newPoint = Point(id=fullState.nextPointID(), location=(4.0, 5.0, 6.0))
+        tree.branches[0].addPoint(newPoint)
+        fullState.puncta = [[Point(id=fullState.nextPointID(), location=(7.0, 8.0, 9.0))]]
+        autoSaver.handleStateChange()
+
+        # Crash, with a torn final write:
+        expected = files.fullStateToString(fullState)
+        with open(files.Journal(path).path, 'ab') as journalFile:
+            journalFile.write(b'\x10\x00\x00')
+        recovered = files.loadState(path)
+        journal = files.Journal(path)
+        assert journal.replay(recovered) == 2
+        assert files.fullStateToString(recovered) == expected
+        assert files.checkIfChanged(recovered, path)
+        assert int(recovered.nextPointID(), 16) > int(newPoint.id, 16)
+
+        # Keeps journaling after recovery, compacting once too big:
+        oldCompactBytes = journalModule._COMPACT_BYTES
+        journalModule._COMPACT_BYTES = 0
+        try:
+            recoveredSaver = files.AutoSaver(recovered, journal)
+            recovered.trees[0].rootPoint.location = (3.0, 2.0, 1.0)
+            recoveredSaver.handleStateChange()
+        finally:
+            journalModule._COMPACT_BYTES = oldCompactBytes
+        again = files.loadState(path)
+        assert files.Journal(path).replay(again) == 1
+        assert files.fullStateToString(again) == files.fullStateToString(recovered)
+
+        # Journal for an older version of the project is ignored:
+        files.saveState(again, path)
+        assert files.Journal(path).replay(files.loadState(path)) == 0
+
+        # Saving starts a new journal, closing removes it:
+        files.saveState(recovered, path)
+        recoveredSaver.projectSaved()
+        assert not files.hasJournal(path)
+        recoveredSaver.close()
+        assert not os.path.exists(files.Journal(path).path)
+    print ("Journal passed! 🙌")
+
+# Tests that threaded gzip output is still plain gzip, and other codecs are detected on load.
+def testCompression():
+    data = b''.join(b'%d,' % i for i in range(500000)) # A few blocks worth
+    with tempfile.TemporaryDirectory() as tmpDir:
+        path = os.path.join(tmpDir, 'data.gz')
+        with compression.CompressedWriter(path, compression.GZIP, 1, threads=4) as outfile:
+            for start in range(0, len(data), 10000):
+                outfile.write(data[start:start + 10000])
+        assert gzip.open(path).read() == data
+        assert compression.readCompressed(path) == data
+
+        fullState = files.loadState(EXAMPLE_PATH)
+        for codec in ['gzip', 'zstd', 'lz4']:
+            # Codecs that aren't installed fall back to gzip:
+            fullState.projectOptions.compression = codec
+            fullState.projectOptions.compressionLevel = 1
+            reloaded = _roundTrip(fullState, '.dyn.gz')
+            assert files.fullStateToString(reloaded) == files.fullStateToString(fullState)
+
+        # Closing without writing anything still leaves a valid, empty file:
+        for codec in compression.availableCodecs():
+            emptyPath = os.path.join(tmpDir, 'empty.' + codec)
+            compression.CompressedWriter(emptyPath, codec).close()
+            assert compression.readCompressed(emptyPath) == b''
+
+        badPath = os.path.join(tmpDir, 'bad.dyn.gz')
+        with open(badPath, 'wb') as outfile:
+            outfile.write(b'not compressed')
+        try:
+            files.loadState(badPath)
+            assert False, "Expected unknown compression to fail"
+        except ValueError:
+            pass
+    print ("Compression passed! 🙌")
+
+# Tests that files saved with default compression only have fields older versions can load.
+def testOlderVersionsCanLoad():
+    # ProjectOptions before compression was added, which fails on any other field:
+    OldProjectOptions = attr.make_class('OldProjectOptions',
+        ['pixelSizes', 'motilityOptions', 'analysisOptions', 'zProjectionMethod'])
+    fullState = files.loadState(EXAMPLE_PATH)
+    with tempfile.TemporaryDirectory() as tmpDir:
+        path = os.path.join(tmpDir, 'state.dyn.gz')
+        files.saveState(fullState, path)
+        with gzip.open(path) as infile:
+            saved = json.load(infile)
+        OldProjectOptions(**saved['projectOptions'])
+
+        # Non-default choices are still saved:
+        fullState.projectOptions.compressionLevel = 9
+        reloaded = _roundTrip(fullState, '.dyn.gz')
+        assert reloaded.projectOptions.compression == 'gzip'
+        assert reloaded.projectOptions.compressionLevel == 9
+    print ("Older versions can load passed! 🙌")
+
+# Tests that lazily loaded stacks only load when used, and match an eager load.
+def testLazyLoading():
+    with tempfile.TemporaryDirectory() as tmpDir:
+        path = os.path.join(tmpDir, 'state.dynb')
+        files.saveState(files.loadState(EXAMPLE_PATH), path)
+        eager = files.loadState(path)
+        lazy = files.loadState(path, lazy=True)
+        assert len(lazy.trees) > 1 and not any(tree.isLoaded() for tree in lazy.trees)
+        assert (lazy._nextPointID, lazy._nextBranchID) == (eager._nextPointID, eager._nextBranchID)
+
+        # Using one stack only loads that one, and doesn't count as an edit:
+        assert lazy.uiStates[1]._tree.rootPoint.id == eager.trees[1].rootPoint.id
+        assert lazy.trees[1].isLoaded() and not lazy.trees[0].isLoaded()
+        assert lazy.trees[1] == eager.trees[1]
+        assert not files.checkIfChanged(lazy, path)
+
+        # History and copies leave other stacks unloaded:
+        history = History(lazy)
+        history.pushState()
+        lazy.trees[1].rootPoint.location = (1.0, 2.0, 3.0)
+        assert history.undo()
+        assert lazy.trees[1] == eager.trees[1]
+        copied = lazy.trees[0].detachedCopy()
+        assert not lazy.trees[0].isLoaded() and not copied.isLoaded()
+        assert copied == eager.trees[0]
+
+        # Copies can load on other threads (e.g. background autosave) while this one loads too:
+        copies = [tree.detachedCopy() for tree in lazy.trees for _ in range(4)]
+        workers = [threading.Thread(target=lambda tree=tree: tree.rootPoint) for tree in copies]
+        for worker in workers:
+            worker.start()
+        assert copied.rootPoint is not None
+        for worker in workers:
+            worker.join()
+        assert all(tree.isLoaded() for tree in copies)
+        assert copies[0] == eager.trees[0] and copies[-1] == eager.trees[-1]
+
+        # Unloaded stacks are copied straight across when saving:
+        lazy.trees[1].rootPoint.location = (1.0, 2.0, 3.0)
+        eager.trees[1].rootPoint.location = (1.0, 2.0, 3.0)
+        copyPath = os.path.join(tmpDir, 'copy.dynb')
+        files.saveState(lazy, copyPath)
+        assert not lazy.trees[0].isLoaded()
+        assert files.fullStateToString(files.loadState(copyPath)) == files.fullStateToString(eager)
+        assert files.fullStateToString(lazy) == files.fullStateToString(eager)
+    print ("Lazy loading passed! 🙌")
+
+# Soma plus branches given as (parent branch index, parent point index, point locations).
+# Point IDs are new each time, branch IDs are the index like in matlab.
+def _buildMatlabLikeTree(fullState, branchSpecs, rootLocation):
+    tree = Tree()
+    tree.rootPoint = Point(id=fullState.nextPointID(), location=rootLocation)
+    for i, (parentBranch, parentPoint, locations) in enumerate(branchSpecs):
+        branch = Branch(id='%04x' % i)
+        branch.setParentPoint(tree.rootPoint if parentBranch is None else tree.branches[parentBranch].points[parentPoint])
+        tree.addBranch(branch)
+        for location in locations:
+            branch.addPoint(Point(id=fullState.nextPointID(), location=location))
+    return tree
+
+# Tests that points are given the ID of the matching point in the previous stack.
+def testAlignPointID():
+    along = [(10.0 * j, 0.0, 5.0) for j in range(1, 11)]
+    up = [(40.0, 10.0 * j, 5.0) for j in range(1, 11)]
+    back = [(-10.0 * j, 0.0, 5.0) for j in range(1, 6)]
+    shift = lambda locations, dx: [(x + dx, y - 2, z) for x, y, z in locations]
+
+    for bipartite in [False, True]:
+        fullState = FullState()
+        t0 = _buildMatlabLikeTree(fullState, [(None, 0, along), (0, 3, up), (None, 0, back)], (0.0, 0.0, 5.0))
+        t1 = _buildMatlabLikeTree(fullState, [
+            (None, 0, shift(along, 3.5)),              # Same number of points
+            (0, 3, shift(up[:6] + up[7:], 2.5)),       # One removed
+            (None, 0, shift(back + [(-60, 0, 5)], 3)), # One added
+        ], (3.0, -2.0, 5.0))
+        fullState.addFiles(['t0.tif', 't1.tif'], [t0, t1])
+        extraID = t1.branches[2].points[-1].id
+        files.matlab.alignPointID(fullState, bipartite=bipartite)
+
+        assert t1.rootPoint.id == t0.rootPoint.id
+        ids0 = [[p.id for p in branch.points] for branch in t0.branches]
+        ids1 = [[p.id for p in branch.points] for branch in t1.branches]
+        assert ids1[0] == ids0[0]
+        assert ids1[1] == ids0[1][:6] + ids0[1][7:]
+        assert ids1[2][:5] == ids0[2] and ids1[2][5] == extraID
+        # Point IDs are still unique
+        allIDs = [p.id for p in t1.flattenPoints()]
+        assert len(allIDs) == len(set(allIDs))
+    print ("Align point ID passed! 🙌")
+
+# NWB file with a trace for each POI ID given, plus stimulus times.
+def _writeNWB(path, pointIDs, nSamples):
+    import datetime
+    import pynwb
+    nwbFile = pynwb.NWBFile(session_description='test', identifier=os.path.basename(path),
+        session_start_time=datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc))
+    for i, pointID in enumerate(pointIDs):
+        nwbFile.add_acquisition(pynwb.base.TimeSeries(name=TRACE_PREFIX + pointID,
+            data=np.full(nSamples, float(i)), unit='dF/F', rate=30.0))
+    nwbFile.add_stimulus(pynwb.base.TimeSeries(name='stim', data=np.ones(2), unit='s', timestamps=[1.5, 4.0]))
+    with pynwb.NWBHDF5IO(path, 'w') as io:
+        io.write(nwbFile)
+
+# Tests that traces are read one POI at a time, within the memory budget, sharing open files.
+def testTraceCache():
+    cache = TraceCache()
+    cache.clear()
+    with tempfile.TemporaryDirectory() as tmpDir:
+        pathA, pathB = os.path.join(tmpDir, 'a.nwb'), os.path.join(tmpDir, 'b.nwb')
+        _writeNWB(pathA, ['00000001', '00000002', '00000003'], 1000)
+        _writeNWB(pathB, ['00000004'], 1000)
+        paths = [pathA, pathB, os.path.join(tmpDir, 'missing.nwb')]
+
+        oldBudget = cache.budgetBytes
+        try:
+            cache.budgetBytes = 2 * 1000 * 8 # Two traces
+            trace = cache.getTraceForPOI(paths, '00000004')
+            assert trace.rate == 30.0 and (trace.data == 0.0).all()
+            assert list(cache._loadedTraces.keys()) == [(pathB, '00000004')]
+            assert cache.getTraceForPOI(paths, '00000004') is trace
+            assert cache.getTraceForPOI(paths, 'ffffffff') is None
+            assert cache.getTraceForPOI(paths, '00000002', loadIfMissing=False) is None
+
+            # Stimuli come from the same open file:
+            assert cache.getStim(paths) == [1.5, 4.0]
+            assert sorted(cache._handles.keys()) == [pathA, pathB]
+
+            # Least recently used are dropped once over budget:
+            assert (cache.getTraceForPOI(paths, '00000002').data == 1.0).all()
+            cache.getTraceForPOI(paths, '00000004')
+            cache.getTraceForPOI(paths, '00000003')
+            assert list(cache._loadedTraces.keys()) == [(pathB, '00000004'), (pathA, '00000003')]
+            assert cache._loadedBytes == 2 * 1000 * 8
+
+            allTraces = cache.getAllTraces(paths)
+            assert sorted(allTraces.keys()) == ['00000001', '00000002', '00000003', '00000004']
+            assert (allTraces['00000003'].data == 2.0).all()
+        finally:
+            cache.budgetBytes = oldBudget
+            cache.clear()
+    print ("Trace cache passed! 🙌")
+
+def run():
+    testTraceCache()
+    testAlignPointID()
+    testLazyLoading()
+    testCompression()
+    testOlderVersionsCanLoad()
+    testJournal()
+    testBackgroundAutoSave()
+    testUnsavedChanges()
+    testStreamingJSON()
+    testBinaryMatchesJSON()
+    testBinaryEdgeCases()
+    return True
+
+if __name__ == '__main__':
+    run()
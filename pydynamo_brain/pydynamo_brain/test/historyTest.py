@@ -121,11 +121,119 @@ def testMaxDepth():
     assert h.liveState.trees[0].rootPoint is not None
     print ("History length test passed! 🙌")
 
+# Tests that edits to a soma with no branches yet can be undone.
+def testChildlessRoot():
+    fullState = FullState()
+    fullState.addFiles(['test.tif'], [Tree(rootPoint=Point(id='root', location=(0, 0, 0)))])
+    h = History(fullState)
+    root = fullState.trees[0].rootPoint
+
+    h.pushState()
+    root.location = (10, 10, 10)
+    root.radius = 3.0
+    assert h.undo()
+    assert root.location == (0, 0, 0) and root.radius is None
+    assert h.redo()
+    assert root.location == (10, 10, 10) and root.radius == 3.0
+    print ("Childless root history passed! 🙌")
+
+# Tests that undo only touches what changed, keeping the same point objects.
+def testInPlace():
+    fullState = files.loadState("pydynamo_brain/pydynamo_brain/test/files/example2.dyn.gz")
+    h = History(fullState)
+    tree0, tree1 = fullState.trees[0], fullState.trees[1]
+    allPoints1 = tree1.flattenPoints()
+    moved = tree0.flattenPoints()[3]
+    oldLocation = moved.location
+
+    h.pushState()
+    tree0.movePoint(moved.id, (1, 2, 3))
+    h.pushState()
+    tree0.removePointByID(tree0.flattenPoints()[-1].id)
+    assert len(h.undoStack) == 2
+
+    assert h.undo()
+    assert h.undo()
+    assert fullState.trees[0] is tree0 and fullState.trees[1] is tree1
+    assert tree0.getPointByID(moved.id) is moved
+    assert moved.location == oldLocation
+    assert all(a is b for a, b in zip(allPoints1, tree1.flattenPoints()))
+
+    assert h.redo()
+    assert moved.location == (1, 2, 3)
+    print ("In place history passed! 🙌")
+
+# Tests that snapshots share unchanged trees, and only copy changed trees that can't be diffed.
+def testSharedTrees():
+    fullState = files.loadState("pydynamo_brain/pydynamo_brain/test/files/example2.dyn.gz")
+    h = History(fullState)
+    tree0, tree1 = fullState.trees[0], fullState.trees[1]
+
+    s0 = h.pushState()
+    selected = tree1.flattenPoints()[2]
+    fullState.uiStates[1].currentPointID = selected.id
+    fullState.uiStates[1]._currentPointCache = selected
+    s1 = h.pushState()
+    assert all(a is b for a, b in zip(s0.trees, s1.trees))
+
+    # Duplicate point IDs can't be diffed, so that tree is copied instead:
+    branch = Branch(id=fullState.nextBranchID())
+    tree0.addBranch(branch)
+    branch.setParentPoint(tree0.rootPoint)
+    branch.addPoint(Point(id=tree0.rootPoint.id, location=(1, 1, 1)))
+    s2 = h.pushState()
+    assert s2.trees[0].copiedTree is not None and s2.trees[1] is s1.trees[1]
+    s3 = h.pushState()
+    assert s3.trees[0] is s2.trees[0]
+
+    tree0.rootPoint.location = (5, 5, 5)
+    assert h.undo()
+    assert fullState.trees[1] is tree1 and fullState.trees[0] is not tree0
+    assert fullState.uiStates[0]._tree is fullState.trees[0]
+    assert fullState.trees[0]._parentState is fullState.uiStates[0]
+    assert fullState.trees[0] == s3.trees[0].copiedTree
+    assert fullState.uiStates[1].currentPoint() is selected
+    print ("Shared tree history passed! 🙌")
+
+# Tests that patches over the memory budget move to disk, and come back on undo.
+def testMemoryBudget():
+    fullState = files.loadState("pydynamo_brain/pydynamo_brain/test/files/example2.dyn.gz")
+    h = History(fullState)
+    h.setMemoryBudget(0)
+    tree = fullState.trees[0]
+    points = tree.flattenPoints()[1:11]
+    oldLocations = [point.location for point in points]
+
+    for point in points:
+        h.pushState()
+        tree.movePoint(point.id, (0, 0, 0))
+    footprint = h.footprint()
+    assert footprint.undoCount == len(points)
+    assert footprint.spilledCount == len(points) - 1
+    assert footprint.diskBytes > 0 and footprint.memoryBytes > 0
+
+    while h.undo():
+        pass
+    assert [point.location for point in points] == oldLocations
+    assert h.footprint().spilledCount == len(points) - 1 # Now in the redo stack
+    while h.redo():
+        pass
+    assert all(point.location == (0, 0, 0) for point in points)
+
+    # New patches stay in memory once back under budget, older ones stay on disk:
+    h.setMemoryBudget(History.MEMORY_BUDGET_BYTES)
+    h.pushState()
+    assert h.footprint().spilledCount == len(points) - 1
+    print ("History memory budget passed! 🙌")
 
 def run():
     testTree()
     testParents()
     testMaxDepth()
+    testChildlessRoot()
+    testInPlace()
+    testSharedTrees()
+    testMemoryBudget()
     return True
 
 if __name__ == '__main__':
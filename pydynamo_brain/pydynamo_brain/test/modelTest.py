@@ -1,4 +1,9 @@
+import numpy as np
+
 from pydynamo_brain.model import *
+from pydynamo_brain.model.tree.traversal import POST_ORDER
+from pydynamo_brain.model.tree.treeArrays import FLAG_AXON
+from pydynamo_brain.model.tree.util import findAllTriples
 
 def testBranchOrder():
     """
@@ -61,8 +66,403 @@ def testBranchOrder():
     assert centrifugalOrders[2] == 2
     assert centrifugalOrders[3] == 3
 
+def testIDIndex():
+    tree = Tree()
+    pR = Point(id='root', location=(0,0,0))
+    tree.rootPoint = pR
+    b0 = Branch(id='b0')
+    b0.setParentPoint(pR)
+    p1 = Point(id='p1', location=(0,0,1))
+    b0.addPoint(p1)
+    tree.addBranch(b0)
+
+    assert tree.getPointByID('root') is pR
+    assert tree.getPointByID('p1') is p1
+    assert tree.getBranchByID('b0') is b0
+
+    # Points added after the index is built:
+    p2 = Point(id='p2', location=(0,0,2))
+    b0.addPoint(p2)
+    assert tree.getPointByID('p2') is p2
+    b1 = Branch(id='b1')
+    p3 = Point(id='p3', location=(0,1,1))
+    b1.addPoint(p3)
+    b1.setParentPoint(p1)
+    tree.addBranch(b1)
+    assert tree.getPointByID('p3') is p3
+    assert tree.getBranchByID('b1') is b1
+
+    # ID changes:
+    p2.id = 'p2new'
+    b1.id = 'b1new'
+    assert tree.getPointByID('p2') is None
+    assert tree.getPointByID('p2new') is p2
+    assert tree.getBranchByID('b1') is None
+    assert tree.getBranchByID('b1new') is b1
+
+    # Removal:
+    tree.removePointByID('p3')
+    assert tree.getPointByID('p3') is None
+    assert tree.getBranchByID('b1new') is None
+
+    # Disconnected branches are only found when asked for:
+    b2 = Branch(id='b2')
+    p4 = Point(id='p4', location=(1,1,1))
+    b2.addPoint(p4)
+    tree.addBranch(b2)
+    assert tree.getPointByID('p4') is None
+    assert tree.getPointByID('p4', includeDisconnected=True) is p4
+
+def testPositionIndex():
+    tree = Tree()
+    pR = Point(id='root', location=(0,0,0))
+    tree.rootPoint = pR
+    b0, b1 = Branch(id='b0'), Branch(id='b1')
+    b0.setParentPoint(pR)
+    b1.setParentPoint(pR)
+    tree.addBranch(b0)
+    tree.addBranch(b1)
+    points = [Point(id='p%d' % i, location=(0,0,i)) for i in range(5)]
+    for p in points:
+        b0.addPoint(p)
+
+    assert [p.indexInParent() for p in points] == [0, 1, 2, 3, 4]
+    assert b1.indexInParent() == 1
+    assert pR.indexInParent() == 0
+
+    # Insert in the middle, shifts later points:
+    pMid = Point(id='pMid', location=(0,1,1))
+    b0.insertPointBefore(pMid, 2)
+    assert pMid.indexInParent() == 2
+    assert points[4].indexInParent() == 5
+
+    # Remove from the middle and the end:
+    b0.removePointLocally(points[1])
+    b0.removePointLocally(points[4])
+    assert [p.id for p in b0.points] == ['p0', 'pMid', 'p2', 'p3']
+    assert [b0.indexForPointID(p.id) for p in b0.points] == [0, 1, 2, 3]
+    assert b0.indexForPointID('p4') == -1
+
+    # ID changes and points replaced directly:
+    points[3].id = 'p3new'
+    assert b0.indexForPointID('p3new') == 3
+    assert b0.indexForPointID('p3') == -1
+    b0.points = b0.points[:2]
+    assert b0.indexForPointID('p2') == -1
+    assert pMid.nextPointInBranch(noWrap=True) is None
+
+    # Branch positions after removal:
+    tree.removeBranch(b0) # Not allowed, has points
+    assert b1.indexInParent() == 1
+    b0.points = []
+    tree.removeBranch(b0)
+    assert b1.indexInParent() == 0
+
+def testTreeArrays():
+    fullState = FullState()
+    fullState.projectOptions.pixelSizes = [0.5, 0.5, 2.0]
+    tree = Tree()
+    fullState.addFiles(['test.tif'], [tree])
+
+    pR = Point(id='root', location=(0,0,0))
+    tree.rootPoint = pR
+    b0, b1 = Branch(id='b0'), Branch(id='b1')
+    b0.setParentPoint(pR)
+    tree.addBranch(b0)
+    p1 = Point(id='p1', location=(0,0,1), radius=2.0)
+    p2 = Point(id='p2', location=(0,0,2), annotation='axon')
+    b0.addPoint(p1)
+    b0.addPoint(p2)
+    b1.setParentPoint(p1)
+    b1.addPoint(Point(id='p3', location=(0,2,1)))
+    tree.addBranch(b1)
+
+    arrays = tree.arrays()
+    assert arrays.ids == [p.id for p in tree.flattenPoints()]
+    assert arrays.ids == ['root', 'p1', 'p3', 'p2']
+    assert list(arrays.parents) == [-1, 0, 1, 1]
+    assert list(arrays.branchIndices) == [-1, 0, 1, 0]
+    assert arrays.radii[1] == 2.0 and np.isnan(arrays.radii[0])
+    assert list(arrays.hasFlag(FLAG_AXON)) == [False, False, False, True]
+    assert np.allclose(arrays.worldLocations[2], (0, 1, 2))
+    assert np.allclose(arrays.edgeLengths(), [0, 2, 1, 2])
+
+    # Cached until something changes:
+    assert tree.arrays() is arrays
+    p2.location = (0,0,3)
+    moved = tree.arrays()
+    assert moved is not arrays
+    assert np.allclose(moved.locations[3], (0,0,3))
+    fullState.projectOptions.pixelSizes = [1, 1, 1]
+    assert np.allclose(tree.arrays().worldLocations[3], (0,0,3))
+
+# Tests that a soma with no branches yet still lets its tree know when it changes.
+def testChildlessRoot():
+    tree = Tree(rootPoint=Point(id='root', location=(0,0,0)))
+    FullState().addFiles(['test.tif'], [tree])
+    assert np.allclose(tree.arrays().locations, [[0,0,0]])
+    tree.rootPoint.location = (10,10,10)
+    assert np.allclose(tree.arrays().locations, [[10,10,10]])
+
+    oldRoot, newRoot = tree.rootPoint, Point(id='soma', location=(1,2,3))
+    tree.rootPoint = newRoot
+    newRoot.radius = 3.0
+    assert tree.arrays().ids == ['soma'] and tree.arrays().radii[0] == 3.0
+    # Replaced roots no longer belong to the tree:
+    arrays = tree.arrays()
+    oldRoot.location = (5,5,5)
+    assert tree.arrays() is arrays
+
+def testWorldCoords():
+    fullState = FullState()
+    fullState.projectOptions.pixelSizes = [0.5, 0.5, 2.0]
+    tree = Tree()
+    fullState.addFiles(['test.tif'], [tree])
+
+    pR = Point(id='root', location=(0,0,0))
+    tree.rootPoint = pR
+    b0 = Branch(id='b0')
+    b0.setParentPoint(pR)
+    tree.addBranch(b0)
+    p1 = Point(id='p1', location=(2,0,0))
+    p2 = Point(id='p2', location=(2,0,1), radius=1.0)
+    b0.addPoint(p1)
+    b0.addPoint(p2)
+
+    x, y, z = tree.worldCoordPoints([p1, p2])
+    assert x == [1, 1] and y == [0, 0] and z == [0, 2]
+    assert np.allclose(tree.worldCoordArray([(4, 4, 4)]), [[2, 2, 8]])
+    assert np.allclose(tree.worldCoordArray(), [[0, 0, 0], [1, 0, 0], [1, 0, 2]])
+    assert tree.spatialDist(pR, p2) == np.sqrt(5)
+    assert tree.spatialAndTreeDist(p1, p2) == (2, 2)
+    assert b0.worldLengths() == (3, 0)
+    assert b0.cumulativeWorldLengths() == [1, 3]
+    assert tree.closestPointToWorldLocation((1, 0, 1.5)) is p2
+
+def testSubtreeMetrics():
+    fullState = FullState()
+    fullState.projectOptions.pixelSizes = [1, 1, 1]
+    tree = Tree()
+    fullState.addFiles(['test.tif'], [tree])
+
+    # Main branch of length 2 along x, with a longer child branch of length 1 + 4 along y.
+    pR = Point(id='root', location=(0,0,0))
+    tree.rootPoint = pR
+    b0, b1 = Branch(id='b0'), Branch(id='b1')
+    b0.setParentPoint(pR)
+    tree.addBranch(b0)
+    p1 = Point(id='p1', location=(1,0,0))
+    p2 = Point(id='p2', location=(2,0,0))
+    b0.addPoint(p1)
+    b0.addPoint(p2)
+    b1.setParentPoint(p1)
+    p3 = Point(id='p3', location=(1,1,0))
+    p4 = Point(id='p4', location=(1,5,0))
+    b1.addPoint(p3)
+    b1.addPoint(p4)
+    tree.addBranch(b1)
+
+    rows = tree.arrays().rowsFor([pR, p1, p2, p3, p4])
+    metrics = tree.subtreeMetrics()
+    assert np.allclose(metrics.longestDistanceToLeaf[rows], [6, 5, 0, 4, 0])
+    assert np.allclose(metrics.pathLengthFromRoot[rows], [0, 1, 2, 2, 6])
+    assert np.allclose(metrics.spatialDistFromRoot[rows], [0, 1, 2, np.sqrt(2), np.sqrt(26)])
+    assert tree.subtreeMetrics() is metrics
+    assert p1.longestDistanceToLeaf() == 5
+    assert tree.spatialAndTreeRadius() == (np.sqrt(26), 6)
+
+    # Longer child branch should now continue the main branch:
+    tree.updateAllPrimaryBranches()
+    assert [p.id for p in b0.points] == ['p1', 'p3', 'p4']
+    assert [p.id for p in b1.points] == ['p2']
+    assert b1.parentPoint is p1
+    assert tree.subtreeMetrics() is not metrics
+
+def testTreeDistances():
+    fullState = FullState()
+    fullState.projectOptions.pixelSizes = [0.5, 0.5, 2.0]
+    tree = Tree()
+    fullState.addFiles(['test.tif'], [tree])
+
+    # Randomly attached branches, to get a variety of depths and common ancestors.
+    rng = np.random.RandomState(0)
+    tree.rootPoint = Point(id='root', location=(0,0,0))
+    allPoints = [tree.rootPoint]
+    for b in range(30):
+        branch = Branch(id='b%d' % b)
+        branch.setParentPoint(allPoints[rng.randint(len(allPoints))])
+        tree.addBranch(branch)
+        for _ in range(rng.randint(1, 8)):
+            point = Point(id='p%d' % len(allPoints), location=tuple(rng.uniform(-10, 10, 3)))
+            branch.addPoint(point)
+            allPoints.append(point)
+
+    def _walkedTreeDist(pA, pB):
+        pathA, pathB = pA.pathFromRoot(), pB.pathFromRoot()
+        common = 0
+        while common < min(len(pathA), len(pathB)) and pathA[common] is pathB[common]:
+            common += 1
+        dist = 0.0
+        for path in [pathA[common - 1:], pathB[common - 1:]]:
+            for i in range(len(path) - 1):
+                dist += tree.spatialDist(path[i], path[i + 1])
+        return dist
+
+    sample = [allPoints[i] for i in rng.choice(len(allPoints), 25, replace=False)] + [tree.rootPoint]
+    matrix = tree.treeDistanceMatrix(sample)
+    assert matrix.shape == (len(sample), len(sample))
+    for i, pA in enumerate(sample):
+        for j, pB in enumerate(sample):
+            assert np.isclose(matrix[i, j], _walkedTreeDist(pA, pB))
+    assert np.allclose(np.diag(matrix), 0)
+    assert np.allclose(tree.treeDistances(sample[:5], sample[5:10]), np.diag(matrix[:5, 5:10]))
+    assert np.isclose(tree.spatialAndTreeDist(sample[0], sample[1])[1], matrix[0, 1])
+
+    rows = tree.arrays().rowsFor(sample)
+    ancestors = tree.ancestorIndex().lowestCommonAncestors(rows, rows[0])
+    assert ancestors[0] == rows[0] and ancestors[-1] == 0
+
+    # Disconnected points can't be used:
+    try:
+        tree.treeDistanceMatrix([Point(id='lost', location=(0,0,0))])
+        assert False, "Expected failure for disconnected point"
+    except ValueError:
+        pass
+
+def testSpatialIndex():
+    fullState = FullState()
+    fullState.projectOptions.pixelSizes = [0.5, 0.5, 2.0]
+    tree = Tree()
+    fullState.addFiles(['test.tif'], [tree])
+
+    # Integer locations, so there are plenty of ties for the closest point.
+    rng = np.random.RandomState(1)
+    tree.rootPoint = Point(id='root', location=(0,0,0))
+    allPoints = [tree.rootPoint]
+    for b in range(20):
+        branch = Branch(id='b%d' % b)
+        branch.setParentPoint(allPoints[rng.randint(len(allPoints))])
+        tree.addBranch(branch)
+        for _ in range(rng.randint(1, 8)):
+            point = Point(id='p%d' % len(allPoints), location=tuple(float(v) for v in rng.randint(-5, 6, 3)))
+            branch.addPoint(point)
+            allPoints.append(point)
+
+    def _scanClosest(target, zFilter=False, world=False):
+        closestDist, closestPoint = None, None
+        for point in tree.flattenPoints():
+            if zFilter and round(point.location[2]) != round(target[2]):
+                continue
+            location = tree.worldCoordArray([point])[0] if world else point.location
+            dist = np.linalg.norm(np.array(location) - target)
+            if closestDist is None or dist < closestDist:
+                closestDist, closestPoint = dist, point
+        return closestPoint
+
+    for target in rng.randint(-6, 7, (100, 3)).astype(float):
+        assert tree.closestPointTo(target) is _scanClosest(target)
+        assert tree.closestPointTo(target, zFilter=True) is _scanClosest(target, zFilter=True)
+        assert tree.closestPointToWorldLocation(target) is _scanClosest(target, world=True)
+    planePoints = tree.pointsInZPlane(2.4)
+    assert planePoints == [p for p in tree.flattenPoints() if round(p.location[2]) == 2]
+    assert tree.closestPointTo((0, 0, 100), zFilter=True) is None
+
+    # Index is rebuilt after points move:
+    index = tree.spatialIndex()
+    allPoints[-1].location = (50, 50, 50)
+    assert tree.spatialIndex() is not index
+    assert tree.closestPointTo((49, 49, 49)) is allPoints[-1]
+
+def testMoveDownstream():
+    fullState = FullState()
+    tree = Tree()
+    fullState.addFiles(['test.tif'], [tree])
+
+    # Long enough that moving point-by-point recursively would fail:
+    tree.rootPoint = Point(id='root', location=(0,0,0))
+    b0, b1 = Branch(id='b0'), Branch(id='b1')
+    b0.setParentPoint(tree.rootPoint)
+    tree.addBranch(b0)
+    for i in range(5000):
+        b0.addPoint(Point(id='p%d' % i, location=(i + 1, 0, 0)))
+    b1.setParentPoint(b0.points[10])
+    tree.addBranch(b1)
+    for i in range(3):
+        b1.addPoint(Point(id='c%d' % i, location=(11, i + 1, 0)))
+
+    before = tree.arrays()
+    tree.movePoint('p5', (6, 0, 2), downstream=True)
+    assert b0.points[4].location == (5, 0, 0)
+    assert b0.points[5].location == (6, 0, 2)
+    assert b0.points[-1].location == (5000, 0, 2)
+    assert [p.location for p in b1.points] == [(11, 1, 2), (11, 2, 2), (11, 3, 2)]
+    assert tree.arrays() is not before
+
+    # Moving from the soma moves everything, each point only once:
+    assert len(tree.downstreamPoints(tree.rootPoint)) == len(tree.flattenPoints())
+    tree.movePoint('root', (1, 1, 1), downstream=True)
+    assert b0.points[4].location == (6, 1, 1)
+    assert b1.points[2].location == (12, 4, 3)
+
+def testTraversal():
+    """
+    Same tree as testBranchOrder:
+    b0: pR-p1-p2-p3
+    b1: p2-p4
+    b2: p1-p5-p7
+    b3: p5-p6
+    """
+    tree = Tree()
+    pR = Point(id='root', location=(0,0,0))
+    tree.rootPoint = pR
+    points = {pID: Point(id=pID, location=(0,0,i)) for i, pID in enumerate(['p1', 'p2', 'p3', 'p4', 'p5', 'p6', 'p7'])}
+    for bID, parentID, pointIDs in [('b0', None, ['p1', 'p2', 'p3']), ('b1', 'p2', ['p4']), ('b2', 'p1', ['p5', 'p7']), ('b3', 'p5', ['p6'])]:
+        branch = Branch(id=bID)
+        branch.setParentPoint(pR if parentID is None else points[parentID])
+        for pointID in pointIDs:
+            branch.addPoint(points[pointID])
+        tree.addBranch(branch)
+
+    def _ids(items):
+        return [item.id for item in items]
+
+    assert _ids(tree.iterPoints()) == ['root', 'p1', 'p5', 'p6', 'p7', 'p2', 'p4', 'p3']
+    assert _ids(tree.iterPoints()) == _ids(tree.flattenPoints())
+    assert _ids(tree.iterPoints(order=POST_ORDER)) == ['p6', 'p7', 'p5', 'p4', 'p3', 'p2', 'p1', 'root']
+    assert _ids(points['p5'].iterSubtree()) == ['p5', 'p6', 'p7']
+    assert _ids(points['p2'].iterSubtree(order=POST_ORDER)) == ['p4', 'p3', 'p2']
+    assert _ids(tree.iterBranches()) == ['b0', 'b2', 'b3', 'b1']
+    assert _ids(tree.iterBranches(descendInto=lambda b: b.id != 'b2')) == ['b0', 'b2', 'b1']
+    assert points['p1'].subtreeContainsID('p6') and not points['p5'].subtreeContainsID('p4')
+
+    triples = findAllTriples(tree, pR, None)
+    assert [tuple(_ids(t)) for t in triples] == [
+        ('root', 'p1', 'p5'), ('p1', 'p5', 'p6'), ('p1', 'p5', 'p7'),
+        ('root', 'p1', 'p2'), ('p1', 'p2', 'p4'), ('p1', 'p2', 'p3'),
+    ]
+
+    # Deep trees shouldn't hit the recursion limit:
+    branch = tree.getBranchByID('b3')
+    for i in range(5000):
+        branch.addPoint(Point(id='deep%d' % i, location=(0,0,0)))
+        branch = Branch(id='deepBranch%d' % i)
+        branch.setParentPoint(tree.getPointByID('deep%d' % i))
+        tree.addBranch(branch)
+    assert len(list(tree.iterPoints(order=POST_ORDER))) == 8 + 5000
+    assert len(list(tree.iterBranches())) == 4 + 5000
+
 def run():
     testBranchOrder()
+    testIDIndex()
+    testPositionIndex()
+    testTreeArrays()
+    testChildlessRoot()
+    testWorldCoords()
+    testSubtreeMetrics()
+    testTreeDistances()
+    testSpatialIndex()
+    testMoveDownstream()
+    testTraversal()
     return True
 
 if __name__ == '__main__':
@@ -1,6 +1,151 @@
+import numpy as np
+import os
+import tempfile
+
 import pydynamo_brain.files as files
+from pydynamo_brain.model import *
+
+SCAN_PATH = "pydynamo_brain/pydynamo_brain/test/files/scan1Auto.swc"
+EXAMPLE_PATH = "pydynamo_brain/pydynamo_brain/test/files/example2.dyn.gz"
+
+# Soma with two branches, one of which forks. Separated by a mix of spaces and tabs.
+FORKED_SWC = """#name forked
+#xc1 = 511
+
+1 1 0 0 0 2.5 -1
+2\t3\t1.0\t0\t0\t1\t1
+3  3  2.0  0  0  1  2
+4 3 0 1 0 1 1
+5 3  2.0 1.0 0 1 2
+\t6 3 3 0 0 1 3
+"""
+
+def _importText(text):
+    with tempfile.TemporaryDirectory() as tmpDir:
+        path = os.path.join(tmpDir, 'test.swc')
+        with open(path, 'w') as outfile:
+            outfile.write(text)
+        return files.importFromSWC(path)
+
+# Tests the branch structure of a small imported file, with any whitespace between values.
+def testImportStructure():
+    tree = _importText(FORKED_SWC)
+    assert tree.rootPoint.id == '1'
+    assert tree.rootPoint.location == (0.0, 0.0, 0.0) and tree.rootPoint.radius == 2.5
+
+    # First child continues the branch, later children start new ones.
+    branchPoints = [(b.id, b.parentPoint.id, [p.id for p in b.points]) for b in tree.branches]
+    assert branchPoints == [
+        ('0000', '1', ['2', '3', '6']),
+        ('0001', '1', ['4']),
+        ('0002', '2', ['5']),
+    ], branchPoints
+    assert tree.getPointByID('5').location == (2.0, 1.0, 0.0)
+    assert tree.getPointByID('6').parentBranch is tree.branches[0]
+    assert [b.id for b in tree.getPointByID('2').children] == ['0002']
+
+# Tests files that can't be converted are rejected.
+def testImportErrors():
+    assert _importText("1 1 0 0 0 1 -1\n2 3 1 0 0 1\n") is None # Missing column
+    assert _importText("1 1 0 0 0 1 -1\n2 3 1 0 0 1 -1\n") is None # Two somas
+    assert _importText("#Only comments\n") is None
+
+    # Nodes not connected to the soma are dropped.
+    tree = _importText("1 1 0 0 0 1 -1\n2 3 1 0 0 1 1\n3 3 2 0 0 1 7\n")
+    assert [p.id for p in tree.flattenPoints()] == ['1', '2']
+
+# Tests a real reconstruction, traced by Vaa3D.
+def testImportScan():
+    tree = files.importFromSWC(SCAN_PATH)
+    assert len(tree.flattenPoints()) == 194
+    for branch in tree.branches:
+        assert branch.parentPoint is not None
+        assert all(point.parentBranch is branch for point in branch.points)
+
+# Tests exporting every stack at once, and reading the files back in.
+def testExportAll():
+    fullState = files.loadState(EXAMPLE_PATH)
+    fullState.volumeSize = [1, 20, 512, 512]
+    fullState.projectOptions.pixelSizes = [0.5, 0.25, 2.0]
+    with tempfile.TemporaryDirectory() as tmpDir:
+        paths = files.exportAllToSWC(tmpDir, fullState, threads=2)
+        assert [os.path.basename(path) for path in paths] == [
+            files.swc.swcNameForStack(stackPath) for stackPath in fullState.filePaths
+        ]
+
+        for path, tree in zip(paths, fullState.trees):
+            # Same as exporting each on its own:
+            files.exportToSWC(tmpDir, 'single.swc', tree, fullState)
+            with open(path) as allFile, open(os.path.join(tmpDir, 'single.swc')) as singleFile:
+                allLines, singleLines = allFile.read().split('\n'), singleFile.read().split('\n')
+            assert allLines[1:] == singleLines[1:] # Only the #name differs
+
+            # Every point comes back at the same location, under the same parent.
+            # Point IDs are SWC indexes, which are original rows + 1.
+            original, reread = tree.arrays(), files.importFromSWC(path).flattenPoints()
+            assert len(original) == len(reread)
+            for point in reread:
+                assert np.allclose(original.locations[int(point.id) - 1], point.location, atol=1e-4)
+                parent = point.nextPointInBranch(delta=-1)
+                parentRow = -1 if parent is None else int(parent.id) - 1
+                assert original.parents[int(point.id) - 1] == parentRow
+
+        # World coordinates and types for NeuroM:
+        paths = files.exportAllToSWC(tmpDir, fullState, forNeuroM=True)
+        with open(paths[0]) as neuroMFile:
+            nodes = [line.split() for line in neuroMFile if line[0] != '#']
+    tree = fullState.trees[0]
+    assert len(nodes) == len(tree.flattenPoints())
+    assert nodes[0][1] == '1' and all(node[1] == '3' for node in nodes[1:])
+    x, y, z = tree.rootPoint.location
+    assert [float(v) for v in nodes[0][2:5]] == [round(x * 0.5, 4), round(y * 0.25, 4), round(z * 2.0, 4)]
+
+# Tests importing a directory of SWC files as a new project, like importing each through the UI.
+def testBatchImport():
+    from pydynamo_brain.importSWC import runSWCImport
+    with open(SCAN_PATH) as scanFile:
+        scanText = scanFile.read()
+
+    with tempfile.TemporaryDirectory() as tmpDir:
+        # Numbered out of alphabetical order, and with extra whitespace:
+        for name, text in [('t10.swc', FORKED_SWC), ('t2.swc', scanText), ('t1.swc', FORKED_SWC.replace(' ', '  '))]:
+            with open(os.path.join(tmpDir, name), 'w') as outfile:
+                outfile.write(text)
+        swcPaths = files.findSWCFiles(tmpDir)
+        assert [os.path.basename(path) for path in swcPaths] == ['t1.swc', 't2.swc', 't10.swc']
+
+        expected = FullState()
+        for path in swcPaths:
+            tree = Tree()
+            expected.addFiles([path.replace('.swc', '.tif')], [tree])
+            tree.clearAndCopyFrom(files.importFromSWC(path), expected)
+        expectedText = files.fullStateToString(expected)
+        for workers in [1, 2]:
+            fullState = files.importSWCFiles(swcPaths, workers=workers)
+            assert files.fullStateToString(fullState) == expectedText
+        assert fullState.nextPointID() == expected.nextPointID()
+
+        # And from the command line, straight to a project file:
+        savePath = os.path.join(tmpDir, 'project.dynb')
+        assert runSWCImport([os.path.join(tmpDir, 't*.swc'), '-o', savePath, '--workers', '1']) == 0
+        assert files.fullStateToString(files.loadState(savePath)) == expectedText
+
+        # Files that can't be imported leave an empty stack, so the others keep their timepoints.
+        with open(os.path.join(tmpDir, 't1.swc'), 'w') as outfile:
+            outfile.write("1 1 0 0 0 1\n")
+        fullState = files.importSWCFiles(swcPaths, workers=1)
+        assert len(fullState.trees) == 3 and fullState.trees[0].rootPoint is None
+        assert len(fullState.trees[2].flattenPoints()) == 6
 
 def run(path='data/swcTest/7f_ss_cell1_step0_av2.tif_x122_y34_z26_app2.swc'):
+    testImportStructure()
+    testImportErrors()
+    testImportScan()
+    testExportAll()
+    testBatchImport()
     tree = files.importFromSWC(path)
-    # TODO - verify tree struture
+    assert tree.rootPoint is not None and len(tree.branches) > 0
     return True
+
+if __name__ == '__main__':
+    run()
@@ -152,6 +152,7 @@ class DendriteCanvasActions():
         thisPuncta = copy.deepcopy(lastPuncta)
         assert thisPuncta is not None and lastPuncta is not None
         self.uiState.parent().puncta.append(thisPuncta)
+        self.uiState.parent().markEdited()
     
     def importPointsFromSWC(self, windowIndex, filePath):
         thisTree = self.uiState.parent().trees[windowIndex]
@@ -172,6 +173,7 @@ class DendriteCanvasActions():
             fullState.traces.append([])
         if filePath not in fullState.traces[windowIndex]:
             fullState.traces[windowIndex].append(filePath)
+            fullState.markEdited()
 
     def smartRegisterImages(self, windowIndex):
         if windowIndex == 0:
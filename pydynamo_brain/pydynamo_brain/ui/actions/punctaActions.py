@@ -34,6 +34,8 @@ class PunctaActions():
                 radius=self.DEFAULT_RADIUS_PX
             ))
             self.state.uiStates[atIndex].selectPunctaByID(newID)
+        # Puncta aren't in a tree, so the state isn't told about edits automatically:
+        self.state.markEdited()
 
     # Remove a point, and optionally the same point in later stacks:
     def removePoint(self, localIdx, targetPoint, laterStacks=False):
@@ -46,6 +48,7 @@ class PunctaActions():
                 self.state.puncta[atIndex] = [
                     point for point in self.state.puncta[atIndex] if point.id != targetID
                 ]
+        self.state.markEdited()
 
     # Select a point, on this stack and all other stacks its on
     def selectPoint(self, localIdx, pointClicked):
@@ -78,6 +81,7 @@ class PunctaActions():
         current = localState.currentPuncta()
         if current is not None:
             current.location = location
+            self.state.markEdited()
 
     # Move the middle of point, by a set amount
     def relativeMove(self, localIdx, dX, dY, laterStacks=False):
@@ -94,6 +98,7 @@ class PunctaActions():
                         current.location[1] + dY,
                         current.location[2]
                     )
+            self.state.markEdited()
 
     # Change the radius of a point, leaving center the same.
     def movePointBoundary(self, index, location):
@@ -102,6 +107,7 @@ class PunctaActions():
         if current is not None:
             self.history.pushState()
             current.radius = deltaSz(location, current.location)
+            self.state.markEdited()
 
     # Grow/shrink the radius of point, by a set ratio
     def relativeGrow(self, localIdx, dR, laterStacks=False):
@@ -114,5 +120,6 @@ class PunctaActions():
                 current = self._localState(atIndex).currentPuncta()
                 if current is not None:
                     current.radius *= dR
+            self.state.markEdited()
     
 
@@ -29,6 +29,9 @@ class BranchToColorMap():
         if branch is None:
             # Default to root, if no branch provided
             return ROOT_COLOR_ID
+        if branch.id not in self._branchToColorID and branch._parentTree is not None:
+            # Lazily loaded trees are only mapped once they're used:
+            self.addNewTree(branch._parentTree)
         if branch.id not in self._branchToColorID:
             print ("Branch %s doesn't have a color?!" % branch.id)
             return ROOT_COLOR_ID
@@ -78,7 +81,8 @@ class BranchToColorMap():
     def initFromFullState(self, fullState):
         self._branchToColorID = dict()
         for tree in fullState.trees:
-            self.addNewTree(tree)
+            if tree.isLoaded():
+                self.addNewTree(tree)
 
     # Add a new tree to the mapping:
     def addNewTree(self, tree):
@@ -39,7 +39,7 @@ class Dendrite3DCanvas(BaseMatplotlibCanvas):
         ax.scatter(x, y, z, c=_BRANCH_TO_COLOR_MAP.rgbForBranch(None), s=100)
 
         # Scale results to keep same aspect ratio (matplotlib apsect='equal' is broken in 3d...)
-        x, y, z = self.treeModel.worldCoordPoints(self.treeModel.flattenPoints())
+        x, y, z = self.treeModel.worldCoordArray().T
         xmin, xmax = np.min(x), np.max(x)
         ymin, ymax = np.min(y), np.max(y)
         zmin, zmax = np.min(z), np.max(z)
@@ -202,11 +202,11 @@ class DendriteVolumeCanvas(QWidget):
 
         # TODO - share with below
         closestDist, closestPoint = None, None
-        allPoints = self.uiState._tree.flattenPoints()
+        if zFilter:
+            allPoints = self.uiState._tree.pointsInZPlane(location[2])
+        else:
+            allPoints = self.uiState._tree.flattenPoints()
         for point in allPoints:
-            if zFilter and round(point.location[2]) != round(location[2]):
-                continue
-
             radius = dotSize
             resizeRadius = False
             if radius is None:
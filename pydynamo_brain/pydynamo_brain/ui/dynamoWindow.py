@@ -2,7 +2,7 @@ from PyQt5 import QtCore, QtWidgets, QtGui
 from PyQt5.Qt import Qt
 
 from pydynamo_brain.model import FullState, Tree, UIState, History
-from pydynamo_brain.files import AutoSaver, loadState, saveState, checkIfChanged, importFromMatlab, exportToSWC, saveRemapWithMerge
+from pydynamo_brain.files import AutoSaver, Journal, hasJournal, loadState, saveState, checkIfChanged, importFromMatlab, exportAllToSWC, saveRemapWithMerge
 from pydynamo_brain.util import moveInList
 from pydynamo_brain.util.testableFilePicker import getOpenFileName
 
@@ -13,17 +13,24 @@ import time
 from .actions import FullStateActions
 from .analysisWindow import AnalysisWindow
 from .branchToColorMap import BranchToColorMap
-from .common import centerWindow, createAndShowInfo, cursorPointer
+from .common import centerWindow, cursorPointer
 from .initialMenu import InitialMenu
 from .settingsWindow import SettingsWindow
 from .stackListWindow import StackListWindow
 from .stackWindow import StackWindow
 from .tilefigs import tileFigs
 
+# How long autosave messages stay in the status bar:
+AUTOSAVE_MESSAGE_MS = 5000
+
 class DynamoWindow(QtWidgets.QMainWindow):
+    # Autosave results come from a worker thread, so are passed back to the UI thread via a signal:
+    autoSaveStatus = QtCore.pyqtSignal(str)
+
     def __init__(self, app, argv):
         QtWidgets.QMainWindow.__init__(self, None)
         self.app = app
+        self.autoSaveStatus.connect(self.showAutoSaveStatus)
 
         self.stackWindows = []
         self.fullState = FullState()
@@ -42,7 +49,7 @@ class DynamoWindow(QtWidgets.QMainWindow):
 
         if len(argv) == 1:
             fileToOpen = argv[0]
-            if fileToOpen.endswith(".dyn.gz"):
+            if fileToOpen.endswith(".dyn.gz") or fileToOpen.endswith(".dynb"):
                 self.openFromFile(fileToOpen)
             elif fileToOpen.endswith(".mat"):
                 self.importFromMatlab(fileToOpen)
@@ -97,6 +104,8 @@ class DynamoWindow(QtWidgets.QMainWindow):
             )
             if reply == QtWidgets.QMessageBox.No:
                 return # Don't quit!
+        if self.autoSaver is not None:
+            self.autoSaver.close()
         if self.app is not None:
             self.app.quit()
 
@@ -114,18 +123,35 @@ class DynamoWindow(QtWidgets.QMainWindow):
         print ("File: '%s'" % filePath)
         if filePath == "":
             filePath, _ = QtWidgets.QFileDialog.getOpenFileName(self,
-                "Open dynamo save file", "", "Dynamo files (*.dyn.gz)"
+                "Open dynamo save file", "", "Dynamo files (*.dyn.gz *.dynb)"
             )
         if filePath != "":
             self.stackList.show()
-            self.fullState = loadState(filePath)
+            # Stacks are only loaded once shown (for formats that support it):
+            self.fullState = loadState(filePath, lazy=True)
+            journal = self.maybeRecoverJournal(filePath)
             self.history = History(self.fullState)
             self.fullActions = FullStateActions(self.fullState, self.history)
-            self.autoSaver = AutoSaver(self.fullState)
+            self.autoSaver = AutoSaver(self.fullState, journal)
             BranchToColorMap().initFromFullState(self.fullState)
             self.initialMenu.hide()
             self.makeNewWindows()
 
+    # Offer to replay edits journaled but never saved, e.g. if the app crashed:
+    def maybeRecoverJournal(self, filePath):
+        if not hasJournal(filePath):
+            return None
+        msg = "Found unsaved changes from a previous session, recover them?"
+        reply = QtWidgets.QMessageBox.question(
+            self, 'Recover changes?', msg, QtWidgets.QMessageBox.Yes, QtWidgets.QMessageBox.No
+        )
+        if reply == QtWidgets.QMessageBox.No:
+            return None # Journal gets replaced once the autosaver starts.
+        journal = Journal(filePath)
+        recovered = journal.replay(self.fullState)
+        print ("Recovered %d changes from %s" % (recovered, journal.path))
+        return journal
+
     def importFromMatlab(self, filePath=""):
         if filePath == "":
             filePath, _ = QtWidgets.QFileDialog.getOpenFileName(self,
@@ -146,6 +172,7 @@ class DynamoWindow(QtWidgets.QMainWindow):
             parentWindow = self
         if self.fullState._rootPath is not None:
             saveState(self.fullState, self.fullState._rootPath)
+            self.autoSaver.projectSaved()
             QtWidgets.QMessageBox.information(parentWindow, "Saved", "Data saved to " + self.fullState._rootPath)
         else:
             self.saveToNewFile(parentWindow)
@@ -153,14 +180,15 @@ class DynamoWindow(QtWidgets.QMainWindow):
     def saveToNewFile(self, parentWindow=None):
         if parentWindow is None:
             parentWindow = self
-        filePath, _ = QtWidgets.QFileDialog.getSaveFileName(parentWindow,
-            "New dynamo save file", "", "Dynamo files (*.dyn.gz)"
+        filePath, fileFilter = QtWidgets.QFileDialog.getSaveFileName(parentWindow,
+            "New dynamo save file", "", "Dynamo files (*.dyn.gz);;Dynamo binary files (*.dynb)"
         )
         if filePath != "":
-            if not filePath.endswith(".dyn.gz"):
-                filePath = filePath + ".dyn.gz"
+            if not filePath.endswith(".dyn.gz") and not filePath.endswith(".dynb"):
+                filePath = filePath + (".dynb" if "dynb" in fileFilter else ".dyn.gz")
             self.fullState._rootPath = filePath
             saveState(self.fullState, filePath)
+            self.autoSaver.projectSaved()
             QtWidgets.QMessageBox.information(parentWindow, "Saved", "Data saved to " + filePath)
 
     def exportToSWC(self, parentWindow=None):
@@ -170,11 +198,7 @@ class DynamoWindow(QtWidgets.QMainWindow):
             "Folder for SWC files", ""
         )
         if dirPath != None and dirPath != '':
-            for path, tree in zip(self.fullState.filePaths, self.fullState.trees):
-                childPath = os.path.basename(path)
-                childPath = childPath.replace(".tif", "").replace(".tiff", "").replace(".mat", "")
-                childPath = childPath + ".swc"
-                exportToSWC(dirPath, childPath, tree, self.fullState)
+            exportAllToSWC(dirPath, self.fullState)
         QtWidgets.QMessageBox.information(parentWindow, "Save complete", "SWC files saved!")
 
     # Global key handler for actions shared between all stack windows
@@ -249,7 +273,7 @@ class DynamoWindow(QtWidgets.QMainWindow):
 
     # Make the settings dialog visible:
     def openSettings(self):
-        self.settingsWindow.openFromState(self.fullState)
+        self.settingsWindow.openFromState(self.fullState, self.history)
 
     # Clean empty branches, show popup for changes
     def cleanEmptyBranches(self, parentWindow=None):
@@ -313,6 +337,7 @@ class DynamoWindow(QtWidgets.QMainWindow):
 
                 self.fullState.filePaths[i] = fixedPath
                 self.fullState.uiStates[i].imagePath = fixedPath
+                self.fullState.markEdited()
                 previousPath = fixedPath
 
             if self.fullState.uiStates[i].isHidden:
@@ -373,6 +398,7 @@ class DynamoWindow(QtWidgets.QMainWindow):
         moveInList(self.fullState.uiStates, indexFrom, indexTo)
         moveInList(self.fullState.puncta, indexFrom, indexTo)
         moveInList(self.stackWindows, indexFrom, indexTo)
+        self.fullState.markEdited()
         for i, stackWindow in enumerate(self.stackWindows):
             if stackWindow is not None:
                 stackWindow.updateWindowIndex(i)
@@ -413,8 +439,13 @@ class DynamoWindow(QtWidgets.QMainWindow):
     # TODO - listen to full state changes.
     def maybeAutoSave(self, originWindow=None):
         if self.autoSaver is not None:
-            showInfoCB = lambda msg: createAndShowInfo(msg, originWindow)
-            self.autoSaver.handleStateChange(showInfoCB)
+            self.autoSaver.handleStateChange(self.autoSaveStatus.emit)
+
+    # Briefly show the result of an autosave on all open windows:
+    def showAutoSaveStatus(self, msg):
+        for window in self.stackWindows:
+            if window is not None:
+                window.statusBar().showMessage(msg, AUTOSAVE_MESSAGE_MS)
 
     def updateUndoStack(self, isRedo, originWindow=None):
         if originWindow is not None:
@@ -202,7 +202,7 @@ class Motility3DCanvas(BaseMatplotlibCanvas):
 
             # Make equal aspect ratio:
             if not self.dendrogram:
-                x, y, z = treeModel.worldCoordPoints(treeModel.flattenPoints())
+                x, y, z = treeModel.worldCoordArray().T
                 xmin, xmax = np.min(x), np.max(x)
                 ymin, ymax = np.min(y), np.max(y)
                 zmin, zmax = np.min(z), np.max(z)
@@ -77,7 +77,7 @@ class Registration3DCanvas(BaseMatplotlibCanvas):
         self.drawPointsOneColor(ax, treeModel, [treeModel.rootPoint], somaColor, s=350) # Big soma
 
         # Make equal aspect ratio:
-        x, y, z = treeModel.worldCoordPoints(treeModel.flattenPoints())
+        x, y, z = treeModel.worldCoordArray().T
         xmin, xmax = np.min(x), np.max(x)
         ymin, ymax = np.min(y), np.max(y)
         zmin, zmax = np.min(z), np.max(z)
@@ -4,10 +4,13 @@ import numpy as np
 from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.Qt import Qt
 
-from pydynamo_brain.model import MotilityOptions, ProjectOptions
+from pydynamo_brain.files.compression import LEVEL_RANGES, availableCodecs
+from pydynamo_brain.model import History, MotilityOptions, ProjectOptions
 
 from .common import centerWindow, cursorPointer, floatOrDefault
 
+_BYTES_PER_MB = 1024 * 1024
+
 class SettingsWindow(QtWidgets.QMainWindow):
     def __init__(self, parent):
         QtWidgets.QMainWindow.__init__(self, parent)
@@ -45,6 +48,19 @@ class SettingsWindow(QtWidgets.QMainWindow):
         for option in ['max', 'mean', 'median', 'std']:
             self.zProjectionMethod.addItem(option)
 
+        # Fields for saving:
+        self.compression = QtWidgets.QComboBox(self.root)
+        for codec in availableCodecs():
+            self.compression.addItem(codec)
+        self.compressionLevel = QtWidgets.QLineEdit(self.root)
+        self.compressionLevel.setValidator(QtGui.QIntValidator(0, 22))
+        self.compressionLevel.setPlaceholderText("default")
+
+        # Fields for undo history:
+        self.historyBudget = QtWidgets.QLineEdit(self.root)
+        self.historyBudget.setValidator(QtGui.QDoubleValidator(0, 100000, 0))
+        self.historyFootprint = QtWidgets.QLabel(self.root)
+
         # First up: Pixel x/y/z size in microns
         pixelSizes = QtWidgets.QWidget(self)
         l1 = QtWidgets.QFormLayout(pixelSizes)
@@ -67,6 +83,14 @@ class SettingsWindow(QtWidgets.QMainWindow):
         l3 = QtWidgets.QFormLayout(otherOptions)
         l3.addRow("Sholl bin size (μM)", self.shollBinSize)
         l3.addRow("Z projection method", self.zProjectionMethod)
+        l3.addRow("Save compression", self.compression)
+        l3.addRow("Compression level (higher = smaller, slower)", self.compressionLevel)
+
+        # Then: Undo history, older changes past the memory limit are moved to disk
+        historyOptions = QtWidgets.QWidget(self)
+        l4 = QtWidgets.QFormLayout(historyOptions)
+        l4.addRow("Memory limit (MB)", self.historyBudget)
+        l4.addRow("Current size", self.historyFootprint)
 
         # And finally, buttons:
         bCancel = QtWidgets.QPushButton("Cancel", self)
@@ -90,13 +114,16 @@ class SettingsWindow(QtWidgets.QMainWindow):
         l.addWidget(motOptions)
         l.addWidget(QtWidgets.QLabel("Other options"))
         l.addWidget(otherOptions)
+        l.addWidget(QtWidgets.QLabel("Undo history"))
+        l.addWidget(historyOptions)
         l.addWidget(buttons)
 
         self.root.setFocus()
         self.setCentralWidget(self.root)
 
-    def openFromState(self, fullState):
+    def openFromState(self, fullState, history=None):
         self.fullState = fullState
+        self.history = history
 
         self.xValue.setText("%.3f" % fullState.projectOptions.pixelSizes[0])
         self.yValue.setText("%.3f" % fullState.projectOptions.pixelSizes[1])
@@ -120,17 +147,43 @@ class SettingsWindow(QtWidgets.QMainWindow):
             comboIdx = 0 # Default to first option
         self.zProjectionMethod.setCurrentIndex(comboIdx)
 
+        comboIdx = self.compression.findText(fullState.projectOptions.compression, QtCore.Qt.MatchFixedString)
+        self.compression.setCurrentIndex(max(comboIdx, 0))
+        level = fullState.projectOptions.compressionLevel
+        self.compressionLevel.setText("" if level is None else "%d" % level)
+
+        budgetBytes = History.MEMORY_BUDGET_BYTES if history is None else history.memoryBudgetBytes
+        self.historyBudget.setText("%d" % round(budgetBytes / _BYTES_PER_MB))
+        self.historyFootprint.setText(self.describeHistory())
+
         self.show()
 
     def saveOptions(self):
-        self.fullState.projectOptions = self.buildProjectOptions()
+        self.fullState.setProjectOptions(self.buildProjectOptions())
+        # Budget applies to this session, including projects opened later:
+        budgetBytes = int(floatOrDefault(self.historyBudget, History.MEMORY_BUDGET_BYTES / _BYTES_PER_MB) * _BYTES_PER_MB)
+        History.MEMORY_BUDGET_BYTES = budgetBytes
+        if self.history is not None:
+            self.history.setMemoryBudget(budgetBytes)
         self.fullState = None
+        self.history = None
         self.close()
 
     def cancelOptions(self):
         self.fullState = None
+        self.history = None
         self.close()
 
+    def describeHistory(self):
+        if self.history is None:
+            return "-"
+        footprint = self.history.footprint()
+        text = "%d undo / %d redo, %.1f MB in memory" % (
+            footprint.undoCount, footprint.redoCount, footprint.memoryBytes / _BYTES_PER_MB)
+        if footprint.spilledCount > 0:
+            text += ", %d on disk (%.1f MB)" % (footprint.spilledCount, footprint.diskBytes / _BYTES_PER_MB)
+        return text
+
     ### Copy fields into options model objects.
     def buildProjectOptions(self):
         options = ProjectOptions()
@@ -143,8 +196,17 @@ class SettingsWindow(QtWidgets.QMainWindow):
         # TODO - split into buildAnalysisOptions if more get added here...
         options.analysisOptions['shollBinSize'] = floatOrDefault(self.shollBinSize, 5.0)
         options.zProjectionMethod = self.zProjectionMethod.currentText()
+        options.compression = self.compression.currentText()
+        options.compressionLevel = self.buildCompressionLevel(options.compression)
         return options
 
+    def buildCompressionLevel(self, codec):
+        text = self.compressionLevel.text().strip()
+        if text == "":
+            return None
+        low, high = LEVEL_RANGES[codec]
+        return min(max(int(text), low), high)
+
     def buildMotilityOptions(self):
         options = MotilityOptions()
         options.filoDist = floatOrDefault(self.filoDist, 5)
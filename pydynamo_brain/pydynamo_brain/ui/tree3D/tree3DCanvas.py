@@ -36,7 +36,7 @@ class Tree3DCanvas(BaseMatplotlibCanvas):
         for offset, ax in enumerate(self.axes):
             treeIdx = self.firstTree + offset
             treeModel = self.treeModels[treeIdx]
-            x, y, z = treeModel.worldCoordPoints(treeModel.flattenPoints())
+            x, y, z = treeModel.worldCoordArray().T
             if xmin is None:
                 xmin, xmax = np.min(x), np.max(x)
                 ymin, ymax = np.min(y), np.max(y)
@@ -12,6 +12,11 @@ Point3D = Tuple[float, float, float]
 SAVE_KEY = 'persist'
 SAVE_META: Dict[str, bool] = {SAVE_KEY: True}
 
+# Fields that are only saved when not their default, so files that don't use them
+# still load in versions from before the field was added.
+SAVE_UNLESS_DEFAULT_KEY = 'persistUnlessDefault'
+SAVE_UNLESS_DEFAULT_META: Dict[str, bool] = {SAVE_KEY: True, SAVE_UNLESS_DEFAULT_KEY: True}
+
 # Function that does nothing:
 NOOP_FUNC = lambda: None
 
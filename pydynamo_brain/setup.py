@@ -181,6 +181,7 @@ setup(
     entry_points={  # Optional
          'console_scripts': [
              'pydynamo_brain=pydynamo_brain:runDynamo',
+             'pydynamo_brain_swc=pydynamo_brain.importSWC:runSWCImport',
          ],
     },
 
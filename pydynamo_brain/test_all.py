@@ -4,6 +4,7 @@
 from pydynamo_brain.test import (
     absOrientTest,
     dendrogramTest,
+    filesTest,
     historyTest,
     modelTest,
     motilityTest,
@@ -25,6 +26,11 @@ def test_dendrogram():
     assert dendrogramTest.run()
     print ("")
 
+def test_files():
+    print ("Files test...")
+    assert filesTest.run()
+    print ("")
+
 def test_history():
     print ("History test...")
     assert historyTest.run()
@@ -74,6 +80,7 @@ def test_uiPuncta(qtbot):
 
 if __name__ == '__main__':
     test_absOrient()
+    test_files()
     test_history()
     test_motility()
     test_recursiveAdjust()